@@ -202,23 +202,11 @@
 
 # print(diff)
 
-# find out all the files with size 50.0 B and get the tile ids
-import os
-target_dir = '/data/Datasets/MatchingResult_All/MatchedCensusTrees_2017' 
-files = os.listdir(target_dir)
-size_50 = []
-for file in files:
-    if os.path.getsize(os.path.join(target_dir, file)) == 50:
-        tile_id = file.split('_')[-1].split('.')[0]
-        size_50.append(tile_id)
-save_path = '/data/Datasets/MatchingResult_All/MatchedCensusTrees_2017/size_50.csv'
-with open(save_path, 'w') as f:
-    for file in size_50:
-        f.write(file + '\n')
-print('length of size_50:', len(size_50))
-
-
-
-
-
-
+# empty (the 50 B FeatureCollections), malformed and missing outputs of both stages, one scandir per folder
+from coverage_audit import run_audit
+
+counts, diffs = run_audit(stage_dirs={'shading': '/data/Datasets/MatchingResult_All/MatchedShadingTrees_2017',
+                                      'census': '/data/Datasets/MatchingResult_All/MatchedCensusTrees_2017'},
+                          result_dir='/data/Datasets/MatchingResult_All/coverage')
+print(counts)
+print('length of size_50:', len(diffs['census_empty']))
@@ -1,525 +1,66 @@
 import os
-import sys
-import json
-import gc
-import numpy as np
-import pandas as pd
-import geopandas as gpd
-from shapely.geometry import Point, box, shape
-from sklearn.neighbors import NearestNeighbors
-from memory_profiler import profile
-from rtree import index
 import time
-import os
-import math
-import csv
-import io
-import signal
-from tqdm import tqdm
-from json.decoder import JSONDecodeError
+import zlib
 import logging
-import boto3
-from io import BytesIO
-from botocore.exceptions import ClientError
-
-# This version added the function to keep track of the progress of the processing tiles
+import argparse
+from tqdm import tqdm
+from pipeline_engine import (configure_logging, open_storage, load_all_geojson_files, process_tile, distance_in_feet,
+                             pipeline_code_version, register_census_claims, is_tile_processed)
+from tile_supervisor import process_tile_supervised
+from seam_reconciliation import init_census_claims, write_seam_corrections
+from tile_fingerprint import plan_stale_tiles
+from work_queue import (LEASE_SECONDS, default_worker_id, connect_queue, claim_seeding, seed_queue, wait_until_seeded,
+                        run_queue_worker, claim_finalizing, finish_finalizing, reset_queue, all_tile_ids)
+from tile_cost import estimate_tile_costs, lpt_order, lpt_makespan, estimate_remaining, format_duration
+from aggregate_cubes import CUBES_NAME, connect_cubes, update_tile_cubes
+
+# This version added the function to keep track of the progress of the processing tiles.
+# The stages themselves live in pipeline_engine.py; this script is the configuration and the
+# scheduling (supervision, work queue or shards, seam reconciliation) of the full AWS runs.
 
 # Configure logging
-log_directory = '/data/Datasets/MatchingResult_All'
+log_directory = os.environ.get('TREEFOLIO_LOG_DIR', '/data/Datasets/MatchingResult_All')
+configure_logging(log_directory)
 
 # ec2 = boto3.client('ec2', region_name='us-east-1')
 
-# Check if the log directory exists, and create it if it doesn't
-if not os.path.exists(log_directory):
-    os.makedirs(log_directory)
-
-log_filename = os.path.join(log_directory, 'tree_indexing.log')
-logging.basicConfig(filename=log_filename, filemode='a', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-
-s3 = boto3.client('s3')
-
-def read_s3_object(bucket_name, object_key):
-    try:
-        response = s3.get_object(Bucket=bucket_name, Key=object_key)
-        return response['Body'].read()
-    except s3.exceptions.NoSuchKey:
-        return None
-
-def list_s3_dirs(bucket_name, prefix):
-    s3 = boto3.client('s3')
-    paginator = s3.get_paginator('list_objects_v2')
-    dirs = set() 
-    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
-        if "CommonPrefixes" in page:
-            for obj in page['CommonPrefixes']:
-                # Split the prefix by '/' and filter out empty strings, then take the last element
-                dirs.add(obj['Prefix'].rstrip('/').split('/')[-1])
-    return list(dirs)
-
-
-def time_it(func):
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        tqdm.write(f"{func.__name__} took {end_time - start_time:.6f} seconds to execute.")
-        return result
-    return wrapper
-
-
-
-@profile
-def load_json_files_from_s3(bucket_name, base_prefix, tile_id, year):
-    all_json_data = []
-    # Construct the prefix
-    prefix = f"{base_prefix}{tile_id}/{year}/JSON_TreeData_{tile_id}/"
-    
-    try:
-        paginator = s3.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
-            if "Contents" not in page:
-                continue
-            for obj in page['Contents']:
-                json_file_key = obj['Key']
-                if not json_file_key.endswith('.json'):
-                    continue
-
-                try:
-                    # Use read_s3_object to get the file content
-                    json_file_content = read_s3_object(bucket_name, json_file_key)
-                    data = json.loads(json_file_content.decode('utf-8'))
-                    data['tile_id'] = tile_id
-                    all_json_data.append(data)
-                except json.JSONDecodeError as e:
-                    error_message = f"Error reading {json_file_key} for tile {tile_id}: {e}"
-                    logging.error(error_message)
-                except ClientError as e:
-                    logging.error(f"Failed to load {json_file_key} from S3: {e}")
-
-    except ClientError as e:
-        logging.error(f"Failed to list objects in bucket {bucket_name} with prefix {prefix}: {e}")
-        return None
-
-    if not all_json_data:
-        error_message = f"Lidar Json data does not exist for tile {tile_id} in year {year}"
-        logging.info(error_message)
-        return None
-
-    return all_json_data
-
-
-
-@profile
-def match_shade_data_from_s3(json_data, bucket_name, base_prefix, tile_id, year):
-    all_json_data = []
-    for data in json_data:
-        tile_ID = data['tile_id']
-        tree_id = data['Tree_CountId']
-        # Construct the S3 key for the CSV file
-        csv_key = f"{base_prefix}{tile_id}/{year}/Shading_Metrics_{tile_ID}/Shading_Metric_{tile_ID}_Tree_ID_{tree_id}.csv"
-        csv_content = read_s3_object(bucket_name, csv_key)
-        if csv_content is None:
-            # logging.info(f"Shading CSV file for tree {tree_id} in tile {tile_id} does not exist")
-            shade_data_at_max_amplitude = {
-                key: None for key in [
-                    "TreeShadow_PointCount",
-                    "RelNoon_ShadedArea",
-                    "RelNoon_ShadedArea_Ground",
-                    "RelNoon_Perc_Canopy_StreetShade",
-                    "RelNoon_Perc_Canopy_InShade"
-                ]
-            }
-            daily_average_shade_data = {
-                key: None for key in [
-                    "DailyAvg_ShadedArea",
-                    "DailyAvg_ShadedArea_Ground",
-                    "DailyAvg_Perc_Canopy_StreetShade",
-                    "DailyAvg_Perc_Canopy_InShade"
-                ]
-            }
-            weighted_average_shade_data = {
-                key: None for key in [
-                    "HighTempHours_Avg_ShadedArea",
-                    "HighTempHours_Avg_ShadedArea_Ground",
-                    "HighTempHours_Avg_Perc_Canopy_StreetShade",
-                    "HighTempHours_Avg_Perc_Canopy_InShade"
-                ]
-            }
-        else:
-            csv_string = io.BytesIO(csv_content)
-            df = pd.read_csv(csv_string)
-            df['DateTime_ISO'] = pd.to_datetime(df['DateTime_ISO'])
-            df = df[df['DateTime_ISO'].dt.strftime('%Y-%m-%d') == '2017-06-21']
-            max_amplitude_row = df[df['Sun_Amplitude']
-                                    == df['Sun_Amplitude'].max()]
-            shade_data_at_max_amplitude = {
-                "TreeShadow_PointCount": max_amplitude_row["TreeShadow_PointCount"].mean(),
-                "RelNoon_ShadedArea": max_amplitude_row["Shadow_Area"].mean(),
-                "RelNoon_ShadedArea_Ground": max_amplitude_row["ShadowArea_Ground"].mean(),
-                "RelNoon_Perc_Canopy_StreetShade": max_amplitude_row["Perc_Canopy_StreetShade"].mean(),
-                "RelNoon_Perc_Canopy_InShade": max_amplitude_row["Perc_Canopy_InShade"].mean()
-            }
-            daily_average_shade_data = {
-                "DailyAvg_ShadedArea": df["Shadow_Area"].mean(),
-                "DailyAvg_ShadedArea_Ground": df["ShadowArea_Ground"].mean(),
-                "DailyAvg_Perc_Canopy_StreetShade": df["Perc_Canopy_StreetShade"].mean(),
-                "DailyAvg_Perc_Canopy_InShade": df["Perc_Canopy_InShade"].mean()
-            }
-            df_time_filtered = df[df['DateTime_ISO'].dt.hour.between(11, 15)]
-            weighted_average_shade_data = {
-                "HighTempHours_Avg_ShadedArea": df_time_filtered["Shadow_Area"].mean(),
-                "HighTempHours_Avg_ShadedArea_Ground": df_time_filtered["ShadowArea_Ground"].mean(),
-                "HighTempHours_Avg_Perc_Canopy_StreetShade": df_time_filtered["Perc_Canopy_StreetShade"].mean(),
-                "HighTempHours_Avg_Perc_Canopy_InShade": df_time_filtered["Perc_Canopy_InShade"].mean()
-            }
-        data = {**data, **shade_data_at_max_amplitude, **daily_average_shade_data, **weighted_average_shade_data}
-        all_json_data.append(data)
-    return all_json_data
-
-
-def create_rtree_index(geojson_data):
-    idx = index.Index()
-    for pos, feature in enumerate(geojson_data['features']):
-        polygon = shape(feature['geometry'])
-        idx.insert(pos, polygon.bounds)
-    return idx
-
-@profile
-def match_json_with_geojson_boundary(json_data, geojson_path):
-    with open(geojson_path) as f:
-        geojson_data = json.load(f)
-    idx = create_rtree_index(geojson_data)
-    for point_dict in json_data:
-        point = Point(point_dict['PredictedTreeLocation']['Longitude'], point_dict['PredictedTreeLocation']['Latitude'])
-        for pos in idx.intersection(point.coords[0]):
-            feature = geojson_data['features'][pos]
-            polygon = shape(feature['geometry']) 
-            if polygon.contains(point):
-                point_dict['boro_code'] = feature['properties']['boro_code']
-                point_dict['boro_name'] = feature['properties']['boro_name']
-                break
-        else:
-            point_dict['boro_code'] = None
-            point_dict['boro_name'] = None                  
-    return json_data
-
 
-def get_tile_bounds(json_data, y_buffer_distance, x_buffer_distance):
-    x_coords = [d["PredictedTreeLocation"]["Longitude"] for d in json_data]
-    y_coords = [d["PredictedTreeLocation"]["Latitude"] for d in json_data]
-    if not x_coords or not y_coords:
-        return None
-    return box(min(x_coords) - x_buffer_distance, min(y_coords) - y_buffer_distance, 
-               max(x_coords) + x_buffer_distance, max(y_coords) + y_buffer_distance)
-
-@profile
-def load_all_geojson_files(folder):
-    points = []
-    features_properties = []
-    coords = []
-    for file in os.listdir(folder):
-        if file.endswith('.geojson'):
-            path = os.path.join(folder, file)
-            with open(path, 'r') as f:
-                data = json.load(f)
-            for feature in data['features']:
-                point = feature['geometry']['coordinates']
-                points.append(point)
-                features_properties.append(feature['properties'])
-                coords.append(point)
-    return {'points': np.array(points), 'features_properties': features_properties, 'coords': coords} 
-
-@profile
-def filter_geojson_data(geojson_data, tile_bounds):
-    filtered_features = []
-    for i, point in enumerate(geojson_data['coords']):
-        if tile_bounds.contains(Point(point)):
-            feature = {
-                'type': 'Feature',
-                'geometry': {'type': 'Point', 'coordinates': point},
-                'properties': geojson_data['features_properties'][i]
-            }
-            filtered_features.append(feature)
-    if not filtered_features: 
-        return None
-    return {'type': 'FeatureCollection', 'features': filtered_features}
-
-
-# calculate the average dbh
-def get_avg_dbh(filter_geojson_data):
-    if filter_geojson_data is None or "features" not in filter_geojson_data:
-        logging.info("filter_geojson_data is None or missing features")
-        return None
-    sum_dbh = 0
-    features = filter_geojson_data["features"]
-    for feature in features:
-        properties = feature["properties"]
-        if properties["tree_dbh"]:  
-            sum_dbh += properties["tree_dbh"]
-    return sum_dbh / len(features)
-
-
-def construct_nearest_neighbors(data):
-    features = data['features']
-    if not features:  
-        return None
-    points = np.array([feature['geometry']['coordinates'] for feature in features])
-    if points.ndim == 1:  
-        points = points.reshape(-1, 1)  # Reshape to 2D if it's 1D
-    return NearestNeighbors(n_neighbors=1, algorithm='ball_tree').fit(points)
-
-@profile
-def match_json_to_geojson(json_data, geojson_data, neighbors):
-    matched_data = []
-    for data in json_data:
-        point = np.array([[data["PredictedTreeLocation"]["Longitude"], data["PredictedTreeLocation"]["Latitude"]]])
-        distance, index = neighbors.kneighbors(point)
-        matched_properties = geojson_data['features'][index[0][0]]['properties'] # {}
-        matched_geojson_point = geojson_data['features'][index[0][0]]['geometry']['coordinates'] # []
-        matched_data.append({
-            'json_data': data,
-            'geojson_properties': matched_properties, # {}
-            'tree_id': matched_properties['tree_id'],  # str
-            'distance': distance[0][0],
-            'geojson_point': matched_geojson_point, # []
-            'isNearest': False
-        })
-    return matched_data # [{}]
-
-@profile
-def post_process_matched_data(matched_data):
-   # Find the nearest match for each tree_id
-    nearest_match_for_tree_id = {}
-    for data in matched_data:
-        tree_id = data['tree_id']
-        if tree_id not in nearest_match_for_tree_id or data['distance'] < nearest_match_for_tree_id[tree_id]['distance']:
-            nearest_match_for_tree_id[tree_id] = data
-
-    # Update the isNearest attribute for all points
-    for data in matched_data:
-        tree_id = data['tree_id']
-        if data['json_data']['Tree_CountId'] == nearest_match_for_tree_id[tree_id]['json_data']['Tree_CountId']:
-            data['isNearest'] = True  
-            data['hasTreeCensusID'] = True
-            data['UpdatedLocation'] = data['geojson_point']      
-        else:
-            data['isNearest'] = False   
-            data['hasTreeCensusID'] = False
-            coor_dict = data['json_data']["PredictedTreeLocation"] 
-            data['UpdatedLocation'] = [coor_dict['Longitude'], coor_dict['Latitude']]   
-            # delete all the census info: 'geojson_properties', 'tree_id', 'geojson_point'
-            data['tree_id'] = None
-            data['geojson_properties'] = None
-            data['geojson_point'] = None     
-    return matched_data
-
-def calculate_canopy_radius(tree_dbh):
-    tree_dbh_ft = tree_dbh / 12
-    tree_dbh_m = tree_dbh_ft / 3.28
-    trunk_area_sq_m = math.pi * ((tree_dbh_m / 2) ** 2)
-    canopy_diameter_m = 7 + 28.2 * trunk_area_sq_m
-    canopy_radius_m = canopy_diameter_m / 2
-    return canopy_radius_m
-
-@profile
-def construct_new_geojson_from_shade(json_data):
-    features = []
-    for data in json_data:
-        properties = {
-            # deteted tree data - json properties
-            'Tree_CountID': data['Tree_CountId'],
-            "Tile_id": data['tile_id'],
-            "Recorded Year": data["RecordedYear"],
-            "TopofCanopyHeight": data["TreeFoliageHeight"],
-            "CanopyVolume": data["ConvexHull_TreeDict"]["volume"],
-            "CanopyArea": data["ConvexHull_TreeDict"]["area"],
-            "InPark": data["InPark"],
-            "GroundHeight": data["GroundZValue"],
-            "FoliageHeight": data["TreeFoliageHeight"],
-            "BoroName": data["boro_name"],
-            # shdading data
-            "TreeShadow_PointCount": data["TreeShadow_PointCount"],
-            "RelNoon_ShadedArea": data["RelNoon_ShadedArea"],
-            "RelNoon_ShadedArea_Ground": data["RelNoon_ShadedArea_Ground"],
-            "RelNoon_Perc_Canopy_StreetShade": data["RelNoon_Perc_Canopy_StreetShade"],
-            "RelNoon_Perc_Canopy_InShade": data["RelNoon_Perc_Canopy_InShade"],
-            "DailyAvg_ShadedArea": data["DailyAvg_ShadedArea"],
-            "DailyAvg_ShadedArea_Ground": data["DailyAvg_ShadedArea_Ground"],
-            "DailyAvg_Perc_Canopy_StreetShade": data["DailyAvg_Perc_Canopy_StreetShade"],
-            "DailyAvg_Perc_Canopy_InShade": data["DailyAvg_Perc_Canopy_InShade"],
-            "HighTempHours_Avg_ShadedArea": data["HighTempHours_Avg_ShadedArea"],
-            "HighTempHours_Avg_ShadedArea_Ground": data["HighTempHours_Avg_ShadedArea_Ground"],
-            "HighTempHours_Avg_Perc_Canopy_StreetShade": data["HighTempHours_Avg_Perc_Canopy_StreetShade"],
-            "HighTempHours_Avg_Perc_Canopy_InShade": data["HighTempHours_Avg_Perc_Canopy_InShade"],
-            "Predicted Latitude": data['PredictedTreeLocation']['Latitude'],
-            "Predicted Longitude": data['PredictedTreeLocation']['Longitude'],
-        }
-        new_properties = {
-                key: None for key in [
-                    'Distance_to_census_location',
-                    "isNearest",
-                    "hasTreeCensusID",
-                    'Census_id',
-                    'Census Latitude',
-                    'Census Longitude',
-                    'Spc_latin',
-                    'Spc_common',
-                    'Tree_dbh',
-                    'Canopy_radius', # calculate the canopy radius in meters
-                    'Curb_loc',
-                    'Status',
-                    'Health',
-                    'Address',
-                    'Zipcode',
-                    'CensusBoroName'
-                ]
-            }
-        properties.update(new_properties)
-
-        point = Point(data['PredictedTreeLocation']['Longitude'],
-                      data['PredictedTreeLocation']['Latitude'])
-        
-        features.append(gpd.GeoDataFrame([properties], geometry=[point]))
-    if not features:
-        logging.error("No features to concatenate")
-    else:
-        combined_gdf = pd.concat(features, ignore_index=True)
-        return combined_gdf
-
-@profile
-def construct_new_geojson(matched_data, avg_canopy_radius):
-    features = []
-    for data in matched_data:
-        #summary census data
-        json_data = data['json_data']
-        properties = {
-            # deteted tree data - json properties
-            'Tree_CountID': json_data['Tree_CountId'],
-            "Tile_id": json_data['tile_id'],
-            "Recorded Year": json_data["RecordedYear"],
-            "TopofCanopyHeight": json_data["TreeFoliageHeight"],
-            "CanopyVolume": json_data["ConvexHull_TreeDict"]["volume"],
-            "CanopyArea": json_data["ConvexHull_TreeDict"]["area"],
-            "InPark": json_data["InPark"],
-            "GroundHeight": json_data["GroundZValue"],
-            "FoliageHeight": json_data["TreeFoliageHeight"],
-            "BoroName":json_data["boro_name"],
-            "TreeShadow_PointCount": json_data["TreeShadow_PointCount"],
-            "RelNoon_ShadedArea": json_data["RelNoon_ShadedArea"],
-            "RelNoon_ShadedArea_Ground": json_data["RelNoon_ShadedArea_Ground"],
-            "RelNoon_Perc_Canopy_StreetShade": json_data["RelNoon_Perc_Canopy_StreetShade"],
-            "RelNoon_Perc_Canopy_InShade": json_data["RelNoon_Perc_Canopy_InShade"],
-            "DailyAvg_ShadedArea": json_data["DailyAvg_ShadedArea"],
-            "DailyAvg_ShadedArea_Ground": json_data["DailyAvg_ShadedArea_Ground"],
-            "DailyAvg_Perc_Canopy_StreetShade": json_data["DailyAvg_Perc_Canopy_StreetShade"],
-            "DailyAvg_Perc_Canopy_InShade": json_data["DailyAvg_Perc_Canopy_InShade"], 
-            "HighTempHours_Avg_ShadedArea": json_data["HighTempHours_Avg_ShadedArea"],
-            "HighTempHours_Avg_ShadedArea_Ground": json_data["HighTempHours_Avg_ShadedArea_Ground"],
-            "HighTempHours_Avg_Perc_Canopy_StreetShade": json_data["HighTempHours_Avg_Perc_Canopy_StreetShade"],
-            "HighTempHours_Avg_Perc_Canopy_InShade": json_data["HighTempHours_Avg_Perc_Canopy_InShade"],
-            # matched data
-            "Predicted Latitude": data['UpdatedLocation'][1],
-            "Predicted Longitude": data['UpdatedLocation'][0],
-            'Distance_to_census_location': data['distance'],
-            "isNearest": data['isNearest'],
-            "hasTreeCensusID": data['hasTreeCensusID']
-        }
-        geojson_props = data.get('geojson_properties', None)
-        # Matched census tree data - geojson
-        if geojson_props == None:
-            keys = [
-                'Census_id',
-                'Census Latitude',
-                'Census Longitude',
-                'Spc_latin',
-                'Spc_common',
-                'Tree_dbh',
-                'Curb_loc',
-                'Status',
-                'Health',
-                'Address',
-                'Zipcode',
-                'CensusBoroName'
-            ]
-    
-            new_properties = {key: None for key in keys}
-            # Assign avg_canopy_radius to the Canopy_radius key
-            new_properties['Canopy_radius'] = avg_canopy_radius
-
-        else: 
-            new_properties = {
-                # Matched census tree data - geojson
-                'Census_id': geojson_props['tree_id'],
-                'Census Latitude': geojson_props['Latitude'],
-                'Census Longitude': geojson_props['longitude'],
-                'Spc_latin': geojson_props['spc_latin'],
-                'Spc_common': geojson_props['spc_common'],
-                'Tree_dbh': geojson_props['tree_dbh'],
-                'Canopy_radius': calculate_canopy_radius(geojson_props['tree_dbh']), # calculate the canopy radius in meters
-                'Curb_loc': geojson_props['curb_loc'],
-                'Status': geojson_props['status'],
-                'Health': geojson_props['health'],
-                'Address': geojson_props['address'],
-                'Zipcode': geojson_props['zipcode'],
-                'CensusBoroName': geojson_props['boroname'] 
-            }
-        properties.update(new_properties)
-
-        point = Point(data['UpdatedLocation'][0],
-                      data['UpdatedLocation'][1])
-        
-        features.append(gpd.GeoDataFrame([properties], geometry=[point]))
-    if not features:
-        logging.error("No features to concatenate")
-    else:
-        combined_gdf = pd.concat(features, ignore_index=True)
-        return combined_gdf
-
-@profile
-def save_new_geojson(new_geojson, output_folder, tile_id):
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    output_path = os.path.join(output_folder, f'NewMatchedShadingTrees_{tile_id}.geojson')
-    new_geojson.to_file(output_path, driver='GeoJSON')
-
-
-# Main execution    
-def process_tile(bucket_name, base_prefix, tile_id, year, all_geojson, boundary_path, x_buffer_distance, y_buffer_distance,output_dir):
-    try: 
-        logging.info(f"Start processing tile_id {tile_id}")
-        tqdm.write(f"Start processing tile_id {tile_id}")
-        json_data = load_json_files_from_s3(bucket_name, base_prefix, tile_id, year)
-        if json_data is None:
-            return None
-        json_data = match_shade_data_from_s3(json_data, bucket_name, base_prefix, tile_id, year)
-        json_data = match_json_with_geojson_boundary(json_data, boundary_path)
-        tile_bounds = get_tile_bounds(json_data, x_buffer_distance, y_buffer_distance)
-        filtered_geojson_data = filter_geojson_data(all_geojson, tile_bounds) 
-        avg_dbh = get_avg_dbh(filtered_geojson_data)
-        avg_canopy_radius = calculate_canopy_radius(avg_dbh)
-        if filtered_geojson_data == None: # there is no street tree in the given tile
-            new_geojson = construct_new_geojson_from_shade(json_data)
-        else:
-            neighbors = construct_nearest_neighbors(filtered_geojson_data)
-            matched_data = match_json_to_geojson(json_data, filtered_geojson_data, neighbors)
-            matched_data = post_process_matched_data(matched_data)
-            new_geojson = construct_new_geojson(matched_data, avg_canopy_radius)
-        save_new_geojson(new_geojson, output_dir, tile_id)
-        tqdm.write(f"New GeoJSON for tile_id {tile_id} saved")
-        logging.info(f"New GeoJSON for tile_id {tile_id} saved")
-        # After processing the tile, manually invoke GC to clean up
-        gc.collect()
-    except Exception as e:
-        logging.error(f"Error processing tile_id: {tile_id}. Error: {e}", exc_info=True)
-        # Clean up memory after an error to prevent memory leaks
-        gc.collect()
-
-def is_tile_processed(tile_key, output_dir):
-    # Check if a file corresponding to the tile_key exists in output_dir
-    output_file_path = os.path.join(output_dir, f'NewMatchedShadingTrees_{tile_key}.geojson')
-    return os.path.exists(output_file_path)
-
-def main():
+def shard_tiles(tile_keys, shard):
+    # 'i/n' keeps the tiles whose id hashes to i out of n; stable across nodes and reruns
+    index_str, count_str = shard.split('/')
+    shard_index, shard_count = int(index_str), int(count_str)
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Shard {shard} is out of range, expected i/n with 0 <= i < n")
+    return [tile_key for tile_key in tile_keys if zlib.crc32(tile_key.encode('utf-8')) % shard_count == shard_index]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Match LiDAR trees to the street tree census, tile by tile.')
+    parser.add_argument('--worker', action='store_true',
+                        help='lease tiles from the shared --queue until it drains, run the same command on every node')
+    parser.add_argument('--queue', default='/data/Datasets/MatchingResult_All/tile_queue.sqlite',
+                        help='SQLite work queue on storage shared by all nodes')
+    parser.add_argument('--worker-id', default=None, help='defaults to hostname-pid')
+    parser.add_argument('--reset-queue', action='store_true',
+                        help='clear --queue before working, to drop an interrupted run instead of resuming it; '
+                             'pass it to one node only, before the others start')
+    parser.add_argument('--lease-seconds', type=float, default=LEASE_SECONDS,
+                        help='a tile whose heartbeat stops for this long is leased to another node')
+    parser.add_argument('--shard', default=None, metavar='I/N',
+                        help='without a queue: process only the I-th of N fixed hash partitions of the tiles')
+    parser.add_argument('--sample-dir', default=None,
+                        help='read the tiles from this local folder (e.g. TFb or BK17) instead of the bucket')
+    parser.add_argument('--no-shutdown', action='store_true', help='keep the instance running after the run')
+    args = parser.parse_args(argv)
+    if args.worker and args.shard:
+        parser.error('--shard splits tiles statically, it cannot be combined with --worker')
+    if args.reset_queue and not args.worker:
+        parser.error('--reset-queue only applies to --worker runs')
+    return args
+
+
+def main(args=None):
+    args = args or parse_args([])
     # change the bucket here
     bucket_name = 'treefolio-sylvania-data'
     year = '2017'
@@ -531,27 +72,128 @@ def main():
     y_buffer_distance = 0.00010484
     x_buffer_distance = 0.00009009
 
+    # per-stage timings are only recorded when TREEFOLIO_STAGE_METRICS is set, e.g.
+    # TREEFOLIO_STAGE_METRICS=/data/Datasets/MatchingResult_All/stage_metrics.jsonl
+
+    # per-tile budgets, a tile exceeding them is retried with smaller batches and fewer fetchers
+    batch_size = 100
+    max_fetch_workers = 8
+    tile_memory_limit_mb = 16000
+    tile_timeout = 2 * 60 * 60
+    max_retries = 2
+    failure_log_path = os.path.join(output_dir, 'failed_tiles.jsonl')
+    # past tile timings, also used to estimate tile costs for longest-first scheduling
+    tile_metrics_path = os.path.join(output_dir, 'tile_performance.jsonl')
+
+    # 'nearest' keeps the closest LiDAR tree per census tree, 'optimal' solves a one-to-one assignment;
+    # census trees further than max_match_distance (in distance_unit, 'ft' or 'm') are never matched
+    match_mode = 'nearest'
+    max_match_distance = None
+    distance_unit = 'ft'
+
     # whole dataset
     base_prefix = 'ProcessedLasData/Sept17th-2023/'
-    # tile_keys = list_s3_dirs(bucket_name, base_prefix) 
-
-    # oom troubleshooting
-    tile_keys = ['935160', '935162', '12147', '20162','24611']
+    storage = open_storage(bucket_name, base_prefix, sample_dir=args.sample_dir)
+    tile_keys = storage.list_tiles()
+
+    # census tree_id -> best match across tiles, to settle census trees claimed on both sides of a seam
+    claims_dir = os.path.join(output_dir, 'census_claims')
+    census_claims = init_census_claims()
+
+    # count/sum/mean/quantile cubes by borough, zipcode, species and tile, folded in as tiles complete
+    cube_conn = connect_cubes(os.path.join(output_dir, CUBES_NAME))
+
+    def update_cubes(tile_key):
+        # derived data only, a tile left out is picked up by the next run or by aggregate_cubes.py
+        try:
+            update_tile_cubes(cube_conn, output_dir, tile_key)
+        except Exception:
+            logging.warning(f"Tile {tile_key}: aggregate cubes not updated", exc_info=True)
+
+    # only tiles whose input fingerprint changed (S3 ETags, census shard, boundary, code/config) are rerun
+    code_hash = pipeline_code_version(year, x_buffer_distance, y_buffer_distance, match_mode,
+                                      distance_in_feet(max_match_distance, distance_unit))
+
+    def run_tile(tile_key):
+        return process_tile_supervised(
+            process_tile, tile_key,
+            (storage, tile_key, year, all_geojson, boundary_path, x_buffer_distance, y_buffer_distance, output_dir),
+            {'match_mode': match_mode, 'max_match_distance': max_match_distance, 'distance_unit': distance_unit}, batch_size, max_fetch_workers, tile_memory_limit_mb, tile_timeout, max_retries, failure_log_path)
+
+    if args.worker:
+        # every node runs this same command against one queue; output_dir must be shared too,
+        # the node that finds the queue drained first registers every tile's claims
+        worker_id = args.worker_id or default_worker_id()
+        conn = connect_queue(args.queue)
+        if args.reset_queue:
+            reset_queue(conn)
+        # a queue finalized by the previous run is cleared here, so every run seeds its own stale tiles
+        if claim_seeding(conn, worker_id):
+            stale_tiles = plan_stale_tiles(tile_keys, output_dir, is_tile_processed, storage, year,
+                                           all_geojson, boundary_path, code_hash)
+            costs = estimate_tile_costs(list(stale_tiles), storage, year, tile_metrics_path)
+            seed_queue(conn, [tile_key for tile_key in tile_keys if tile_key in stale_tiles],
+                       [tile_key for tile_key in tile_keys if tile_key not in stale_tiles], costs)
+            logging.info(f"Worker {worker_id} queued {len(stale_tiles)} of {len(tile_keys)} tiles, estimated makespan " +
+                         ', '.join(f"{nodes} nodes {format_duration(lpt_makespan(costs.values(), nodes))}"
+                                   for nodes in (1, 2, 4, 8)))
+        else:
+            wait_until_seeded(conn)
+        def run_and_aggregate(tile_key):
+            result = run_tile(tile_key)
+            update_cubes(tile_key)
+            return result
+
+        processed_count = run_queue_worker(args.queue, worker_id, run_and_aggregate, lease_seconds=args.lease_seconds)
+        logging.info(f"Worker {worker_id} processed {processed_count} tiles")
+        if claim_finalizing(conn, worker_id):
+            for tile_key in all_tile_ids(conn):
+                register_census_claims(census_claims, claims_dir, tile_key)
+                update_cubes(tile_key)
+            write_seam_corrections(census_claims, os.path.join(output_dir, 'seam_corrections.csv'))
+            finish_finalizing(conn)
+        conn.close()
+        logging.info("SCRIPT_END: Processing complete.")
+        return
+
+    if args.shard:
+        tile_keys = shard_tiles(tile_keys, args.shard)
+        logging.info(f"Shard {args.shard}: {len(tile_keys)} tiles")
+
+    stale_tiles = plan_stale_tiles(tile_keys, output_dir, is_tile_processed, storage, year,
+                                   all_geojson, boundary_path, code_hash)
+    logging.info(f"{len(stale_tiles)} of {len(tile_keys)} tiles need processing")
+    costs = estimate_tile_costs(list(stale_tiles), storage, year, tile_metrics_path)
+    logging.info(f"Estimated processing time {format_duration(sum(costs.values()))}")
 
     try:
         processed_count = 0
+        done_cost, remaining_cost = 0.0, sum(costs.values())
+        run_start = time.time()
         with tqdm(total=len(tile_keys), desc="Processing Progress") as progress_bar:
             for tile_key in tile_keys:
-                # if tile_key in ['935160', '935162', '12147', '20162','24611']:
-                #     progress_bar.update(1)
-                #     continue # skip this tile, troubleshooting later
-                if is_tile_processed(tile_key, output_dir):
+                if tile_key not in stale_tiles:
+                    register_census_claims(census_claims, claims_dir, tile_key)
+                    update_cubes(tile_key)
                     progress_bar.update(1)
-                    continue
-                process_tile(bucket_name, base_prefix, tile_key, year, all_geojson, boundary_path, x_buffer_distance, y_buffer_distance, output_dir)
+            # most expensive first, so the ETA settles early and shards end close together
+            for tile_key in lpt_order(list(stale_tiles), costs):
+                logging.info(f"Tile {tile_key} is stale: {', '.join(stale_tiles[tile_key])}")
+                run_tile(tile_key)
+                register_census_claims(census_claims, claims_dir, tile_key)
+                update_cubes(tile_key)
                 progress_bar.update(1)
                 processed_count += 1
-                tqdm.write(f"Processed tiles count: {processed_count}")
+                done_cost += costs[tile_key]
+                remaining_cost -= costs[tile_key]
+                eta = format_duration(estimate_remaining(done_cost, remaining_cost, time.time() - run_start))
+                tqdm.write(f"Processed tiles count: {processed_count}, estimated time to completion {eta}")
+        if args.shard:
+            # claims of the other shards are not settled yet; a final unsharded run only
+            # registers the (then fresh) tiles and writes the corrections
+            logging.info("Sharded run, seam corrections are left to an unsharded run")
+        else:
+            write_seam_corrections(census_claims, os.path.join(output_dir, 'seam_corrections.csv'))
     except Exception as e:
         progress_bar.close()  # Ensure the progress bar is closed in case of an exception
         logging.error("Error occurred during the main processing", exc_info=True)
@@ -562,5 +204,7 @@ def shutdown_instance():
     os.system('sudo shutdown now')
 
 if __name__ == "__main__":
-    main()
-    shutdown_instance()
\ No newline at end of file
+    args = parse_args()
+    main(args)
+    if not args.no_shutdown:
+        shutdown_instance()
\ No newline at end of file
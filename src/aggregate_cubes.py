@@ -0,0 +1,246 @@
+import os
+import json
+import math
+import zlib
+import sqlite3
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+from shade_windows import SHADE_WINDOWS, window_output_keys
+from tree_query import OUTPUT_PREFIX, load_tile_properties
+
+# Precomputed aggregates of the canopy and shade metrics by borough, zipcode, species, tile and
+# species x zipcode, in one SQLite file next to the outputs. Dashboards read the small `cubes`
+# table (or its cube_{dimension} views): count, sum, mean and p50/p90/p99 per group and metric.
+#
+# Every statistic is additive, so the cubes are updated tile by tile: each tile's contribution is
+# kept (compressed) in tile_partials, and re-aggregating a tile subtracts its old contribution
+# and adds the new one, then recomputes only the groups it touched. Quantiles come from a
+# log-bucketed sketch with ACCURACY relative error (DDSketch style), the bucket counts merge by
+# addition as well. The metrics are non-negative; values <= 0 land in the zero bucket.
+#
+# IndexMatch_HL_aws1 folds in each tile as it completes; this script catches up a whole folder:
+#   python src/aggregate_cubes.py /data/Datasets/MatchingResult_All
+#   sqlite3 /data/Datasets/MatchingResult_All/aggregate_cubes.sqlite \
+#       "SELECT * FROM cube_species_zipcode WHERE metric = 'CanopyVolume' AND zipcode = '11203'"
+
+DIMENSIONS = {
+    'borough': ['BoroName'],
+    'zipcode': ['Zipcode'],
+    'species': ['Spc_common'],
+    'tile': ['Tile_id'],
+    'species_zipcode': ['Spc_common', 'Zipcode'],
+}
+METRICS = ['CanopyVolume', 'CanopyArea', 'TopofCanopyHeight'] + window_output_keys(SHADE_WINDOWS)
+QUANTILES = [0.5, 0.9, 0.99]
+ACCURACY = 0.02
+GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+ZERO_BUCKET = -(2 ** 31)
+CUBES_NAME = 'aggregate_cubes.sqlite'
+GROUP = ['dimension', 'key', 'key2', 'metric']
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS tile_partials (
+    tile_id TEXT PRIMARY KEY,
+    source_size INTEGER,
+    source_mtime INTEGER,
+    partial BLOB                    -- zlib JSON rows of the tile's sketch contribution
+);
+CREATE TABLE IF NOT EXISTS sketches (
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,              -- '' when the tree has no value, e.g. no census match
+    key2 TEXT NOT NULL,             -- second key of two-column dimensions, otherwise ''
+    metric TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    total REAL NOT NULL,
+    PRIMARY KEY (dimension, key, key2, metric, bucket)
+);
+CREATE TABLE IF NOT EXISTS cubes (
+    dimension TEXT NOT NULL,
+    key TEXT NOT NULL,
+    key2 TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    mean REAL,
+    {', '.join(f'p{int(q * 100)} REAL' for q in QUANTILES)},
+    PRIMARY KEY (dimension, key, key2, metric)
+);
+"""
+
+
+def _view_sql(dimension, columns):
+    names = [column.lower() for column in columns]
+    keys = f"key AS {names[0]}" + (f", key2 AS {names[1]}" if len(names) > 1 else '')
+    quantiles = ', '.join(f'p{int(q * 100)}' for q in QUANTILES)
+    return (f"CREATE VIEW IF NOT EXISTS cube_{dimension} AS SELECT {keys}, metric, count, sum, mean, {quantiles} "
+            f"FROM cubes WHERE dimension = '{dimension}'")
+
+
+def connect_cubes(cube_path):
+    # rollback journal and short IMMEDIATE transactions, as the tile queue, so shards can share it
+    conn = sqlite3.connect(cube_path, timeout=60, isolation_level=None)
+    conn.executescript(SCHEMA)
+    for dimension, columns in DIMENSIONS.items():
+        conn.execute(_view_sql(dimension, columns))
+    return conn
+
+
+def sketch_buckets(values):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        buckets = np.ceil(np.log(values) / math.log(GAMMA))
+    return np.where(values > 0, buckets, ZERO_BUCKET).astype(np.int64)
+
+
+def bucket_value(bucket):
+    # midpoint of the bucket in the relative sense, within ACCURACY of every value in it
+    return 0.0 if bucket == ZERO_BUCKET else 2 * GAMMA ** bucket / (GAMMA + 1)
+
+
+def tile_partial(path):
+    # one row per (group, metric, bucket) with the count and sum of the tile's values in it
+    columns = load_tile_properties(path)['columns']
+    frame = pd.DataFrame({name: columns[name] for name in METRICS if name in columns})
+    if frame.empty:
+        return pd.DataFrame(columns=GROUP + ['bucket', 'n', 'total'])
+    for name in {column for columns_ in DIMENSIONS.values() for column in columns_}:
+        frame[name] = ['' if value is None else str(value) for value in columns.get(name, [None] * len(frame))]
+    key_columns = sorted({column for columns_ in DIMENSIONS.values() for column in columns_})
+    long = frame.melt(id_vars=key_columns, var_name='metric', value_name='value').dropna(subset=['value'])
+    long['value'] = long['value'].astype(float)
+    long['bucket'] = sketch_buckets(long['value'].to_numpy())
+    parts = []
+    for dimension, dimension_columns in DIMENSIONS.items():
+        part = long.groupby(dimension_columns + ['metric', 'bucket'], as_index=False).agg(
+            n=('value', 'size'), total=('value', 'sum'))
+        part = part.rename(columns={dimension_columns[0]: 'key'})
+        part['key2'] = part.pop(dimension_columns[1]) if len(dimension_columns) > 1 else ''
+        part.insert(0, 'dimension', dimension)
+        parts.append(part[GROUP + ['bucket', 'n', 'total']])
+    return pd.concat(parts, ignore_index=True)
+
+
+def _pack(partial):
+    return zlib.compress(json.dumps(partial.values.tolist()).encode('utf-8'))
+
+
+def _unpack(blob):
+    return pd.DataFrame(json.loads(zlib.decompress(blob)), columns=GROUP + ['bucket', 'n', 'total'])
+
+
+def summarize_sketches(sketches):
+    # cubes rows (count, sum, mean, quantiles) from the merged bucket rows of some groups
+    rows = []
+    for group, buckets in sketches.groupby(GROUP, sort=False):
+        buckets = buckets.sort_values('bucket')
+        count = int(buckets['n'].sum())
+        if count <= 0:
+            continue
+        total = float(buckets['total'].sum())
+        cumulative = buckets['n'].cumsum().to_numpy()
+        quantiles = [bucket_value(int(buckets['bucket'].iat[int(np.searchsorted(cumulative, q * (count - 1), side='right'))]))
+                     for q in QUANTILES]
+        rows.append(list(group) + [count, total, total / count] + quantiles)
+    return rows
+
+
+def apply_tile_partial(conn, tile_id, partial, source=(None, None)):
+    # replace the tile's contribution to the sketches with `partial`, then refresh the groups touched
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT partial FROM tile_partials WHERE tile_id = ?", (tile_id,)).fetchone()
+        old = _unpack(row[0]) if row and row[0] is not None else None
+        delta = partial
+        if old is not None and len(old):
+            old[['n', 'total']] = -old[['n', 'total']]
+            delta = pd.concat([old, partial], ignore_index=True).groupby(GROUP + ['bucket'], as_index=False)[['n', 'total']].sum()
+            delta = delta[(delta['n'] != 0) | (delta['total'] != 0)]
+        conn.executemany(
+            "INSERT INTO sketches (dimension, key, key2, metric, bucket, n, total) VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (dimension, key, key2, metric, bucket) DO UPDATE SET n = n + excluded.n, total = total + excluded.total",
+            [(d, k, k2, m, int(b), int(n), float(t)) for d, k, k2, m, b, n, t in delta.itertuples(index=False)])
+        touched = delta[GROUP].drop_duplicates()
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS touched (dimension TEXT, key TEXT, key2 TEXT, metric TEXT)")
+        conn.execute("DELETE FROM touched")
+        conn.executemany("INSERT INTO touched VALUES (?, ?, ?, ?)", touched.itertuples(index=False))
+        conn.execute("DELETE FROM sketches WHERE n <= 0 AND (dimension, key, key2, metric) IN (SELECT * FROM touched)")
+        sketches = pd.read_sql_query(
+            "SELECT s.dimension, s.key, s.key2, s.metric, s.bucket, s.n, s.total FROM sketches s JOIN touched t "
+            "ON s.dimension = t.dimension AND s.key = t.key AND s.key2 = t.key2 AND s.metric = t.metric", conn)
+        conn.execute("DELETE FROM cubes WHERE (dimension, key, key2, metric) IN (SELECT * FROM touched)")
+        conn.executemany(f"INSERT INTO cubes VALUES ({', '.join('?' * (len(GROUP) + 3 + len(QUANTILES)))})",
+                         summarize_sketches(sketches))
+        conn.execute("INSERT OR REPLACE INTO tile_partials (tile_id, source_size, source_mtime, partial) VALUES (?, ?, ?, ?)",
+                     (tile_id, source[0], source[1], _pack(partial)))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(touched)
+
+
+def _source(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def _is_current(conn, tile_id, source):
+    row = conn.execute("SELECT source_size, source_mtime FROM tile_partials WHERE tile_id = ?", (tile_id,)).fetchone()
+    return row is not None and tuple(row) == source
+
+
+def update_tile_cubes(conn, output_dir, tile_id):
+    # fold one tile's current output into the cubes; False when it is already in there
+    path = os.path.join(output_dir, f'{OUTPUT_PREFIX}{tile_id}.geojson')
+    source = _source(path)
+    if source is None or _is_current(conn, tile_id, source):
+        return False
+    apply_tile_partial(conn, tile_id, tile_partial(path), source)
+    return True
+
+
+def update_all_cubes(conn, output_dir, processes=None):
+    # every changed output in the folder; tiles whose output is gone are taken out again
+    with os.scandir(output_dir) as entries:
+        paths = {entry.name[len(OUTPUT_PREFIX):-len('.geojson')]: entry.path for entry in entries
+                 if entry.name.startswith(OUTPUT_PREFIX) and entry.name.endswith('.geojson')}
+    sources = {tile_id: _source(path) for tile_id, path in paths.items()}
+    changed = sorted(tile_id for tile_id in paths if not _is_current(conn, tile_id, sources[tile_id]))
+    removed = [tile_id for (tile_id,) in conn.execute("SELECT tile_id FROM tile_partials") if tile_id not in paths]
+    for tile_id in removed:
+        apply_tile_partial(conn, tile_id, pd.DataFrame(columns=GROUP + ['bucket', 'n', 'total']))
+        conn.execute("DELETE FROM tile_partials WHERE tile_id = ?", (tile_id,))
+    # partials are computed in parallel, applying them stays in this process (one writer)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        partials = executor.map(tile_partial, [paths[tile_id] for tile_id in changed], chunksize=4)
+        for tile_id, partial in tqdm(zip(changed, partials), total=len(changed), desc="Aggregating tiles"):
+            apply_tile_partial(conn, tile_id, partial, sources[tile_id])
+    return changed, removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate the matched-tree outputs by borough, zipcode, species and tile.')
+    parser.add_argument('output_dir', help='folder with the NewMatchedShadingTrees_{tile}.geojson outputs')
+    parser.add_argument('--cube-db', default=None, help=f'defaults to {CUBES_NAME} in output_dir')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    conn = connect_cubes(args.cube_db or os.path.join(args.output_dir, CUBES_NAME))
+    changed, removed = update_all_cubes(conn, args.output_dir, args.processes)
+    print(f"{len(changed)} tiles aggregated, {len(removed)} removed")
+    for dimension in DIMENSIONS:
+        groups, = conn.execute("SELECT COUNT(DISTINCT key || '|' || key2) FROM cubes WHERE dimension = ?", (dimension,)).fetchone()
+        print(f"{dimension}: {groups} groups")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import numpy as np
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from tree_batch import TreeBatch
+from tree_json import parse_tree_fields
+from tile_fingerprint import s3_listing_hash, plan_stale_tiles
+from seam_reconciliation import init_census_claims, write_seam_corrections
+from stage_metrics import append_jsonl, tile_metrics_scope, current_tile_id
+
+# Runs the stages of pipeline_engine.process_tile as a producer/consumer chain over many tiles:
+#
+#   list -> fetch_json -> fetch_csv -> shade -> borough -> match -> write
+#
+# Each stage has its own number of workers and hands its output to the next one through a bounded
+# asyncio queue, so a slow stage holds back the stages before it instead of piling tiles up in
+# memory. Storage requests (list, JSON and CSV gets) run as asyncio tasks on an I/O thread pool and are
+# capped by s3_requests in flight in total; the CPU stages (JSON field extraction, shade
+# summaries, borough labels, matching) run in a separate executor, threads by default or forked
+# processes with --cpu-processes. While one tile is being matched the next ones are downloading.
+# CSVs travel to the shade stage in chunks of batch_size, which bounds the memory a tile's CSVs
+# can take. Output files, census claims, fingerprints and the tile_performance.jsonl rows are the
+# same as process_tile writes. Each stage worker runs its item inside tile_metrics_scope, so with
+# TREEFOLIO_STAGE_METRICS set the instrumented pipeline_engine stages still name their tile.
+#
+#   python src/async_pipeline.py --dataset /tmp/treefolio_benchmark/trees_1000/dataset.json \
+#       --output-dir /tmp/async_out --concurrency fetch_csv=4 match=2
+
+DEFAULT_CONCURRENCY = {'list': 4, 'fetch_json': 2, 'fetch_csv': 2, 'shade': 4, 'borough': 2, 'match': 2, 'write': 2}
+
+_DONE = object()
+
+# set before the CPU executor starts, forked workers inherit the census instead of receiving it per call
+_worker_state = {}
+
+
+def _pipeline():
+    import pipeline_engine
+    return pipeline_engine
+
+
+# CPU stages, module level so a process pool can run them
+
+def parse_tree_batch(tile_id, documents):
+    rows = []
+    for key, raw in documents:
+        if raw is None:
+            continue
+        try:
+            rows.append(parse_tree_fields(raw))
+        except json.JSONDecodeError as e:
+            logging.error(f"Error reading {key} for tile {tile_id}: {e}")
+    return TreeBatch(tile_id, rows) if rows else None
+
+
+def summarize_shade_chunk(csv_contents, year):
+    pipeline = _pipeline()
+    summaries = [pipeline.summarize_shade_csv(csv_content, year) for csv_content in csv_contents]
+    return {key: np.array([np.nan if summary[key] is None else summary[key] for summary in summaries], dtype=float)
+            for key in pipeline.SHADE_KEYS}
+
+
+def label_boroughs(trees, boundary_path):
+    return _pipeline().match_json_with_geojson_boundary(trees, boundary_path)
+
+
+def match_and_fingerprint(trees, settings, s3_inputs):
+    pipeline = _pipeline()
+    all_geojson = _worker_state['all_geojson']
+    matched_tile = pipeline.match_tile(trees, all_geojson, settings['x_buffer_distance'], settings['y_buffer_distance'],
+                                       settings['match_mode'], settings['max_match_distance'])
+    fingerprint = pipeline.tile_fingerprint(settings['year'], all_geojson, settings['boundary_path'],
+                                            settings['x_buffer_distance'], settings['y_buffer_distance'],
+                                            settings['match_mode'], settings['max_match_distance'],
+                                            matched_tile['tile_bounds'], s3_inputs)
+    return matched_tile, fingerprint
+
+
+def run_for_tile(tile_id, func, *args):
+    # executor threads and processes start without the stage worker's context
+    with tile_metrics_scope(tile_id):
+        return func(*args)
+
+
+# asyncio side
+
+async def _in_io(ctx, func, *args):
+    return await ctx['loop'].run_in_executor(ctx['io_executor'], run_for_tile, current_tile_id(), func, *args)
+
+
+async def _in_cpu(ctx, func, *args):
+    return await ctx['loop'].run_in_executor(ctx['cpu_executor'], run_for_tile, current_tile_id(), func, *args)
+
+
+async def _s3_get(ctx, key):
+    async with ctx['s3_slots']:
+        return await _in_io(ctx, ctx['storage'].read, key)
+
+
+def _finish_tile(ctx, tile, status):
+    # the row is written by the stage worker once the time of the current stage is added
+    tile['record']['status'] = status
+    tile['record']['total_s'] = round(time.perf_counter() - tile['started'], 6)
+    ctx['results'][status] = ctx['results'].get(status, 0) + 1
+    tile['finished'] = True
+
+
+def _write_tile_record(ctx, tile):
+    record = tile['record']
+    record['stages'] = {name: round(seconds, 6) for name, seconds in record['stages'].items()}
+    record['timestamp'] = time.time()
+    append_jsonl(os.path.join(ctx['settings']['output_dir'], 'tile_performance.jsonl'), record)
+    tile['recorded'] = True
+
+
+async def list_stage(ctx, tile, emit):
+    settings = ctx['settings']
+    tile_id = tile['tile_id']
+    tile['started'] = time.perf_counter()
+    async with ctx['s3_slots']:
+        objects = await _in_io(ctx, ctx['storage'].tile_objects, tile_id, settings['year'])
+    # the same listing fingerprints the inputs and tells which CSVs exist, so missing ones cost no request
+    tile['s3_inputs'] = s3_listing_hash(objects, tile_id)
+    tile['json_keys'] = [obj['Key'] for obj in objects
+                         if f'/JSON_TreeData_{tile_id}/' in obj['Key'] and obj['Key'].endswith('.json')]
+    tile['csv_keys'] = {obj['Key'] for obj in objects if f'/Shading_Metrics_{tile_id}/' in obj['Key']}
+    await emit(tile)
+
+
+async def fetch_json_stage(ctx, tile, emit):
+    keys = tile.pop('json_keys')
+    documents = await asyncio.gather(*[_s3_get(ctx, key) for key in keys])
+    trees = await _in_cpu(ctx, parse_tree_batch, tile['tile_id'], list(zip(keys, documents)))
+    if trees is None:
+        logging.info(f"Lidar Json data does not exist for tile {tile['tile_id']} in year {ctx['settings']['year']}")
+        _finish_tile(ctx, tile, 'no_json')
+        return
+    tile['trees'] = trees
+    tile['record']['trees_loaded'] = len(trees)
+    await emit(tile)
+
+
+async def fetch_csv_stage(ctx, tile, emit):
+    settings = ctx['settings']
+    trees = tile['trees']
+    tile_id = tile['tile_id']
+    batch_size = settings['batch_size']
+    starts = list(range(0, len(trees), batch_size))
+    tile['pending_chunks'] = len(starts)
+    for start in starts:
+        keys = [ctx['storage'].shade_csv_key(tile_id, settings['year'], tree_id)
+                for tree_id in trees.tree_count_id[start:start + batch_size]]
+        contents = await asyncio.gather(*[_s3_get(ctx, key) if key in tile['csv_keys'] else _missing() for key in keys])
+        found = sum(content is not None for content in contents)
+        tile['record']['csvs_found'] = tile['record'].get('csvs_found', 0) + found
+        tile['record']['csvs_missing'] = tile['record'].get('csvs_missing', 0) + len(contents) - found
+        # waits here while the shade stage is behind
+        await emit({'tile': tile, 'start': start, 'contents': contents})
+
+
+async def _missing():
+    return None
+
+
+async def shade_stage(ctx, chunk, emit):
+    tile = chunk['tile']
+    try:
+        if not tile.get('finished'):
+            summaries = await _in_cpu(ctx, summarize_shade_chunk, chunk['contents'], ctx['settings']['year'])
+            for key, values in summaries.items():
+                tile['trees'].set_shade(key, chunk['start'], values)
+    finally:
+        tile['pending_chunks'] -= 1
+    if tile['pending_chunks'] == 0 and not tile.get('finished'):
+        await emit(tile)
+
+
+async def borough_stage(ctx, tile, emit):
+    tile['trees'] = await _in_cpu(ctx, label_boroughs, tile['trees'], ctx['settings']['boundary_path'])
+    tile['record']['tree_batch_bytes'] = tile['trees'].nbytes()
+    await emit(tile)
+
+
+async def match_stage(ctx, tile, emit):
+    matched_tile, fingerprint = await _in_cpu(ctx, match_and_fingerprint, tile.pop('trees'), ctx['settings'],
+                                              tile['s3_inputs'])
+    tile['matched_tile'] = matched_tile
+    tile['fingerprint'] = fingerprint
+    census = matched_tile['census']
+    tile['record']['census_candidates'] = len(census['census_rows']) if census else 0
+    tile['record']['matched'] = int(matched_tile['trees'].matched.sum())
+    await emit(tile)
+
+
+async def write_stage(ctx, tile, emit):
+    output_path = await _in_io(ctx, ctx['pipeline'].save_tile_outputs, ctx['settings']['output_dir'], tile['tile_id'],
+                               tile.pop('matched_tile'), tile['fingerprint'])
+    tile['record']['output_bytes'] = os.path.getsize(output_path)
+    logging.info(f"New GeoJSON for tile_id {tile['tile_id']} saved")
+    _finish_tile(ctx, tile, 'done')
+
+
+STAGES = [
+    ('list', list_stage),
+    ('fetch_json', fetch_json_stage),
+    ('fetch_csv', fetch_csv_stage),
+    ('shade', shade_stage),
+    ('borough', borough_stage),
+    ('match', match_stage),
+    ('write', write_stage),
+]
+
+
+async def _stage_worker(ctx, name, func, inbox, outbox):
+    blocked = 0.0
+
+    async def emit(value):
+        # waiting on a full downstream queue is backpressure from the next stage, not time spent
+        # in this one, and is left out of the stage seconds
+        nonlocal blocked
+        put_start = time.perf_counter()
+        await outbox.put(value)
+        blocked += time.perf_counter() - put_start
+
+    while True:
+        item = await inbox.get()
+        if item is _DONE:
+            # leave it for the other workers of this stage
+            await inbox.put(_DONE)
+            return
+        tile = item['tile'] if 'tile' in item else item
+        start_time = time.perf_counter()
+        blocked = 0.0
+        try:
+            # each worker is its own task, the scope covers this item only
+            with tile_metrics_scope(tile['tile_id']):
+                await func(ctx, item, emit if outbox is not None else None)
+        except Exception as e:
+            logging.error(f"Error processing tile_id: {tile['tile_id']} in stage {name}. Error: {e}", exc_info=True)
+            if not tile.get('finished'):
+                _finish_tile(ctx, tile, 'error')
+        stages = tile['record']['stages']
+        stages[name] = stages.get(name, 0.0) + time.perf_counter() - start_time - blocked
+        if tile.get('finished') and not tile.get('recorded'):
+            _write_tile_record(ctx, tile)
+
+
+async def _run_stage(ctx, name, func, inbox, outbox, workers):
+    await asyncio.gather(*[_stage_worker(ctx, name, func, inbox, outbox) for _ in range(workers)])
+    if outbox is not None:
+        await outbox.put(_DONE)
+
+
+async def _run(ctx, tile_keys, concurrency, queue_size):
+    queues = [asyncio.Queue(maxsize=queue_size) for _ in STAGES]
+    runners = []
+    for i, (name, func) in enumerate(STAGES):
+        outbox = queues[i + 1] if i + 1 < len(STAGES) else None
+        runners.append(asyncio.create_task(_run_stage(ctx, name, func, queues[i], outbox, concurrency[name])))
+    for tile_id in tile_keys:
+        await queues[0].put({'tile_id': tile_id, 'started': time.perf_counter(),
+                             'record': {'tile_id': tile_id, 'stages': {}, 'runner': 'async'}})
+    await queues[0].put(_DONE)
+    await asyncio.gather(*runners)
+
+
+def run_async_pipeline(pipeline, storage, tile_keys, year, all_geojson, boundary_path,
+                       x_buffer_distance, y_buffer_distance, output_dir, match_mode='nearest',
+                       max_match_distance=None, distance_unit='ft', concurrency=None, s3_requests=32,
+                       queue_size=4, batch_size=100, cpu_workers=None, cpu_processes=False):
+    stage_workers = dict(DEFAULT_CONCURRENCY)
+    stage_workers.update(concurrency or {})
+    unknown = set(stage_workers) - set(DEFAULT_CONCURRENCY)
+    if unknown:
+        raise ValueError(f"Unknown pipeline stages {sorted(unknown)}, expected {list(DEFAULT_CONCURRENCY)}")
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    settings = {
+        'year': year, 'boundary_path': boundary_path,
+        'x_buffer_distance': x_buffer_distance, 'y_buffer_distance': y_buffer_distance, 'output_dir': output_dir,
+        'match_mode': match_mode, 'max_match_distance': pipeline.distance_in_feet(max_match_distance, distance_unit),
+        'batch_size': batch_size
+    }
+    _worker_state['all_geojson'] = all_geojson
+    cpu_workers = cpu_workers or os.cpu_count()
+    if cpu_processes:
+        cpu_executor = ProcessPoolExecutor(max_workers=cpu_workers, mp_context=mp.get_context('fork'))
+    else:
+        cpu_executor = ThreadPoolExecutor(max_workers=cpu_workers)
+    io_executor = ThreadPoolExecutor(max_workers=s3_requests + stage_workers['write'])
+
+    async def main_task():
+        ctx = {
+            'pipeline': pipeline, 'storage': storage, 'settings': settings, 'results': {},
+            'loop': asyncio.get_running_loop(), 'io_executor': io_executor, 'cpu_executor': cpu_executor,
+            's3_slots': asyncio.Semaphore(s3_requests)
+        }
+        await _run(ctx, tile_keys, stage_workers, queue_size)
+        return ctx['results']
+
+    start_time = time.perf_counter()
+    try:
+        results = asyncio.run(main_task())
+    finally:
+        io_executor.shutdown()
+        cpu_executor.shutdown()
+    results['tiles'] = len(tile_keys)
+    results['elapsed_s'] = round(time.perf_counter() - start_time, 3)
+    return results
+
+
+def parse_concurrency(values):
+    concurrency = {}
+    for value in values or []:
+        stage, _, workers = value.partition('=')
+        concurrency[stage] = int(workers)
+    return concurrency
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Process tiles with overlapping S3 and CPU stages.')
+    parser.add_argument('--dataset', default=None, help='dataset.json written by synthetic_tiles.py, served from a local fake S3')
+    parser.add_argument('--local-s3', default=None, help='read the bucket from this folder instead of S3')
+    parser.add_argument('--sample-dir', default=None, help='read the tiles from this local folder (e.g. TFb or BK17)')
+    parser.add_argument('--bucket', default='treefolio-sylvania-data')
+    parser.add_argument('--base-prefix', default='ProcessedLasData/Sept17th-2023/')
+    parser.add_argument('--year', default='2017')
+    parser.add_argument('--census-dir', default='/data/Datasets/StreetTreeGeoJSONs')
+    parser.add_argument('--boundary', default='/data/Datasets/Boundaries/Borough_Boundaries.geojson')
+    parser.add_argument('--output-dir', default='/data/Datasets/MatchingResult_All')
+    parser.add_argument('--tiles', nargs='*', default=None, help='tile ids, defaults to every tile in the bucket')
+    parser.add_argument('--all', action='store_true', help='process every tile, not only the stale ones')
+    parser.add_argument('--concurrency', nargs='*', default=None, metavar='STAGE=N',
+                        help=f"workers per stage, stages: {', '.join(DEFAULT_CONCURRENCY)}")
+    parser.add_argument('--s3-requests', type=int, default=32, help='S3 requests in flight across all stages')
+    parser.add_argument('--queue-size', type=int, default=4, help='items buffered between two stages')
+    parser.add_argument('--batch-size', type=int, default=100, help='CSVs per chunk handed to the shade stage')
+    parser.add_argument('--cpu-workers', type=int, default=None)
+    parser.add_argument('--cpu-processes', action='store_true', help='run CPU stages in forked processes')
+    parser.add_argument('--match-mode', default='nearest', choices=['nearest', 'optimal'])
+    parser.add_argument('--max-match-distance', type=float, default=None)
+    parser.add_argument('--distance-unit', default='ft', choices=['ft', 'm'])
+    args = parser.parse_args()
+
+    if args.dataset:
+        with open(args.dataset) as f:
+            dataset = json.load(f)
+        args.local_s3 = args.local_s3 or dataset['root']
+        args.bucket, args.base_prefix, args.year = dataset['bucket_name'], dataset['base_prefix'], dataset['year']
+        args.census_dir, args.boundary = dataset['census_dir'], dataset['boundary_path']
+        args.tiles = args.tiles or dataset['tile_ids']
+    os.makedirs(args.output_dir, exist_ok=True)
+    os.environ.setdefault('TREEFOLIO_LOG_DIR', args.output_dir)
+    pipeline = _pipeline()
+    pipeline.configure_logging(os.environ['TREEFOLIO_LOG_DIR'])
+    storage = pipeline.open_storage(args.bucket, args.base_prefix, args.local_s3, args.sample_dir)
+
+    y_buffer_distance = 0.00010484
+    x_buffer_distance = 0.00009009
+    all_geojson = pipeline.load_all_geojson_files(args.census_dir)
+    tile_keys = args.tiles or storage.list_tiles()
+    if not args.all:
+        code_hash = pipeline.pipeline_code_version(args.year, x_buffer_distance, y_buffer_distance, args.match_mode,
+                                                   pipeline.distance_in_feet(args.max_match_distance, args.distance_unit))
+        stale_tiles = plan_stale_tiles(tile_keys, args.output_dir, pipeline.is_tile_processed, storage, args.year,
+                                       all_geojson, args.boundary, code_hash)
+        logging.info(f"{len(stale_tiles)} of {len(tile_keys)} tiles need processing")
+        run_keys = [tile_key for tile_key in tile_keys if tile_key in stale_tiles]
+    else:
+        run_keys = list(tile_keys)
+
+    results = run_async_pipeline(pipeline, storage, run_keys, args.year, all_geojson,
+                                 args.boundary, x_buffer_distance, y_buffer_distance, args.output_dir,
+                                 args.match_mode, args.max_match_distance, args.distance_unit,
+                                 parse_concurrency(args.concurrency), args.s3_requests, args.queue_size,
+                                 args.batch_size, args.cpu_workers, args.cpu_processes)
+
+    # seam reconciliation over every tile's claims, as in IndexMatch_HL_aws1.main
+    claims_dir = os.path.join(args.output_dir, 'census_claims')
+    census_claims = init_census_claims()
+    for tile_key in tile_keys:
+        pipeline.register_census_claims(census_claims, claims_dir, tile_key)
+    write_seam_corrections(census_claims, os.path.join(args.output_dir, 'seam_corrections.csv'))
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+# End-to-end benchmark of pipeline_engine.process_tile on synthetic tiles served from a
+# local fake S3, timing every stage at several tile sizes. A saved baseline turns it into a
+# regression check:
+#
+#   python src/benchmark_pipeline.py --save-baseline result/benchmark_baseline.json
+#   python src/benchmark_pipeline.py --baseline result/benchmark_baseline.json --tolerance 0.25
+
+DEFAULT_SIZES = [100, 1000, 10000]
+Y_BUFFER_DISTANCE = 0.00010484
+X_BUFFER_DISTANCE = 0.00009009
+
+
+def prepare_dataset(work_dir, trees_per_tile, seed=0):
+    # Generated tiles are cached per size, generating 10k trees takes longer than processing them
+    from synthetic_tiles import generate_dataset
+    dataset_dir = os.path.join(work_dir, f'trees_{trees_per_tile}')
+    manifest_path = os.path.join(dataset_dir, 'dataset.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            return json.load(f)
+    if os.path.exists(dataset_dir):
+        shutil.rmtree(dataset_dir)
+    dataset = generate_dataset(dataset_dir, n_tiles=1, trees_per_tile=trees_per_tile, seed=seed)
+    with open(manifest_path, 'w') as f:
+        json.dump(dataset, f, indent=4)
+    return dataset
+
+
+def benchmark_size(pipeline, dataset, output_dir):
+    storage = pipeline.open_storage(dataset['bucket_name'], dataset['base_prefix'], local_s3=dataset['root'])
+    timings = {}
+
+    start_time = time.perf_counter()
+    all_geojson = pipeline.load_all_geojson_files(dataset['census_dir'])
+    timings['load_all_geojson_files'] = time.perf_counter() - start_time
+
+    tile_id = dataset['tile_ids'][0]
+    tile_metrics_path = os.path.join(output_dir, 'tile_performance.jsonl')
+    if os.path.exists(tile_metrics_path):
+        os.remove(tile_metrics_path)
+    ok = pipeline.process_tile(storage, tile_id, dataset['year'], all_geojson, dataset['boundary_path'],
+                               X_BUFFER_DISTANCE, Y_BUFFER_DISTANCE, output_dir)
+    if not ok:
+        raise RuntimeError(f"process_tile failed for synthetic tile {tile_id}, see the log in {output_dir}")
+
+    with open(tile_metrics_path) as f:
+        tile_record = json.loads(f.readlines()[-1])
+    timings.update(tile_record['stages'])
+    timings['process_tile'] = tile_record['total_s']
+    return {
+        'timings': {stage: round(seconds, 4) for stage, seconds in timings.items()},
+        'peak_rss_mb': tile_record['peak_rss_mb'],
+        'matched': tile_record.get('matched', 0),
+        'output_bytes': tile_record.get('output_bytes', 0)
+    }
+
+
+def find_regressions(results, baseline, tolerance, min_seconds):
+    regressions = []
+    for size, result in results.items():
+        for stage, seconds in result['timings'].items():
+            reference = baseline.get(size, {}).get('timings', {}).get(stage)
+            if reference is None:
+                continue
+            if seconds > reference * (1 + tolerance) and seconds - reference > min_seconds:
+                regressions.append((size, stage, reference, seconds))
+    return regressions
+
+
+def print_results(results):
+    stages = []
+    for result in results.values():
+        for stage in result['timings']:
+            if stage not in stages:
+                stages.append(stage)
+    sizes = list(results)
+    print(f"{'stage':<36}" + ''.join(f"{size + ' trees':>16}" for size in sizes))
+    for stage in stages:
+        row = ''.join(f"{results[size]['timings'].get(stage, float('nan')):>16.3f}" for size in sizes)
+        print(f"{stage:<36}{row}")
+    print(f"{'peak_rss_mb':<36}" + ''.join(f"{results[size]['peak_rss_mb']:>16.1f}" for size in sizes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every stage of process_tile on synthetic tiles.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='LiDAR trees per tile')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'treefolio_benchmark'),
+                        help='where synthetic tiles are generated and cached')
+    parser.add_argument('--output', default=None, help='write the results as JSON')
+    parser.add_argument('--save-baseline', default=None, help='store the results as the new baseline')
+    parser.add_argument('--baseline', default=None, help='compare against a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown per stage')
+    parser.add_argument('--min-seconds', type=float, default=0.05, help='ignore slowdowns smaller than this')
+    args = parser.parse_args()
+
+    # keep the pipeline's log file inside the benchmark directory
+    output_dir = os.path.join(args.work_dir, 'output')
+    os.makedirs(output_dir, exist_ok=True)
+    import pipeline_engine as pipeline
+    pipeline.configure_logging(os.environ.get('TREEFOLIO_LOG_DIR', output_dir))
+
+    results = {}
+    for size in args.sizes:
+        dataset = prepare_dataset(args.work_dir, size)
+        print(f"Benchmarking {size} trees per tile ...")
+        results[str(size)] = benchmark_size(pipeline, dataset, output_dir)
+    print_results(results)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance, args.min_seconds)
+        for size, stage, reference, seconds in regressions:
+            print(f"REGRESSION {stage} at {size} trees: {reference:.3f}s -> {seconds:.3f}s")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
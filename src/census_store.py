@@ -0,0 +1,285 @@
+import os
+import json
+import math
+import logging
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The street tree census properties, held for the whole run as columns instead of one dict per
+# feature (~680k dicts of mostly repeated strings). Each property is stored by what its values are:
+#   int / float  - a numpy array
+#   category     - int32 codes into the distinct strings (species, health, status, zipcode, ...)
+#   text         - one packed UTF-8 buffer with offsets, for mostly-unique strings such as address
+#   object       - a plain list for anything mixed, so every value comes back exactly as loaded
+# Property dicts are only built on demand (row/rows), e.g. for the census shard hash, and
+# construct_new_geojson takes the columns of its matched rows only.
+#
+# load_census_files parses the borough files in parallel, one process per file. Each feature is
+# checked up front (a Point with finite coordinates, every required property present, coerced
+# properties such as tree_dbh convertible) and dropped with a per-file report otherwise, instead
+# of a KeyError deep inside construct_new_geojson.
+
+# values of a str column that is more unique than this are packed as text
+CATEGORY_MAX_FRACTION = 0.5
+# row states of the int, float and text columns; categories use codes -1 and -2 for them
+VALUE, NULL, ABSENT = 0, 1, 2
+_ABSENT = object()
+# properties coerced on load, a value that cannot be converted drops the feature
+COERCE_PROPERTIES = {'tree_dbh': int}
+# invalid features listed per file in the report, the rest are only counted
+REPORT_EXAMPLES = 5
+
+
+def _states(values):
+    states = np.array([NULL if value is None else ABSENT if value is _ABSENT else VALUE for value in values],
+                      dtype=np.int8)
+    return states if states.any() else None
+
+
+def encode_column(values):
+    # one property over all features, _ABSENT where a feature does not have it
+    types = {type(value) for value in values if value is not None and value is not _ABSENT}
+    if types == {int}:
+        states = _states(values)
+        data = np.array([value if type(value) is int else 0 for value in values], dtype=np.int64)
+        return {'kind': 'int', 'data': data, 'states': states}
+    if types == {float}:
+        states = _states(values)
+        data = np.array([value if type(value) is float else np.nan for value in values], dtype=float)
+        return {'kind': 'float', 'data': data, 'states': states}
+    if types == {str}:
+        strings = [value if type(value) is str else None for value in values]
+        codes, categories = pd.factorize(pd.Series(strings, dtype=object))
+        if len(categories) <= CATEGORY_MAX_FRACTION * len(values):
+            codes = codes.astype(np.int32)
+            codes[[value is _ABSENT for value in values]] = -2
+            return {'kind': 'category', 'codes': codes, 'categories': np.array(list(categories), dtype=object)}
+        encoded = [(value or '').encode('utf-8') for value in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        return {'kind': 'text', 'buffer': b''.join(encoded), 'offsets': offsets, 'states': _states(values)}
+    return {'kind': 'object', 'values': values}
+
+
+def _decode_one(column, i):
+    kind = column['kind']
+    if kind == 'category':
+        code = column['codes'][i]
+        return column['categories'][code] if code >= 0 else None if code == -1 else _ABSENT
+    if kind == 'object':
+        return column['values'][i]
+    states = column['states']
+    if states is not None and states[i] != VALUE:
+        return None if states[i] == NULL else _ABSENT
+    if kind == 'text':
+        return column['buffer'][column['offsets'][i]:column['offsets'][i + 1]].decode('utf-8')
+    return column['data'][i].item()
+
+
+def concat_columns(columns, sizes):
+    # one property of several files; same-kind columns are joined as arrays, anything else is
+    # decoded and encoded again over all rows
+    kinds = {column['kind'] for column in columns}
+    if len(kinds) == 1 and kinds <= {'int', 'float'}:
+        states = None
+        if any(column['states'] is not None for column in columns):
+            states = np.concatenate([np.zeros(size, dtype=np.int8) if column['states'] is None else column['states']
+                                     for column, size in zip(columns, sizes)])
+        return {'kind': columns[0]['kind'], 'data': np.concatenate([column['data'] for column in columns]), 'states': states}
+    if kinds == {'category'}:
+        categories = list(dict.fromkeys(value for column in columns for value in column['categories']))
+        lookup = {value: code for code, value in enumerate(categories)}
+        codes = []
+        for column in columns:
+            remap = np.array([lookup[value] for value in column['categories']] + [0], dtype=np.int32)
+            codes.append(np.where(column['codes'] >= 0, remap[np.maximum(column['codes'], 0)], column['codes']))
+        return {'kind': 'category', 'codes': np.concatenate(codes).astype(np.int32),
+                'categories': np.array(categories, dtype=object)}
+    if kinds == {'text'}:
+        starts = np.cumsum([0] + [len(column['buffer']) for column in columns[:-1]])
+        offsets = np.concatenate([columns[0]['offsets'][:1]] + [column['offsets'][1:] + start
+                                                                for column, start in zip(columns, starts)])
+        states = None
+        if any(column['states'] is not None for column in columns):
+            states = np.concatenate([np.zeros(size, dtype=np.int8) if column['states'] is None else column['states']
+                                     for column, size in zip(columns, sizes)])
+        return {'kind': 'text', 'buffer': b''.join(column['buffer'] for column in columns), 'offsets': offsets,
+                'states': states}
+    return encode_column([_decode_one(column, i) for column, size in zip(columns, sizes) for i in range(size)])
+
+
+def _decode_many(column, rows):
+    kind = column['kind']
+    if kind == 'category':
+        codes = column['codes'][rows]
+        values = column['categories'][np.maximum(codes, 0)] if len(column['categories']) else np.full(len(rows), None)
+        return [value if code >= 0 else None for value, code in zip(values.tolist(), codes.tolist())]
+    if kind == 'object':
+        return [column['values'][i] for i in rows]
+    if kind == 'text':
+        values = [_decode_one(column, i) for i in rows]
+    else:
+        values = column['data'][rows].tolist()
+        states = column['states']
+        if states is not None:
+            values = [value if state == VALUE else None for value, state in zip(values, states[rows].tolist())]
+    return [None if value is _ABSENT else value for value in values]
+
+
+class CensusProperties:
+    __slots__ = ['keys', 'columns', 'n']
+
+    def __init__(self, keys, columns, n):
+        self.keys = keys
+        self.columns = columns
+        self.n = n
+
+    @classmethod
+    def from_properties(cls, properties):
+        # properties: one dict per feature, in census order
+        keys = list(dict.fromkeys(key for props in properties for key in props))
+        columns = {key: encode_column([props.get(key, _ABSENT) for props in properties]) for key in keys}
+        return cls(keys, columns, len(properties))
+
+    @classmethod
+    def concat(cls, parts):
+        # the census of several files, in order; a property a file lacks is absent there
+        keys = list(dict.fromkeys(key for part in parts for key in part.keys))
+        sizes = [part.n for part in parts]
+        columns = {}
+        for key in keys:
+            columns[key] = concat_columns([part.columns.get(key) or encode_column([_ABSENT] * part.n) for part in parts],
+                                          sizes)
+        return cls(keys, columns, sum(sizes))
+
+    def __len__(self):
+        return self.n
+
+    def column(self, key, rows=None):
+        # values of one property, None where a feature has no value (or no such property)
+        rows = np.arange(self.n) if rows is None else np.asarray(rows, dtype=np.int64)
+        if key not in self.columns:
+            return [None] * len(rows)
+        return _decode_many(self.columns[key], rows)
+
+    def row(self, i):
+        # the feature's properties dict as loaded
+        row = {}
+        for key in self.keys:
+            value = _decode_one(self.columns[key], i)
+            if value is not _ABSENT:
+                row[key] = value
+        return row
+
+    def rows(self, rows):
+        return [self.row(i) for i in rows]
+
+
+def _coerce(value, to_type):
+    # None stays None; numbers and numeric strings are converted, anything else raises ValueError
+    if value is None or type(value) is to_type:
+        return value
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if to_type is int:
+        number = float(value)
+        if not math.isfinite(number):
+            raise ValueError(value)
+        return int(round(number))
+    return to_type(value)
+
+
+def feature_error(feature, required):
+    # reason the feature cannot be used, None for a valid one
+    geometry = feature.get('geometry') or {}
+    if geometry.get('type') != 'Point':
+        return f"geometry is {geometry.get('type')}, not a Point"
+    coordinates = geometry.get('coordinates')
+    if (not isinstance(coordinates, list) or len(coordinates) < 2
+            or not all(isinstance(c, (int, float)) and math.isfinite(c) for c in coordinates[:2])):
+        return "Point without two finite coordinates"
+    properties = feature.get('properties')
+    if not isinstance(properties, dict):
+        return "no properties"
+    missing = [key for key in required if key not in properties]
+    if missing:
+        return f"missing properties {', '.join(missing)}"
+    return None
+
+
+def load_census_file(path, required=(), coerce=COERCE_PROPERTIES):
+    # points, encoded properties and a report of one census GeoJSON
+    report = {'file': os.path.basename(path), 'features': 0, 'loaded': 0, 'errors': {}, 'examples': [],
+              'coerced': {key: 0 for key in coerce}}
+
+    def reject(i, reason):
+        report['errors'][reason] = report['errors'].get(reason, 0) + 1
+        if len(report['examples']) < REPORT_EXAMPLES:
+            report['examples'].append((i, reason))
+
+    with open(path, 'rb') as f:
+        content = f.read()
+    try:
+        features = (orjson.loads(content) if orjson is not None else json.loads(content))['features']
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"{path} is not a GeoJSON FeatureCollection: {e}") from e
+    report['features'] = len(features)
+    points = []
+    properties = []
+    for i, feature in enumerate(features):
+        reason = feature_error(feature, required) if isinstance(feature, dict) else "not a Feature"
+        if reason is None:
+            props = feature['properties']
+            try:
+                for key, to_type in coerce.items():
+                    if key in props:
+                        value = _coerce(props[key], to_type)
+                        if value is not props[key]:
+                            props[key] = value
+                            report['coerced'][key] += 1
+            except (ValueError, TypeError):
+                reason = f"{key} is not {to_type.__name__}"
+        if reason is not None:
+            reject(i, reason)
+            continue
+        points.append(feature['geometry']['coordinates'][:2])
+        properties.append(props)
+    report['loaded'] = len(points)
+    return {'points': np.array(points, dtype=float).reshape(-1, 2), 'properties': CensusProperties.from_properties(properties),
+            'report': report}
+
+
+def log_census_report(report):
+    logging.info(f"Census {report['file']}: {report['loaded']} of {report['features']} features loaded")
+    for key, count in report['coerced'].items():
+        if count:
+            logging.info(f"Census {report['file']}: {count} {key} values converted")
+    if report['errors']:
+        reasons = '; '.join(f"{count} {reason}" for reason, count in report['errors'].items())
+        examples = ', '.join(f"#{i} ({reason})" for i, reason in report['examples'])
+        logging.warning(f"Census {report['file']}: dropped {sum(report['errors'].values())} features: {reasons}; "
+                        f"first ones {examples}")
+
+
+def load_census_files(paths, required=(), processes=None):
+    # files in the given order, each parsed and validated in its own process
+    load = partial(load_census_file, required=list(required))
+    if processes == 1 or len(paths) < 2:
+        files = [load(path) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=min(len(paths), processes or os.cpu_count() or 1)) as executor:
+            files = list(executor.map(load, paths))
+    for census_file in files:
+        log_census_report(census_file['report'])
+    return {
+        'points': np.concatenate([census_file['points'] for census_file in files]) if files else np.empty((0, 2)),
+        'properties': CensusProperties.concat([census_file['properties'] for census_file in files]),
+        'reports': [census_file['report'] for census_file in files],
+    }
@@ -0,0 +1,248 @@
+import os
+import csv
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Which tiles made it through which stage. Builds one manifest (a set of tile ids) per source
+#   index   - LAS_ID of every tile in the LAS index GeoJSON
+#   folders - tile folders in the bucket (or a local copy such as TFb), with whether their
+#             JSON_TreeData folder holds any JSON
+#   stages  - output folders of the matching stages, e.g. MatchedShadingTrees_2017 (stage 1) and
+#             MatchedCensusTrees_2017 or MatchingResult_All (stage 2)
+# and classifies every tile with set operations:
+#   no_folder   - in the index, no tile folder
+#   no_json     - folder without tree JSONs
+#   no_output   - JSONs, but a stage wrote nothing
+#   empty       - the stage output has no trees
+#   malformed   - the stage output is not valid JSON
+#   done
+# Outputs are judged by one scandir per folder: small files are parsed to tell empty from not,
+# larger ones only have their first and last bytes checked unless --deep parses them all.
+#
+#   python src/coverage_audit.py --index qgis/nyc2021_las_index.geojson --local-tiles "/Volumes/Extreme SSD/TFb" \
+#       --stage match="/Volumes/Extreme SSD/ZmatchNewResult" --result-dir result
+
+STATUSES = ['no_folder', 'no_json', 'no_output', 'empty', 'malformed', 'done']
+# outputs up to this size are parsed to tell an empty FeatureCollection or list from real data
+SMALL_OUTPUT_BYTES = 1024
+OUTPUT_EXTENSIONS = ('.json', '.geojson')
+# keys per listing request while looking for a tile's first tree JSON
+JSON_PROBE_PAGE_SIZE = 100
+
+
+def index_tiles(index_path):
+    with open(index_path, 'r') as f:
+        geojson_data = json.load(f)
+    return {str(feature['properties']['LAS_ID']) for feature in geojson_data['features']}
+
+
+def local_tile_folders(sample_dir, year):
+    # {tile_id: True when JSON_TreeData_{tile_id} holds a .json}; one scandir per tile folder
+    def has_json(tile_id):
+        json_dir = os.path.join(sample_dir, tile_id, year, f'JSON_TreeData_{tile_id}')
+        if not os.path.isdir(json_dir):
+            return False
+        with os.scandir(json_dir) as entries:
+            return any(entry.name.endswith('.json') for entry in entries)
+
+    with os.scandir(sample_dir) as entries:
+        tile_ids = [entry.name for entry in entries if entry.is_dir()]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return dict(zip(tile_ids, executor.map(has_json, tile_ids)))
+
+
+def s3_tile_folders(s3, bucket_name, base_prefix, year):
+    # Same as local_tile_folders from S3: one delimited listing for the tile folders, then one
+    # small listing per tile, so the cost does not grow with the number of trees
+    tile_ids = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=base_prefix, Delimiter='/'):
+        for prefix in page.get('CommonPrefixes', []):
+            tile_ids.append(prefix['Prefix'].rstrip('/').split('/')[-1])
+
+    def has_json(tile_id):
+        # a folder marker (JSON_TreeData_{tile}/) or another non-JSON key can sort first, so pages
+        # are read until a .json key turns up; any() stops the paginator there
+        pages = paginator.paginate(Bucket=bucket_name, Prefix=f"{base_prefix}{tile_id}/{year}/JSON_TreeData_{tile_id}/",
+                                   PaginationConfig={'PageSize': JSON_PROBE_PAGE_SIZE})
+        return any(obj['Key'].endswith('.json') for page in pages for obj in page.get('Contents', []))
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        return dict(zip(tile_ids, executor.map(has_json, tile_ids)))
+
+
+def output_tile_id(file_name):
+    # MatchedShadingTrees_{tile}.json, NewMatchedShadingTrees_{tile}.geojson ...; sidecars are skipped
+    stem, extension = os.path.splitext(file_name)
+    if extension not in OUTPUT_EXTENSIONS or '.' in stem or '_' not in stem:
+        return None
+    return stem.rsplit('_', 1)[-1]
+
+
+def _is_empty_document(data):
+    if isinstance(data, dict):
+        return len(data.get('features', data)) == 0
+    return len(data) == 0
+
+
+def _judge_output(path, size, deep):
+    # 'empty', 'malformed' or 'done' for one output file
+    if size == 0:
+        return 'empty'
+    if size <= SMALL_OUTPUT_BYTES or deep:
+        try:
+            with open(path, 'rb') as f:
+                data = json.load(f)
+        except (ValueError, UnicodeDecodeError):
+            return 'malformed'
+        return 'empty' if _is_empty_document(data) else 'done'
+    # a truncated write or concatenated objects ('}\n{' without the list around them) show at the ends
+    with open(path, 'rb') as f:
+        head = f.read(64).lstrip()
+        f.seek(max(0, size - 64))
+        tail = f.read().rstrip()
+    if head[:1] == b'[' and tail[-1:] == b']':
+        return 'done'
+    if head[:1] == b'{' and tail[-1:] == b'}' and b'FeatureCollection' in head:
+        return 'done'
+    if head[:1] == b'{' and tail[-1:] == b'}':
+        # a lone object can still be a FeatureCollection with "type" further in, parse to be sure
+        return _judge_output(path, size, True)
+    return 'malformed'
+
+
+def _judge_outputs(items, deep):
+    return [_judge_output(path, size, deep) for path, size in items]
+
+
+def stage_outputs(output_dir, deep=False, processes=None):
+    # {tile_id: 'empty' | 'malformed' | 'done'} from one scandir; sizes come with the directory entries
+    items = {}
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            tile_id = output_tile_id(entry.name)
+            if tile_id is not None and entry.is_file():
+                items[tile_id] = (entry.path, entry.stat().st_size)
+    tile_ids = list(items)
+    if deep and len(tile_ids) > 1:
+        # full parses are CPU bound, spread them over processes in chunks
+        chunk = max(1, len(tile_ids) // (4 * (processes or os.cpu_count() or 1)))
+        chunks = [tile_ids[i:i + chunk] for i in range(0, len(tile_ids), chunk)]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            judged = executor.map(_judge_outputs, [[items[t] for t in c] for c in chunks], [deep] * len(chunks))
+            return dict(zip(tile_ids, (status for statuses in judged for status in statuses)))
+    return {tile_id: _judge_output(path, size, deep) for tile_id, (path, size) in items.items()}
+
+
+def classify_tiles(index, folders, stages):
+    # index: set of tile ids or None, folders: {tile_id: has_json} or None when no tile folders
+    # were listed (every tile is then taken to have its JSONs), stages: {name: {tile_id: status}}.
+    # Returns rows (dicts) sorted by tile id and {diff name: set of tile ids}.
+    all_tiles = set(index or ()) | set(folders or ())
+    for outputs in stages.values():
+        all_tiles |= set(outputs)
+    diffs = {}
+    if folders is None:
+        with_folder = with_json = all_tiles
+    else:
+        with_folder = set(folders)
+        with_json = {tile_id for tile_id, has_json in folders.items() if has_json}
+        diffs['notileid'] = set(index or ()) - with_folder
+        diffs['nojsondata'] = with_folder - with_json
+    if index is not None:
+        diffs['notinindex'] = with_folder - index
+    for name, outputs in stages.items():
+        produced = set(outputs)
+        diffs[f'{name}_nooutput'] = with_json - produced
+        for status in ('empty', 'malformed'):
+            diffs[f'{name}_{status}'] = {tile_id for tile_id, judged in outputs.items() if judged == status}
+        if folders is not None:
+            diffs[f'{name}_orphan'] = produced - with_folder
+
+    rows = []
+    for tile_id in sorted(all_tiles, key=lambda t: (len(t), t)):
+        row = {'tile_id': tile_id, 'in_index': index is None or tile_id in index,
+               'folder': tile_id in with_folder, 'json': tile_id in with_json}
+        if not row['folder']:
+            status = 'no_folder'
+        elif not row['json']:
+            status = 'no_json'
+        else:
+            status = 'done'
+        for name, outputs in stages.items():
+            row[name] = outputs.get(tile_id, 'no_output')
+            # the tile stops at the first stage, in pipeline order, that is not done
+            if status == 'done' and row[name] != 'done':
+                status = row[name]
+        row['status'] = status
+        rows.append(row)
+    return rows, diffs
+
+
+def write_results(result_dir, rows, diffs):
+    if not os.path.exists(result_dir):
+        os.makedirs(result_dir)
+    # one tile id per line without a header, like the diff files written before
+    for name, tile_ids in diffs.items():
+        with open(os.path.join(result_dir, f'diff_{name}.csv'), mode='w', newline='') as file:
+            writer = csv.writer(file)
+            for tile_id in sorted(tile_ids, key=lambda t: (len(t), t)):
+                writer.writerow([tile_id])
+    if rows:
+        with open(os.path.join(result_dir, 'coverage.csv'), mode='w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def run_audit(index_path=None, local_tiles=None, s3=None, bucket_name=None, base_prefix=None, year='2017',
+              stage_dirs=None, result_dir='result', deep=False):
+    index = index_tiles(index_path) if index_path else None
+    if local_tiles:
+        folders = local_tile_folders(local_tiles, year)
+    elif s3 is not None:
+        folders = s3_tile_folders(s3, bucket_name, base_prefix, year)
+    else:
+        folders = None
+    stages = {name: stage_outputs(output_dir, deep) for name, output_dir in (stage_dirs or {}).items()}
+    rows, diffs = classify_tiles(index, folders, stages)
+    write_results(result_dir, rows, diffs)
+    counts = {status: 0 for status in STATUSES}
+    for row in rows:
+        counts[row['status']] += 1
+    return counts, diffs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Classify tiles by how far they got through the pipeline.')
+    parser.add_argument('--index', default=None, help='LAS index GeoJSON with a LAS_ID per tile')
+    parser.add_argument('--local-tiles', default=None, help='local tile folders (e.g. TFb) instead of S3')
+    parser.add_argument('--bucket', default=None, help='list tile folders from this bucket')
+    parser.add_argument('--base-prefix', default='ProcessedLasData/Sept17th-2023/')
+    parser.add_argument('--local-s3', default=None, help='read the bucket from this folder instead of S3')
+    parser.add_argument('--year', default='2017')
+    parser.add_argument('--stage', nargs='*', default=[], metavar='NAME=DIR', help='stage output folders, in order')
+    parser.add_argument('--result-dir', default='result')
+    parser.add_argument('--deep', action='store_true', help='parse every output instead of checking its ends')
+    args = parser.parse_args()
+
+    s3 = None
+    if args.bucket and not args.local_tiles:
+        if args.local_s3:
+            from fake_s3 import LocalS3Client
+            s3 = LocalS3Client(args.local_s3)
+        else:
+            import boto3
+            s3 = boto3.client('s3')
+    stage_dirs = dict(stage.split('=', 1) for stage in args.stage)
+    counts, diffs = run_audit(args.index, args.local_tiles, s3, args.bucket, args.base_prefix, args.year,
+                              stage_dirs, args.result_dir, args.deep)
+    for status, count in counts.items():
+        print(f"{status:<12}{count:>8}")
+    for name, tile_ids in diffs.items():
+        print(f"diff_{name}.csv: {len(tile_ids)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -60,42 +60,13 @@ import csv
 # print(f"The number of duplicately matched street trees: {diff}")
 
 
-# get the tiles in tfb
-dir_path = '/Volumes/Extreme SSD/TFb'
-tfb_list = [f for f in os.listdir(dir_path)]
-
-# output_path = 'result/tfb_tileids.csv'
-# with open(output_path, mode='w', newline='') as file:
-#     writer = csv.writer(file)
-#     for item in tfb_list:
-#         writer.writerow([item])
-
-# get the tiles in nyc 2021
-file_path = 'qgis/nyc2021_las_index.geojson'
-with open(file_path, 'r') as f:
-    geojson_data = json.load(f)
-tile_list = []
-for feature in geojson_data['features']:
-    tile_list.append(feature['properties']['LAS_ID'])
-
-# get the tiles with json 
-dir_path = '/Volumes/Extreme SSD/ZmatchNewResult'
-match_list = [x for x in dir_path if x.endswith('.geojson')]
-
-diff_notileid = [t for t in tile_list if t not in tfb_list]
-diff_nojsondata = [t for t in tfb_list if t not in match_list]
-
-output_path = 'result/diff_notileid.csv'
-with open(output_path, mode='w',newline='') as file:
-    writer = csv.writer(file)
-    for item in diff_notileid:
-        writer.writerow([item])
-
-output_path = 'result/diff_nojsondata.csv'
-with open(output_path, mode='w',newline='') as file:
-    writer = csv.writer(file)
-    for item in diff_nojsondata:
-        writer.writerow([item])
+# tiles in the LAS index without a TFb folder go to result/diff_notileid.csv, TFb tiles without tree
+# JSONs to result/diff_nojsondata.csv and those with JSONs but no match result to diff_match_nooutput.csv
+from coverage_audit import run_audit
+
+counts, diffs = run_audit(index_path='qgis/nyc2021_las_index.geojson', local_tiles='/Volumes/Extreme SSD/TFb',
+                          stage_dirs={'match': '/Volumes/Extreme SSD/ZmatchNewResult'}, result_dir='result')
+print(counts)
 
 '''
 nyc2021 > tfb > match
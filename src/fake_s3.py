@@ -0,0 +1,107 @@
+import os
+import io
+
+# A local-directory stand-in for the handful of boto3 S3 client calls the pipeline makes
+# (get_object, list_objects_v2 pagination with Prefix/Delimiter, head_object), so tiles can be
+# processed and benchmarked without AWS credentials. Bucket "b" maps to the folder root/b and
+# key "x/y.json" to root/b/x/y.json.
+#
+#   storage = pipeline_engine.S3Storage(LocalS3Client('/tmp/fake_s3'), bucket_name, base_prefix)
+
+
+class _NoSuchKey(Exception):
+    pass
+
+
+class _Exceptions:
+    NoSuchKey = _NoSuchKey
+
+
+class _ListObjectsV2Paginator:
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None, PaginationConfig=None):
+        page_size = (PaginationConfig or {}).get('PageSize', 1000)
+        keys, common_prefixes = self.client._list(Bucket, Prefix, Delimiter)
+        if not keys and not common_prefixes:
+            yield {'KeyCount': 0}
+            return
+        entries = [('key', key) for key in keys] + [('prefix', prefix) for prefix in common_prefixes]
+        entries.sort(key=lambda entry: entry[1])
+        for start in range(0, len(entries), page_size):
+            page_entries = entries[start:start + page_size]
+            page = {'KeyCount': len(page_entries)}
+            contents = [self.client._describe(Bucket, key) for kind, key in page_entries if kind == 'key']
+            prefixes = [{'Prefix': key} for kind, key in page_entries if kind == 'prefix']
+            if contents:
+                page['Contents'] = contents
+            if prefixes:
+                page['CommonPrefixes'] = prefixes
+            yield page
+
+
+class LocalS3Client:
+    exceptions = _Exceptions
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _describe(self, bucket, key):
+        stat = os.stat(self._path(bucket, key))
+        # Not an MD5 like real single-part uploads, but it changes whenever the object is rewritten
+        return {'Key': key, 'Size': stat.st_size, 'ETag': f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"',
+                'LastModified': stat.st_mtime}
+
+    def _list(self, bucket, prefix, delimiter):
+        bucket_root = os.path.join(self.root, bucket)
+        # Only walk the deepest folder the prefix fully names
+        base = prefix.rsplit('/', 1)[0] + '/' if '/' in prefix else ''
+        start_dir = os.path.join(bucket_root, *base.rstrip('/').split('/')) if base else bucket_root
+        keys = []
+        common_prefixes = set()
+        if not os.path.isdir(start_dir):
+            return keys, []
+        for dirpath, dirnames, filenames in os.walk(start_dir):
+            rel_dir = os.path.relpath(dirpath, bucket_root).replace(os.sep, '/')
+            rel_dir = '' if rel_dir == '.' else rel_dir + '/'
+            for filename in filenames:
+                key = rel_dir + filename
+                if not key.startswith(prefix):
+                    continue
+                rest = key[len(prefix):]
+                if delimiter and delimiter in rest:
+                    common_prefixes.add(prefix + rest.split(delimiter, 1)[0] + delimiter)
+                else:
+                    keys.append(key)
+        return keys, sorted(common_prefixes)
+
+    def get_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        if not os.path.isfile(path):
+            raise _NoSuchKey(f"The specified key does not exist: {Key}")
+        with open(path, 'rb') as f:
+            body = f.read()
+        description = self._describe(Bucket, Key)
+        return {'Body': io.BytesIO(body), 'ContentLength': len(body), 'ETag': description['ETag']}
+
+    def head_object(self, Bucket, Key):
+        if not os.path.isfile(self._path(Bucket, Key)):
+            raise _NoSuchKey(f"The specified key does not exist: {Key}")
+        description = self._describe(Bucket, Key)
+        return {'ContentLength': description['Size'], 'ETag': description['ETag']}
+
+    def put_object(self, Bucket, Key, Body):
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body.encode('utf-8') if isinstance(Body, str) else Body)
+        return {'ETag': self._describe(Bucket, Key)['ETag']}
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(f"LocalS3Client does not support {operation_name}")
+        return _ListObjectsV2Paginator(self)
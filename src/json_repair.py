@@ -0,0 +1,218 @@
+import os
+import re
+import csv
+import json
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+# Streaming validator and repairer for MatchedShadingTrees_{tile}.json. match_shade_data_aws_batch
+# appends each batch as indented objects one after another, so a finished file is a run of
+# concatenated objects rather than one JSON document, and a crash mid-write leaves a truncated
+# object behind. Instead of reading the whole file and patching '}\n{', every file is decoded
+# object by object with raw_decode over a buffered reader and rewritten as a JSON array (or
+# NDJSON); memory stays at about one object plus one read chunk.
+#
+#   python src/json_repair.py /data/Datasets/MatchingResult_All/MatchedShadingTrees_2017 --check
+#   python src/json_repair.py /data/Datasets/MatchingResult_All/MatchedShadingTrees_2017 --format array
+
+CHUNK_CHARS = 1 << 20
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+REPORT_FIELDS = ['tile_id', 'status', 'records', 'skipped_fragments', 'bytes_in', 'bytes_out', 'error']
+
+
+class RecordStream:
+    # Yields the top-level values of a file that holds either one array or concatenated values.
+    # A value that cannot be decoded is skipped up to the next record boundary (a '{' opening a
+    # line at the records' indentation) and counted in skipped_fragments.
+
+    def __init__(self, f, chunk_chars=CHUNK_CHARS):
+        self.f = f
+        self.chunk_chars = chunk_chars
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.in_array = False
+        self.array_closed = False
+        self.values_after_array = 0
+        self.top_level_values = 0
+        self.skipped_fragments = 0
+        self.boundary = re.compile(r'\n\{')
+
+    def _fill(self, min_chars=0):
+        # drop what was consumed, then read at least a chunk (more for a record larger than the buffer)
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        data = self.f.read(max(self.chunk_chars, min_chars))
+        if not data:
+            self.eof = True
+        self.buffer += data
+
+    def _skip_whitespace(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return
+            self._fill()
+
+    def _resync(self):
+        # move to the next record boundary, reading ahead until one shows up
+        while True:
+            match = self.boundary.search(self.buffer, self.pos + 1)
+            if match:
+                self.pos = match.start() + 1
+                return
+            if self.eof:
+                self.pos = len(self.buffer)
+                return
+            self._fill(len(self.buffer))
+
+    def __iter__(self):
+        self._skip_whitespace()
+        if self.buffer[self.pos:self.pos + 1] == '[':
+            self.in_array = True
+            self.pos += 1
+        while True:
+            self._skip_whitespace()
+            if self.pos >= len(self.buffer):
+                return
+            char = self.buffer[self.pos]
+            if char == ',' or (char == ']' and self.in_array):
+                self.pos += 1
+                self.array_closed = self.array_closed or char == ']'
+                continue
+            if self.in_array and self.top_level_values == 0:
+                # elements of an indented array start deeper than column 0
+                line_start = self.buffer.rfind('\n', 0, self.pos) + 1
+                self.boundary = re.compile(r'\n' + re.escape(self.buffer[line_start:self.pos]) + r'\{')
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                boundary = self.boundary.search(self.buffer, self.pos + 1)
+                if boundary is None and not self.eof:
+                    # most likely the value runs past the buffer, read as much again and retry
+                    self._fill(len(self.buffer))
+                    continue
+                # corrupt or truncated: drop it and carry on at the next record
+                self.skipped_fragments += 1
+                self._resync()
+                continue
+            self.pos = end
+            self.top_level_values += 1
+            self.values_after_array += self.array_closed
+            yield value
+            if self.pos > self.chunk_chars:
+                # forget what was consumed, the next read happens when the buffer runs out
+                self.buffer = self.buffer[self.pos:]
+                self.pos = 0
+
+
+def write_records(records, f, output_format):
+    count = 0
+    if output_format == 'array':
+        f.write('[')
+    for record in records:
+        if output_format == 'array':
+            f.write(',\n' if count else '\n')
+        f.write(json.dumps(record))
+        if output_format == 'ndjson':
+            f.write('\n')
+        count += 1
+    if output_format == 'array':
+        f.write('\n]\n' if count else ']\n')
+    return count
+
+
+def repair_file(path, output_format='array', check_only=False):
+    # Returns one report row; the file is replaced atomically, and only when it was not already
+    # a single valid array (or when NDJSON was asked for)
+    tile_id = os.path.splitext(os.path.basename(path))[0].rsplit('_', 1)[-1]
+    report = {'tile_id': tile_id, 'status': None, 'records': 0, 'skipped_fragments': 0,
+              'bytes_in': os.path.getsize(path), 'bytes_out': None, 'error': None}
+    temp_path = f'{path}.repair'
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            stream = RecordStream(f)
+            if check_only:
+                report['records'] = sum(1 for _ in stream)
+            else:
+                with open(temp_path, 'w', encoding='utf-8') as out:
+                    report['records'] = write_records(stream, out, output_format)
+        report['skipped_fragments'] = stream.skipped_fragments
+        valid_array = (stream.in_array and stream.array_closed and not stream.values_after_array
+                       and stream.skipped_fragments == 0)
+        if report['records'] == 0 and stream.skipped_fragments == 0:
+            report['status'] = 'empty'
+        elif valid_array and output_format == 'array':
+            report['status'] = 'valid'
+        elif check_only:
+            report['status'] = 'corrupt' if stream.skipped_fragments else 'concatenated'
+        else:
+            report['status'] = 'recovered' if stream.skipped_fragments else 'repaired'
+        if not check_only:
+            if report['status'] in ('valid', 'empty'):
+                os.remove(temp_path)
+            else:
+                os.replace(temp_path, path)
+                report['bytes_out'] = os.path.getsize(path)
+    except (OSError, UnicodeDecodeError) as e:
+        report['status'] = 'unreadable'
+        report['error'] = str(e)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return report
+
+
+def _repair_file_args(args):
+    return repair_file(*args)
+
+
+def repair_folder(input_dir, output_format='array', check_only=False, processes=None, report_path=None):
+    paths = []
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.startswith('MatchedShadingTrees_') and entry.name.endswith('.json'):
+                paths.append(entry.path)
+    # largest files first so one big tile does not finish last
+    paths.sort(key=os.path.getsize, reverse=True)
+    reports = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        jobs = [(path, output_format, check_only) for path in paths]
+        for report in tqdm(executor.map(_repair_file_args, jobs), total=len(jobs), desc="Checking" if check_only else "Repairing"):
+            if report['status'] in ('corrupt', 'recovered', 'unreadable'):
+                logging.warning(f"Tile {report['tile_id']}: {report['status']}, {report['records']} records kept, "
+                                f"{report['skipped_fragments']} fragments dropped {report['error'] or ''}")
+            reports.append(report)
+    if report_path:
+        with open(report_path, mode='w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(sorted(reports, key=lambda r: (len(r['tile_id']), r['tile_id'])))
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate and repair MatchedShadingTrees JSON files in place.')
+    parser.add_argument('input_dir')
+    parser.add_argument('--format', default='array', choices=['array', 'ndjson'], dest='output_format')
+    parser.add_argument('--check', action='store_true', help='only report, do not rewrite files')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--report', default=None, help='CSV with one row per tile, defaults to input_dir/repair_report.csv')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    report_path = args.report or os.path.join(args.input_dir, 'repair_report.csv')
+    reports = repair_folder(args.input_dir, args.output_format, args.check, args.processes, report_path)
+    statuses = {}
+    for report in reports:
+        statuses[report['status']] = statuses.get(report['status'], 0) + 1
+    print(f"{len(reports)} files: " + ', '.join(f"{status} {count}" for status, count in sorted(statuses.items())))
+    print(f"records recovered: {sum(report['records'] for report in reports)}, "
+          f"fragments dropped: {sum(report['skipped_fragments'] for report in reports)}")
+    print(f"report: {report_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,12 +5,18 @@ import numpy as np
 import pandas as pd
 import geopandas as gpd
 import logging
-import matplotlib.pyplot as plt
 import contextily as ctx
 import csv
+# maps are drawn on a bare Agg canvas, so no pyplot state and no display backend is involved
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
 
 from shapely.geometry import Point, box, shape, mapping
 from json.decoder import JSONDecodeError
+from match_metrics import compute_match_metrics, write_match_metrics
 
 logging.basicConfig(filename='log/match_metrics.log', filemode='w', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -136,15 +142,18 @@ def tile_bounds_2_geojson(tile_bounds, output_dir, tile_id):
     return tile_bounds_geojson
 
 def filter_geojson_data(geojson_data, tile_bounds, output_dir, tile_id):
-    filtered_features = []
-    for i, point in enumerate(geojson_data['coords']):
-        if tile_bounds.contains(Point(point)):
-            feature = {
-                'type': 'Feature',
-                'geometry': {'type': 'Point', 'coordinates': point},
-                'properties': geojson_data['features_properties'][i]
-            }
-            filtered_features.append(feature)
+    # strictly inside the bounds, like tile_bounds.contains(Point(point)), for all points at once
+    minx, miny, maxx, maxy = tile_bounds.bounds
+    points = geojson_data['points']
+    inside = (points[:, 0] > minx) & (points[:, 0] < maxx) & (points[:, 1] > miny) & (points[:, 1] < maxy)
+    filtered_features = [
+        {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': geojson_data['coords'][i]},
+            'properties': geojson_data['features_properties'][i]
+        }
+        for i in np.flatnonzero(inside)
+    ]
     if not filtered_features: 
         return None
     filtered_geojson = {'type': 'FeatureCollection', 'features': filtered_features}
@@ -175,87 +184,117 @@ def load_matched_data_geojson(input_dir, tile_id, output_dir):
         return None
 
 # 2. mapping, creating the base map
-def mapping_trees_tile(tile_bounds_geojson, lidar_geojson, filtered_street_geojson, matched_data_geojson, output_dir, tile_id):
+def feature_points(geojson, id_key=None):
+    # (n, 2) coordinates of a FeatureCollection, with the id_key property of each feature
+    features = geojson['features'] if geojson else []
+    coords = np.array([feature['geometry']['coordinates'][:2] for feature in features], dtype=float).reshape(-1, 2)
+    ids = [feature['properties'].get(id_key) for feature in features] if id_key else None
+    return coords, ids
+
+
+def match_line_segments(lidar_coords, lidar_ids, matched_coords, matched_ids):
+    # one segment per LiDAR tree from its detected location to where its output row sits; the
+    # first output row per Tree_CountID is used when an id repeats
+    lidar = pd.DataFrame({'Tree_CountId': lidar_ids, 'x0': lidar_coords[:, 0], 'y0': lidar_coords[:, 1]})
+    matched = pd.DataFrame({'Tree_CountId': matched_ids, 'x1': matched_coords[:, 0], 'y1': matched_coords[:, 1]})
+    pairs = lidar.merge(matched.drop_duplicates('Tree_CountId'), on='Tree_CountId', how='inner')
+    return pairs[['x0', 'y0', 'x1', 'y1']].to_numpy().reshape(-1, 2, 2)
+
+
+def mapping_trees_tile(tile_bounds_geojson, lidar_geojson, filtered_street_geojson, matched_data_geojson, output_dir, tile_id, dpi=300):
     # Ensure the output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
-    # Convert tile_bounds GeoJSON to a GeoDataFrame
-    if tile_bounds_geojson:
-        gdf_tile_bounds = gpd.GeoDataFrame.from_features([tile_bounds_geojson], crs='epsg:4326')
-    else:
+    if not tile_bounds_geojson:
         print("No tile bounds provided.")
         return
 
-    # Convert other GeoJSON objects to GeoDataFrames
-    gdf_lidar = gpd.GeoDataFrame.from_features(lidar_geojson['features'], crs='epsg:4326') if lidar_geojson else gpd.GeoDataFrame()
-    gdf_street = gpd.GeoDataFrame.from_features(filtered_street_geojson['features'], crs='epsg:4326') if filtered_street_geojson else gpd.GeoDataFrame()
-    gdf_matched = gpd.GeoDataFrame.from_features(matched_data_geojson['features'], crs='epsg:4326') if matched_data_geojson else gpd.GeoDataFrame()
+    lidar_coords, lidar_ids = feature_points(lidar_geojson, 'Tree_CountId')
+    street_coords, _ = feature_points(filtered_street_geojson)
+    matched_coords, matched_ids = feature_points(matched_data_geojson, 'Tree_CountID')
 
-    # Create the plot
-    fig, ax = plt.subplots(figsize=(10, 10))
+    # a Figure of its own per call, safe to use from pool workers
+    fig = Figure(figsize=(10, 10))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
 
     # Plot tile bounds
-    if not gdf_tile_bounds.empty:
-        gdf_tile_bounds.boundary.plot(ax=ax, edgecolor='black', linewidth=2, label='Tile Bounds')
+    bounds = np.array(tile_bounds_geojson['geometry']['coordinates'][0])
+    ax.plot(bounds[:, 0], bounds[:, 1], color='black', linewidth=2, label='Tile Bounds')
 
     # Plot data points
-    if not gdf_lidar.empty:
-        gdf_lidar.plot(ax=ax, marker='^', color='green', markersize=50, label='LIDAR Data', alpha=0.6)
-    if not gdf_street.empty:
-        gdf_street.plot(ax=ax, marker='o', color='blue', markersize=40, label='Filtered Street Data', alpha=0.6)
-    if not gdf_matched.empty:
-        gdf_matched.plot(ax=ax, marker='x', color='red', markersize=40, label='Matched Data')
-
-
-    # line plot
-    if not gdf_lidar.empty and not gdf_matched.empty:
-        for lidar_index, lidar_row in gdf_lidar.iterrows():
-            matched_row = gdf_matched[gdf_matched['Tree_CountID'] == lidar_row['Tree_CountId']]
-            if not matched_row.empty:
-                lidar_point = lidar_row.geometry
-                matched_point = matched_row.iloc[0].geometry
-                line = plt.Line2D((lidar_point.x, matched_point.x), (lidar_point.y, matched_point.y), lw=1, color='black', alpha=0.8)
-                ax.add_line(line)
+    if len(lidar_coords):
+        ax.scatter(lidar_coords[:, 0], lidar_coords[:, 1], marker='^', color='green', s=50, label='LIDAR Data', alpha=0.6)
+    if len(street_coords):
+        ax.scatter(street_coords[:, 0], street_coords[:, 1], marker='o', color='blue', s=40, label='Filtered Street Data', alpha=0.6)
+    if len(matched_coords):
+        ax.scatter(matched_coords[:, 0], matched_coords[:, 1], marker='x', color='red', s=40, label='Matched Data')
+
+    # all match lines as one collection
+    if len(lidar_coords) and len(matched_coords):
+        segments = match_line_segments(lidar_coords, lidar_ids, matched_coords, matched_ids)
+        ax.add_collection(LineCollection(segments, linewidths=1, colors='black', alpha=0.8))
 
     # Customize the plot
+    # same aspect geopandas gives a lon/lat plot, so maps look like the ones drawn before
+    ax.set_aspect(1 / np.cos(np.radians(bounds[:, 1].mean())))
     ax.set_title(f'Tile {tile_id} Visualization')
     ax.legend()
     ax.set_axis_off()
 
     # Save the figure
     output_filepath = os.path.join(output_dir, f'map_visualization_{tile_id}.png')
-    plt.savefig(output_filepath, dpi=300)
-    plt.close()
+    fig.savefig(output_filepath, dpi=dpi)
 
-    print(f'Map visualization saved to for tile {tile_id}')
     logging.info(f'Map visualization saved for tile {tile_id}')
+    return output_filepath
 
-# 3. calculate the metrics for each tile
-# the total number of street trees / the number of matches
 
-def calculate_tile_metrics(filtered_street_geojson, matched_data_geojson, tile_id):
-    # Initialize variables
-    total_street_trees = 0
-    matched_trees = 0
-    ratio = 0  # Ensure ratio is defined even if total_street_trees is 0
+_worker_geojson = None
 
-    if filtered_street_geojson is not None:
-        total_street_trees = len(filtered_street_geojson["features"])
 
-    if matched_data_geojson is not None:
-        matched_trees = sum(1 for feature in matched_data_geojson["features"] if feature["properties"].get("hasTreeCensusID", False))
+def _init_render_worker(all_geojson):
+    # the census is sent once per worker process instead of once per tile
+    global _worker_geojson
+    _worker_geojson = all_geojson
 
-    if total_street_trees > 0:
-        ratio = matched_trees / total_street_trees
 
-    csv_file_name = 'result/tile_metrics.csv'
+def render_tile(sample_dir, match_data_dir, tile_id, year, year_output_dir, y_buffer_distance, x_buffer_distance, dpi=300):
+    tile_output_dir = os.path.join(year_output_dir, tile_id)
+    os.makedirs(tile_output_dir, exist_ok=True)
 
-    with open(csv_file_name, mode='a', newline='') as file:
-        writer = csv.writer(file)
-        # Write the data
-        writer.writerow([tile_id, matched_trees, total_street_trees, ratio])
+    json_data = load_json_files(sample_dir, tile_id, year, tile_output_dir)
+    if not json_data:
+        return None
 
-    logging.info(f"{tile_id}, {matched_trees}, {total_street_trees}, {ratio}")
+    lidar_geojson = json_to_geojson(json_data, tile_id, year, tile_output_dir)
+    tile_bounds = get_tile_bounds(json_data, y_buffer_distance, x_buffer_distance)
+    tile_bounds_geojson = tile_bounds_2_geojson(tile_bounds, tile_output_dir, tile_id)
+    filtered_street_geojson = filter_geojson_data(_worker_geojson, tile_bounds, tile_output_dir, tile_id)
+    matched_data_geojson = load_matched_data_geojson(match_data_dir, tile_id, tile_output_dir)
+    return mapping_trees_tile(tile_bounds_geojson, lidar_geojson, filtered_street_geojson, matched_data_geojson,
+                              tile_output_dir, tile_id, dpi)
+
+
+def render_tiles(tile_ids, all_geojson, sample_dir, match_data_dir, year, year_output_dir, y_buffer_distance,
+                 x_buffer_distance, dpi=300, processes=None):
+    rendered = {}
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_render_worker, initargs=(all_geojson,)) as executor:
+        futures = {
+            executor.submit(render_tile, sample_dir, match_data_dir, tile_id, year, year_output_dir,
+                            y_buffer_distance, x_buffer_distance, dpi): tile_id
+            for tile_id in tile_ids
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Rendering tiles"):
+            tile_id = futures[future]
+            try:
+                rendered[tile_id] = future.result()
+            except Exception as e:
+                logging.error(f"Error rendering tile {tile_id}: {e}", exc_info=True)
+                rendered[tile_id] = None
+            if rendered[tile_id] is None:
+                print(f"No map for {tile_id}, skipping to next tile.")
+    return rendered
 
 def main():
     sample_dir = 'TFb'
@@ -271,25 +310,13 @@ def main():
     year_output_dir = f'output_{year}'
     os.makedirs(year_output_dir, exist_ok=True)
 
-    for f in tile_folders:
-        tile_id = f
-        tile_output_dir = os.path.join(year_output_dir, f)
-        os.makedirs(tile_output_dir, exist_ok=True)
-        
-        json_data = load_json_files(sample_dir, tile_id, year, tile_output_dir)
-        if not json_data:
-            print(f"No JSON data for {tile_id}, skipping to next tile.")
-            continue
-        
-        lidar_geojson = json_to_geojson(json_data, tile_id, year, tile_output_dir)     
-        tile_bounds = get_tile_bounds(json_data, y_buffer_distance, x_buffer_distance)
-        tile_bounds_geojson = tile_bounds_2_geojson(tile_bounds, tile_output_dir, tile_id)
-        filtered_street_geojson = filter_geojson_data(all_geojson, tile_bounds, tile_output_dir, tile_id)
-        matched_data_geojson = load_matched_data_geojson(match_data_dir, tile_id, tile_output_dir)
-
-        # mapping_trees_tile(tile_bounds_geojson, lidar_geojson, filtered_street_geojson, matched_data_geojson, tile_output_dir, tile_id)
-        calculate_tile_metrics(filtered_street_geojson, matched_data_geojson, tile_id)
-        
+    # 2. one map per tile, rendered in parallel
+    render_tiles(tile_folders, all_geojson, sample_dir, match_data_dir, year, year_output_dir,
+                 y_buffer_distance, x_buffer_distance)
+
+    # 3. match quality for all tiles at once: result/tile_metrics.csv plus the tile, borough and species tables
+    write_match_metrics(compute_match_metrics(match_data_dir, all_geojson), 'result')
+
     # # Save ratio data
     # file_name = "result/tile_match_ratios.csv"
     # with open(file_name, mode='w', newline='') as file:
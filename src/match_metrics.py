@@ -0,0 +1,188 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from tile_fingerprint import load_fingerprint
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Match-quality metrics for every tile at once, from the saved NewMatchedShadingTrees outputs
+# and the city-wide census. The census trees of each tile (those strictly inside its buffered
+# bounds, as filter_geojson_data selects them) come from one STRtree query of all census points
+# against all tile boxes, and the LiDAR claims are joined onto them, so each level is a single
+# groupby over one frame:
+#   matched_ratio        - census trees matched by a LiDAR tree of the tile / census trees
+#   distance p50/90/99   - Distance_to_census_location of those matches
+#   duplicate_claims     - census trees claimed by more than one LiDAR tree (across tiles too)
+#   unmatched_census     - census trees no tile claimed
+# by tile, by borough (census boroname) and by species (census spc_common). A census tree in the
+# overlap of two tile buffers counts for both tiles, but once for its borough and species.
+#
+#   python src/match_metrics.py /data/Datasets/MatchingResult_All --census-dir /data/Datasets/StreetTreeGeoJSONs
+
+# buffers of pipeline_engine, used for outputs written before fingerprints stored the bounds
+Y_BUFFER_DISTANCE = 0.00010484
+X_BUFFER_DISTANCE = 0.00009009
+OUTPUT_PREFIX = 'NewMatchedShadingTrees_'
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def _load_json(path):
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read()) if orjson is not None else json.load(f)
+
+
+def load_tile_matches(path):
+    # The few output columns the metrics need, plus the tile's bounds
+    tile_id = os.path.basename(path)[len(OUTPUT_PREFIX):-len('.geojson')]
+    features = _load_json(path)['features']
+    matched = [bool(f['properties'].get('hasTreeCensusID')) for f in features]
+    census_ids = [f['properties'].get('Census_id') for f in features]
+    distances = [f['properties'].get('Distance_to_census_location') for f in features]
+    fingerprint = load_fingerprint(os.path.dirname(path), tile_id)
+    if fingerprint is not None:
+        bounds = tuple(fingerprint['tile_bounds'])
+    elif features:
+        # matched trees sit on their census location, close enough to the LiDAR extent here
+        coords = np.array([f['geometry']['coordinates'][:2] for f in features], dtype=float)
+        bounds = (coords[:, 0].min() - X_BUFFER_DISTANCE, coords[:, 1].min() - Y_BUFFER_DISTANCE,
+                  coords[:, 0].max() + X_BUFFER_DISTANCE, coords[:, 1].max() + Y_BUFFER_DISTANCE)
+    else:
+        bounds = None
+    return {
+        'tile_id': tile_id,
+        'bounds': bounds,
+        'lidar_trees': len(features),
+        'matched': np.array(matched, dtype=bool),
+        'census_id': np.array(census_ids, dtype=object),
+        'distance': np.array([np.nan if d is None else d for d in distances], dtype=float)
+    }
+
+
+def load_all_matches(match_data_dir, processes=None):
+    paths = sorted(os.path.join(match_data_dir, name) for name in os.listdir(match_data_dir)
+                   if name.startswith(OUTPUT_PREFIX) and name.endswith('.geojson'))
+    if processes == 1 or len(paths) < 2:
+        return [load_tile_matches(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(load_tile_matches, paths, chunksize=8))
+
+
+def census_frame(all_geojson):
+    # one row per census tree, in the order of all_geojson (the census row the claims refer to)
+    columns = {'census_id': 'tree_id', 'borough': 'boroname', 'species': 'spc_common'}
+    if 'properties' in all_geojson:
+        properties = all_geojson['properties']
+        return pd.DataFrame({name: properties.column(key) for name, key in columns.items()})
+    # one properties dict per feature, as the loaders of matchMapping.py and matchMapping2.py keep it
+    properties = all_geojson['features_properties']
+    return pd.DataFrame({name: [props.get(key) for props in properties] for name, key in columns.items()})
+
+
+def tile_census_pairs(tiles, census_points):
+    # (tile position, census row) for every census point strictly inside a tile's bounds
+    boxes = [shapely.box(*tile['bounds']) if tile['bounds'] else shapely.Point() for tile in tiles]
+    points = shapely.points(census_points[:, 0], census_points[:, 1])
+    census_rows, tile_positions = shapely.STRtree(boxes).query(points, predicate='within')
+    return tile_positions, census_rows
+
+
+def build_frames(tiles, all_geojson):
+    # claims: one row per matched LiDAR tree; pairs: one row per (tile, census tree in its bounds)
+    census = census_frame(all_geojson)
+    claims = pd.DataFrame({
+        'tile_id': np.concatenate([np.full(tile['matched'].sum(), tile['tile_id'], dtype=object) for tile in tiles])
+        if tiles else np.array([], dtype=object),
+        'census_id': np.concatenate([tile['census_id'][tile['matched']] for tile in tiles]) if tiles else [],
+        'distance': np.concatenate([tile['distance'][tile['matched']] for tile in tiles]) if tiles else [],
+    })
+    # census ids come back as ints or strings depending on the writer, compare them as strings
+    claims['census_id'] = claims['census_id'].astype(str)
+    census['census_id'] = census['census_id'].astype(str)
+    claim_counts = claims.groupby('census_id').size()
+
+    tile_positions, census_rows = tile_census_pairs(tiles, np.asarray(all_geojson['points'], dtype=float)[:, :2])
+    pairs = census.iloc[census_rows].reset_index(drop=True)
+    pairs['tile_id'] = np.array([tile['tile_id'] for tile in tiles], dtype=object)[tile_positions]
+    # the tile's own (best) match of each census tree in its bounds
+    own = claims.groupby(['tile_id', 'census_id'], as_index=False)['distance'].min()
+    pairs = pairs.merge(own, on=['tile_id', 'census_id'], how='left')
+    pairs['claims'] = pairs['census_id'].map(claim_counts).fillna(0).astype(int)
+
+    # once per census tree for the borough and species levels, with its best match anywhere
+    best = claims.groupby('census_id')['distance'].min()
+    trees = census.drop_duplicates('census_id').copy()
+    trees['distance'] = trees['census_id'].map(best)
+    trees['claims'] = trees['census_id'].map(claim_counts).fillna(0).astype(int)
+    # only census trees inside some processed tile count, the rest of the city was not flown
+    trees = trees[trees['census_id'].isin(pairs['census_id'])]
+    return pairs, trees
+
+
+def summarize(frame, keys):
+    frame = frame.assign(is_matched=frame['distance'].notna(),
+                         is_duplicate=frame['claims'].gt(1), is_unmatched=frame['claims'].eq(0))
+    grouped = frame.groupby(keys, dropna=False)
+    summary = grouped.agg(census_trees=('census_id', 'size'), matched=('is_matched', 'sum'),
+                          duplicate_claims=('is_duplicate', 'sum'), unmatched_census=('is_unmatched', 'sum'))
+    summary['matched_ratio'] = summary['matched'] / summary['census_trees']
+    # reindexed, an empty frame unstacks to no quantile columns at all
+    distances = grouped['distance'].quantile(QUANTILES).unstack().reindex(columns=QUANTILES)
+    distances.columns = [f'distance_p{int(q * 100)}' for q in QUANTILES]
+    return summary.join(distances).reset_index()
+
+
+def compute_match_metrics(match_data_dir, all_geojson, processes=None):
+    tiles = load_all_matches(match_data_dir, processes)
+    pairs, trees = build_frames(tiles, all_geojson)
+    by_tile = summarize(pairs, 'tile_id')
+    lidar = pd.DataFrame({'tile_id': pd.Series([tile['tile_id'] for tile in tiles], dtype=object),
+                          'lidar_trees': [tile['lidar_trees'] for tile in tiles]})
+    # tiles without any census tree in their bounds still get a row
+    by_tile = lidar.merge(by_tile, on='tile_id', how='left')
+    count_columns = ['census_trees', 'matched', 'duplicate_claims', 'unmatched_census']
+    by_tile[count_columns] = by_tile[count_columns].fillna(0).astype(int)
+    by_tile['matched_ratio'] = by_tile['matched_ratio'].fillna(0.0)
+    return {'tile': by_tile, 'borough': summarize(trees, 'borough'), 'species': summarize(trees, 'species')}
+
+
+def write_match_metrics(metrics, result_dir):
+    if not os.path.exists(result_dir):
+        os.makedirs(result_dir)
+    paths = {}
+    for level, frame in metrics.items():
+        paths[level] = os.path.join(result_dir, f'match_metrics_{level}.csv')
+        frame.to_csv(paths[level], index=False)
+    # the old per-tile table, now written once and with a header
+    tile_metrics = metrics['tile'].rename(columns={'matched': 'matched_trees', 'census_trees': 'total_street_trees',
+                                                   'matched_ratio': 'ratio'})
+    tile_metrics[['tile_id', 'matched_trees', 'total_street_trees', 'ratio']].to_csv(
+        os.path.join(result_dir, 'tile_metrics.csv'), index=False)
+    return paths
+
+
+def main():
+    from pipeline_engine import load_all_geojson_files
+    parser = argparse.ArgumentParser(description='Match-quality metrics by tile, borough and species.')
+    parser.add_argument('match_data_dir', help='folder with the NewMatchedShadingTrees_{tile}.geojson outputs')
+    parser.add_argument('--census-dir', default='/data/Datasets/StreetTreeGeoJSONs')
+    parser.add_argument('--result-dir', default='result')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    metrics = compute_match_metrics(args.match_data_dir, load_all_geojson_files(args.census_dir), args.processes)
+    paths = write_match_metrics(metrics, args.result_dir)
+    by_tile = metrics['tile']
+    print(f"{len(by_tile)} tiles, {by_tile['matched'].sum()} of {by_tile['census_trees'].sum()} census trees matched")
+    for level, path in paths.items():
+        print(f"{level}: {path}")
+
+
+if __name__ == "__main__":
+    main()
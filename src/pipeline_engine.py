@@ -0,0 +1,665 @@
+import os
+import gc
+import json
+import math
+import logging
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import Point, box, shape
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+from rtree import index
+from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from seam_reconciliation import save_tile_claims, load_tile_claims, register_tile_claims
+from tile_fingerprint import s3_inputs_hash, file_sha256, census_shard_hash, code_version, save_fingerprint
+from tree_batch import TreeBatch
+from census_store import load_census_files
+from tree_json import parse_tree_fields
+from shade_windows import SHADE_WINDOWS, window_output_keys, validate_windows, evaluate_shade_windows
+from stage_metrics import instrument_stage, start_tile_metrics, add_tile_metric, set_tile_metric, finish_tile_metrics
+
+# The tile pipeline every entry point runs: LiDAR tree JSONs and their Shading_Metrics CSVs are
+# read from a storage backend, labelled with their borough, matched to the street tree census and
+# written as NewMatchedShadingTrees_{tile}.geojson with its census claims and fingerprint.
+# A storage backend holds tiles in the layout the LiDAR processing writes,
+#   {tile}/{year}/JSON_TreeData_{tile}/{tile}_{year}_ID_{id}_TreeCluster.json
+#   {tile}/{year}/Shading_Metrics_{tile}/Shading_Metric_{tile}_Tree_ID_{id}.csv
+# under a bucket prefix (S3Storage) or a local folder such as TFb or BK17 (LocalStorage), so a
+# local run goes through exactly the stages of an AWS run.
+#
+#   storage = S3Storage(boto3.client('s3'), 'treefolio-sylvania-data', 'ProcessedLasData/Sept17th-2023/')
+#   storage = LocalStorage('BK17')
+#   process_tile(storage, tile_id, '2017', all_geojson, boundary_path, x_buffer, y_buffer, output_dir)
+
+# source files whose changes invalidate tile outputs, part of the input fingerprint: the engine and
+# every local module its results depend on (census parsing and coercion, tree JSON parsing, the tree
+# columns, shade windows, census claims); stage_metrics, tile_fingerprint and fake_s3 are left out
+PIPELINE_MODULES = ['pipeline_engine', 'census_store', 'tree_json', 'tree_batch', 'shade_windows', 'seam_reconciliation']
+PIPELINE_SOURCES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), f'{module}.py') for module in PIPELINE_MODULES]
+
+# census candidates considered per LiDAR tree by the 'optimal' one-to-one matching mode
+MATCH_CANDIDATES = 5
+
+# Matching distances are measured in NY State Plane Long Island (EPSG:2263, US survey feet),
+# the CRS the BK17 census layer already uses
+MATCH_CRS = 'EPSG:2263'
+to_match_crs = Transformer.from_crs('EPSG:4326', MATCH_CRS, always_xy=True)
+FEET_PER_METRE = 3937 / 1200
+# shade windows evaluated per tree CSV, a new window only needs an entry in shade_windows.SHADE_WINDOWS
+validate_windows(SHADE_WINDOWS)
+SHADE_KEYS = window_output_keys(SHADE_WINDOWS)
+
+
+def configure_logging(log_directory, log_name='tree_indexing.log', filemode='a'):
+    # Check if the log directory exists, and create it if it doesn't
+    if not os.path.exists(log_directory):
+        os.makedirs(log_directory)
+    log_filename = os.path.join(log_directory, log_name)
+    logging.basicConfig(filename=log_filename, filemode=filemode, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+class TileStorage:
+    # Keys are what read() takes: the object key in S3, the path relative to the folder locally.
+    # Listings are list_objects_v2 entries (Key, Size, ETag) from either backend.
+
+    def tile_prefix(self, tile_id, year):
+        return self.key(f"{tile_id}/{year}/")
+
+    def tile_objects(self, tile_id, year):
+        # everything under the tile's year, one listing for fingerprints, costs and the async runner
+        return self.list_objects(self.tile_prefix(tile_id, year))
+
+    def tree_json_keys(self, tile_id, year):
+        prefix = self.key(f"{tile_id}/{year}/JSON_TreeData_{tile_id}/")
+        return [obj['Key'] for obj in self.list_objects(prefix) if obj['Key'].endswith('.json')]
+
+    def shade_csv_key(self, tile_id, year, tree_id):
+        return self.key(f"{tile_id}/{year}/Shading_Metrics_{tile_id}/Shading_Metric_{tile_id}_Tree_ID_{tree_id}.csv")
+
+    def read_many(self, keys, max_workers=8):
+        if max_workers <= 1:
+            return [self.read(key) for key in keys]
+        # boto3 clients are thread-safe, so the reads of one batch can overlap
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.read, keys))
+
+
+class S3Storage(TileStorage):
+    def __init__(self, s3, bucket_name, base_prefix):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.base_prefix = base_prefix
+
+    def __repr__(self):
+        return f"s3://{self.bucket_name}/{self.base_prefix}"
+
+    def key(self, relative_key):
+        return f"{self.base_prefix}{relative_key}"
+
+    def list_tiles(self):
+        paginator = self.s3.get_paginator('list_objects_v2')
+        dirs = set()
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.base_prefix, Delimiter='/'):
+            for obj in page.get('CommonPrefixes', []):
+                # Split the prefix by '/' and filter out empty strings, then take the last element
+                dirs.add(obj['Prefix'].rstrip('/').split('/')[-1])
+        return list(dirs)
+
+    def list_objects(self, prefix):
+        objects = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            objects.extend(page.get('Contents', []))
+        return objects
+
+    def read(self, key):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=key)
+            return response['Body'].read()
+        except self.s3.exceptions.NoSuchKey:
+            return None
+
+
+class LocalStorage(TileStorage):
+    def __init__(self, sample_dir):
+        self.sample_dir = sample_dir
+
+    def __repr__(self):
+        return self.sample_dir
+
+    def key(self, relative_key):
+        return relative_key
+
+    def _path(self, key):
+        return os.path.join(self.sample_dir, *key.rstrip('/').split('/'))
+
+    def list_tiles(self):
+        with os.scandir(self.sample_dir) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
+
+    def list_objects(self, prefix):
+        # one scandir per folder under the prefix, which names a folder here
+        objects = []
+        pending = [prefix]
+        while pending:
+            folder = pending.pop()
+            try:
+                entries = list(os.scandir(self._path(folder)))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if entry.is_dir():
+                    pending.append(f"{folder}{entry.name}/")
+                    continue
+                stat = entry.stat()
+                # not an MD5 like S3, but it changes whenever the file is rewritten
+                objects.append({'Key': f"{folder}{entry.name}", 'Size': stat.st_size,
+                                'ETag': f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'})
+        objects.sort(key=lambda obj: obj['Key'])
+        return objects
+
+    def read(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+def open_storage(bucket_name=None, base_prefix='', local_s3=None, sample_dir=None):
+    # sample_dir: a local tile folder; local_s3: a folder served as the bucket by fake_s3; else S3
+    if sample_dir:
+        return LocalStorage(sample_dir)
+    if local_s3:
+        from fake_s3 import LocalS3Client
+        return S3Storage(LocalS3Client(local_s3), bucket_name, base_prefix)
+    import boto3
+    return S3Storage(boto3.client('s3'), bucket_name, base_prefix)
+
+
+@instrument_stage
+def load_tree_jsons(storage, tile_id, year):
+    # Only the fields of each JSON the pipeline uses are kept, see tree_batch.py
+    tree_rows = []
+    try:
+        json_keys = storage.tree_json_keys(tile_id, year)
+    except (ClientError, OSError) as e:
+        logging.error(f"Failed to list the tree JSONs of tile {tile_id} in {storage}: {e}")
+        return None
+
+    for json_key in json_keys:
+        try:
+            # only the needed fields are decoded, see tree_json.py
+            tree_rows.append(parse_tree_fields(storage.read(json_key)))
+        except json.JSONDecodeError as e:
+            logging.error(f"Error reading {json_key} for tile {tile_id}: {e}")
+        except (ClientError, OSError) as e:
+            logging.error(f"Failed to load {json_key} from {storage}: {e}")
+
+    if not tree_rows:
+        logging.info(f"Lidar Json data does not exist for tile {tile_id} in year {year}")
+        return None
+    return TreeBatch(tile_id, tree_rows)
+
+
+def summarize_shade_csv(csv_content, year='2017', windows=None):
+    # every window in SHADE_WINDOWS is evaluated on a single parse of the CSV, see shade_windows.py
+    return evaluate_shade_windows(csv_content, year, windows or SHADE_WINDOWS)
+
+
+@instrument_stage
+def fetch_objects(storage, keys, max_fetch_workers):
+    return storage.read_many(keys, max_fetch_workers)
+
+
+@instrument_stage
+def aggregate_shade_batch(trees, start, csv_contents, year='2017'):
+    summaries = []
+    for csv_content in csv_contents:
+        add_tile_metric('csvs_missing' if csv_content is None else 'csvs_found')
+        summaries.append(summarize_shade_csv(csv_content, year))
+    for key in SHADE_KEYS:
+        trees.set_shade(key, start, [np.nan if summary[key] is None else summary[key] for summary in summaries])
+
+
+def match_shade_data(trees, storage, tile_id, year, batch_size=100, max_fetch_workers=8):
+    # Only batch_size CSV files are held in memory at once, the summaries go straight into trees.shade
+    for start in range(0, len(trees), batch_size):
+        csv_keys = [storage.shade_csv_key(tile_id, year, tree_id) for tree_id in trees.tree_count_id[start:start + batch_size]]
+        csv_contents = fetch_objects(storage, csv_keys, max_fetch_workers)
+        aggregate_shade_batch(trees, start, csv_contents, year)
+        del csv_contents
+    return trees
+
+
+def create_rtree_index(geojson_data):
+    idx = index.Index()
+    for pos, feature in enumerate(geojson_data['features']):
+        polygon = shape(feature['geometry'])
+        idx.insert(pos, polygon.bounds)
+    return idx
+
+
+@instrument_stage
+def match_json_with_geojson_boundary(trees, geojson_path):
+    with open(geojson_path) as f:
+        geojson_data = json.load(f)
+    idx = create_rtree_index(geojson_data)
+    polygons = [shape(feature['geometry']) for feature in geojson_data['features']]
+    # borough position per tree, -1 outside every borough
+    boroughs = np.full(len(trees), -1, dtype=np.int64)
+    for i, (lon, lat) in enumerate(zip(trees.longitude, trees.latitude)):
+        point = Point(lon, lat)
+        for pos in idx.intersection((lon, lat)):
+            if polygons[pos].contains(point):
+                boroughs[i] = pos
+                break
+    # the trailing None is what position -1 picks up
+    for field in ('boro_code', 'boro_name'):
+        values = np.array([feature['properties'][field] for feature in geojson_data['features']] + [None], dtype=object)
+        setattr(trees, field, pd.Categorical(values[boroughs]))
+    return trees
+
+
+def get_tile_bounds(trees, y_buffer_distance, x_buffer_distance):
+    if not len(trees):
+        return None
+    return box(trees.longitude.min() - x_buffer_distance, trees.latitude.min() - y_buffer_distance,
+               trees.longitude.max() + x_buffer_distance, trees.latitude.max() + y_buffer_distance)
+
+
+@instrument_stage
+def load_all_geojson_files(folder, processes=None):
+    # borough files parsed and validated in parallel, features missing an output property are
+    # dropped with a per-file report; see census_store.py
+    paths = sorted(os.path.join(folder, file) for file in os.listdir(folder) if file.endswith('.geojson'))
+    required = [census_key for _, census_key in CENSUS_OUTPUT_FIELDS if census_key is not None]
+    return load_census_files(paths, required, processes)
+
+
+@instrument_stage
+def filter_geojson_data(geojson_data, tile_bounds):
+    # census trees strictly inside the tile bounds; census_rows is their position in the
+    # city-wide census of this run, for the properties
+    points = geojson_data['points']
+    if not len(points):
+        return None
+    census_rows = shapely.contains_xy(tile_bounds, points[:, 0], points[:, 1]).nonzero()[0]
+    if not len(census_rows):
+        return None
+    return {'points': points[census_rows], 'census_rows': census_rows, 'properties': geojson_data['properties']}
+
+
+# calculate the average dbh
+def get_avg_dbh(filter_geojson_data):
+    if filter_geojson_data is None or "census_rows" not in filter_geojson_data:
+        logging.info("filter_geojson_data is None or missing features")
+        return None
+    sum_dbh = 0
+    tree_dbh = filter_geojson_data["properties"].column("tree_dbh", filter_geojson_data["census_rows"])
+    for dbh in tree_dbh:
+        if dbh:
+            sum_dbh += dbh
+    return sum_dbh / len(tree_dbh)
+
+
+def distance_in_feet(distance, unit='ft'):
+    if distance is None:
+        return None
+    if unit in ('ft', 'feet'):
+        return distance
+    if unit in ('m', 'metres', 'meters'):
+        return distance * FEET_PER_METRE
+    raise ValueError(f"Unknown distance unit {unit}, expected 'ft' or 'm'")
+
+
+def project_lonlat(lonlat):
+    # One vectorized transform for a whole batch of [lon, lat] pairs
+    lonlat = np.asarray(lonlat, dtype=float).reshape(-1, 2)
+    x, y = to_match_crs.transform(lonlat[:, 0], lonlat[:, 1])
+    return np.column_stack([x, y])
+
+
+@instrument_stage
+def construct_nearest_neighbors(data):
+    if not len(data['points']):
+        return None
+    return cKDTree(project_lonlat(data['points'][:, :2]))
+
+
+@instrument_stage
+def match_json_to_geojson(trees, geojson_data, neighbors, n_candidates=1, max_match_distance=None):
+    # Distances are in feet; max_match_distance prunes candidates inside the KD-tree query,
+    # and a LiDAR tree without any census tree in range gets no match at all
+    if not len(trees):
+        return trees
+    # Query all trees of the tile at once; with n_candidates > 1 the k nearest census trees
+    # are kept per LiDAR tree as the candidate graph for the one-to-one assignment
+    points = project_lonlat(trees.lonlat())
+    n_census = len(geojson_data['census_rows'])
+    # the optimal mode needs the candidate arrays even when the tile has a single census tree
+    keep_candidates = n_candidates > 1
+    n_candidates = min(n_candidates, n_census)
+    distance_upper_bound = np.inf if max_match_distance is None else max_match_distance
+    distances, indices = neighbors.query(points, k=n_candidates, distance_upper_bound=distance_upper_bound)
+    distances = distances.reshape(len(points), n_candidates)
+    indices = indices.reshape(len(points), n_candidates)
+    found = indices[:, 0] < n_census
+    trees.census_index = np.where(found, indices[:, 0], -1)
+    trees.distance = np.where(found, distances[:, 0], np.nan)
+    trees.matched = np.zeros(len(trees), dtype=bool)
+    if keep_candidates:
+        trees.candidate_indices = indices
+        trees.candidate_distances = distances
+    return trees
+
+
+def assign_one_to_one(trees, geojson_data, max_match_distance=None):
+    # Minimum-cost one-to-one assignment on the sparse k-nearest candidate graph. Every LiDAR
+    # tree also gets a private "unmatched" column costing max_match_distance, so the solver
+    # trades a long match for leaving the tree unmatched and a full matching always exists.
+    n_lidar = len(trees)
+    n_census = len(geojson_data['census_rows'])
+    candidate_indices = trees.candidate_indices
+    candidate_distances = trees.candidate_distances
+    rows = np.repeat(np.arange(n_lidar), candidate_indices.shape[1])
+    cols = candidate_indices.ravel()
+    weights = candidate_distances.ravel()
+    # Candidates beyond the distance cap come back from the KD-tree as index n_census
+    keep = cols < n_census
+    rows, cols, weights = rows[keep], cols[keep], weights[keep]
+    if max_match_distance is not None:
+        unmatched_cost = max_match_distance
+    else:
+        unmatched_cost = 2 * weights.max() if len(weights) else 1.0
+    # Shift all costs off zero, a zero-weight entry would be read as a missing edge
+    min_weight = max(unmatched_cost, 1.0) * 1e-9
+    graph = csr_matrix(
+        (np.concatenate([weights, np.full(n_lidar, unmatched_cost)]) + min_weight,
+         (np.concatenate([rows, np.arange(n_lidar)]), np.concatenate([cols, n_census + np.arange(n_lidar)]))),
+        shape=(n_lidar, n_census + n_lidar))
+    _, assigned_cols = min_weight_full_bipartite_matching(graph)
+
+    # trees left unmatched keep the distance to their nearest candidate, as in 'nearest' mode
+    assigned = assigned_cols < n_census
+    candidate_position = (candidate_indices == assigned_cols[:, None]).argmax(axis=1)
+    trees.census_index = np.where(assigned, assigned_cols, -1)
+    trees.distance = np.where(assigned, candidate_distances[np.arange(n_lidar), candidate_position], trees.distance)
+    trees.matched = assigned
+    return trees
+
+
+@instrument_stage
+def post_process_matched_data(trees, match_mode='nearest', geojson_data=None, max_match_distance=None):
+    # 'nearest' keeps the closest LiDAR tree per census tree_id and unmatches the rest,
+    # 'optimal' solves a one-to-one assignment over the candidate graph of match_json_to_geojson
+    if match_mode == 'optimal':
+        return assign_one_to_one(trees, geojson_data, max_match_distance)
+    # Find the nearest match for each tree_id, the first tree wins a tie
+    positions = (trees.census_index >= 0).nonzero()[0]
+    census_ids = geojson_data['properties'].column('tree_id', geojson_data['census_rows'][trees.census_index[positions]])
+    groups, _ = pd.factorize(pd.Series(census_ids, dtype=object))
+    order = np.lexsort((positions, trees.distance[positions], groups))
+    first_in_group = np.ones(len(order), dtype=bool)
+    first_in_group[1:] = groups[order][1:] != groups[order][:-1]
+    nearest_count_id = np.empty(groups.max() + 1 if len(groups) else 0, dtype=trees.tree_count_id.dtype)
+    nearest_count_id[groups[order][first_in_group]] = trees.tree_count_id[positions[order][first_in_group]]
+
+    # the census match is dropped for every other tree, which keeps its predicted location
+    trees.matched = np.zeros(len(trees), dtype=bool)
+    trees.matched[positions] = trees.tree_count_id[positions] == nearest_count_id[groups]
+    trees.census_index = np.where(trees.matched, trees.census_index, -1)
+    return trees
+
+
+def save_census_claims(output_dir, tile_id, trees, geojson_data=None):
+    # Claims of this tile for the city-wide seam reconciliation, by census tree_id since row
+    # positions change whenever the census is reloaded
+    claimed = trees.matched.nonzero()[0]
+    census_ids = []
+    if geojson_data and len(claimed):
+        census_ids = geojson_data['properties'].column('tree_id', geojson_data['census_rows'][trees.census_index[claimed]])
+    save_tile_claims(os.path.join(output_dir, 'census_claims'), tile_id, trees.tree_count_id[claimed],
+                     census_ids, trees.distance[claimed],
+                     trees.longitude[claimed], trees.latitude[claimed])
+
+
+def calculate_canopy_radius(tree_dbh):
+    # works on a single dbh or an array of them
+    tree_dbh_ft = tree_dbh / 12
+    tree_dbh_m = tree_dbh_ft / 3.28
+    trunk_area_sq_m = math.pi * ((tree_dbh_m / 2) ** 2)
+    canopy_diameter_m = 7 + 28.2 * trunk_area_sq_m
+    canopy_radius_m = canopy_diameter_m / 2
+    return canopy_radius_m
+
+
+CENSUS_OUTPUT_FIELDS = [
+    # output property, census property
+    ('Census_id', 'tree_id'),
+    ('Census Latitude', 'Latitude'),
+    ('Census Longitude', 'longitude'),
+    ('Spc_latin', 'spc_latin'),
+    ('Spc_common', 'spc_common'),
+    ('Tree_dbh', 'tree_dbh'),
+    ('Canopy_radius', None), # calculate the canopy radius in meters
+    ('Curb_loc', 'curb_loc'),
+    ('Status', 'status'),
+    ('Health', 'health'),
+    ('Address', 'address'),
+    ('Zipcode', 'zipcode'),
+    ('CensusBoroName', 'boroname')
+]
+
+
+def census_column(values, matched):
+    # object column with None for trees without a census match
+    column = np.full(len(matched), None, dtype=object)
+    column[matched] = values
+    return column
+
+
+@instrument_stage
+def construct_new_geojson(trees, geojson_data=None, avg_canopy_radius=None):
+    # Builds the output column by column from the tile's arrays. With geojson_data None there is
+    # no street tree in the tile and every census column stays empty.
+    if not len(trees):
+        logging.error("No features to concatenate")
+        return None
+    n = len(trees)
+    matched = trees.matched
+    longitude, latitude = trees.longitude.copy(), trees.latitude.copy()
+    matched_rows = np.array([], dtype=np.int64)
+    if geojson_data is not None:
+        # census properties are only decoded for the matched rows
+        census = geojson_data['properties']
+        matched_rows = geojson_data['census_rows'][trees.census_index[matched]]
+        # a matched tree moves onto its census location
+        if len(matched_rows):
+            census_points = geojson_data['points'][trees.census_index[matched], :2].astype(float)
+            longitude[matched], latitude[matched] = census_points[:, 0], census_points[:, 1]
+
+    columns = {
+        # deteted tree data - json properties
+        'Tree_CountID': trees.tree_count_id,
+        "Tile_id": np.full(n, trees.tile_id, dtype=object),
+        "Recorded Year": trees.recorded_year,
+        "TopofCanopyHeight": trees.foliage_height,
+        "CanopyVolume": trees.canopy_volume,
+        "CanopyArea": trees.canopy_area,
+        "InPark": trees.in_park,
+        "GroundHeight": trees.ground_z,
+        "FoliageHeight": trees.foliage_height,
+        "BoroName": trees.boro_name,
+        # shdading data
+        **{key: trees.shade.get(key, np.full(n, np.nan)) for key in SHADE_KEYS},
+        # matched data
+        "Predicted Latitude": latitude,
+        "Predicted Longitude": longitude,
+    }
+    if geojson_data is None:
+        columns.update({key: np.full(n, None, dtype=object)
+                        for key in ['Distance_to_census_location', 'isNearest', 'hasTreeCensusID']})
+    else:
+        columns.update({
+            'Distance_to_census_location': trees.distance,
+            'isNearest': matched,
+            'hasTreeCensusID': matched
+        })
+    for output_key, census_key in CENSUS_OUTPUT_FIELDS:
+        if census_key is not None:
+            values = census.column(census_key, matched_rows) if geojson_data is not None else []
+            columns[output_key] = census_column(values, matched)
+            continue
+        if geojson_data is None:
+            columns[output_key] = np.full(n, None, dtype=object)
+            continue
+        # trees without a census match get the tile's average canopy radius
+        radius = np.full(n, avg_canopy_radius, dtype=float)
+        radius[matched] = calculate_canopy_radius(np.array(census.column('tree_dbh', matched_rows), dtype=float))
+        columns[output_key] = radius
+    return gpd.GeoDataFrame(columns, geometry=gpd.points_from_xy(longitude, latitude))
+
+
+@instrument_stage
+def save_new_geojson(new_geojson, output_folder, tile_id):
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    output_path = os.path.join(output_folder, f'NewMatchedShadingTrees_{tile_id}.geojson')
+    new_geojson.to_file(output_path, driver='GeoJSON')
+    return output_path
+
+
+def match_tile(trees, all_geojson, x_buffer_distance, y_buffer_distance, match_mode='nearest', max_match_distance=None):
+    # census filter, matching and the output GeoDataFrame of one tile whose trees have their
+    # shade and borough; shared by process_tile and the stage runner in async_pipeline.py
+    tile_bounds = get_tile_bounds(trees, x_buffer_distance, y_buffer_distance)
+    filtered_geojson_data = filter_geojson_data(all_geojson, tile_bounds)
+    set_tile_metric('census_candidates', len(filtered_geojson_data['census_rows']) if filtered_geojson_data else 0)
+    if filtered_geojson_data == None: # there is no street tree in the given tile
+        # no census dbh to average either, the canopy radius stays empty
+        new_geojson = construct_new_geojson(trees)
+    else:
+        avg_dbh = get_avg_dbh(filtered_geojson_data)
+        avg_canopy_radius = calculate_canopy_radius(avg_dbh)
+        neighbors = construct_nearest_neighbors(filtered_geojson_data)
+        n_candidates = MATCH_CANDIDATES if match_mode == 'optimal' else 1
+        trees = match_json_to_geojson(trees, filtered_geojson_data, neighbors, n_candidates, max_match_distance)
+        trees = post_process_matched_data(trees, match_mode, filtered_geojson_data, max_match_distance)
+        set_tile_metric('matched', int(trees.matched.sum()))
+        new_geojson = construct_new_geojson(trees, filtered_geojson_data, avg_canopy_radius)
+    return {'trees': trees, 'census': filtered_geojson_data, 'tile_bounds': tile_bounds, 'new_geojson': new_geojson}
+
+
+def pipeline_code_version(year, x_buffer_distance, y_buffer_distance, match_mode, max_match_distance_ft):
+    config = {
+        'year': year,
+        'x_buffer_distance': x_buffer_distance,
+        'y_buffer_distance': y_buffer_distance,
+        'match_mode': match_mode,
+        'max_match_distance_ft': max_match_distance_ft,
+        'shade_windows': SHADE_WINDOWS
+    }
+    return code_version(PIPELINE_SOURCES, config)
+
+
+def tile_fingerprint(year, all_geojson, boundary_path, x_buffer_distance, y_buffer_distance, match_mode,
+                     max_match_distance, tile_bounds, s3_inputs):
+    return {
+        'code': pipeline_code_version(year, x_buffer_distance, y_buffer_distance, match_mode, max_match_distance),
+        'boundary': file_sha256(boundary_path),
+        'census_shard': census_shard_hash(all_geojson, tile_bounds.bounds),
+        's3_inputs': s3_inputs
+    }
+
+
+def save_tile_outputs(output_dir, tile_id, matched_tile, fingerprint):
+    save_census_claims(output_dir, tile_id, matched_tile['trees'], matched_tile['census'])
+    output_path = save_new_geojson(matched_tile['new_geojson'], output_dir, tile_id)
+    set_tile_metric('output_bytes', os.path.getsize(output_path))
+    save_fingerprint(output_dir, tile_id, fingerprint, matched_tile['tile_bounds'].bounds)
+    return output_path
+
+
+def process_tile(storage, tile_id, year, all_geojson, boundary_path, x_buffer_distance, y_buffer_distance, output_dir,
+                 batch_size=100, max_fetch_workers=8, match_mode='nearest', max_match_distance=None, distance_unit='ft'):
+    start_tile_metrics(tile_id)
+    max_match_distance = distance_in_feet(max_match_distance, distance_unit)
+    status = 'error'
+    try:
+        logging.info(f"Start processing tile_id {tile_id}")
+        tqdm.write(f"Start processing tile_id {tile_id}")
+        # fingerprint the inputs before reading them, a concurrent regeneration then shows up as stale
+        s3_inputs = s3_inputs_hash(storage, tile_id, year)
+        trees = load_tree_jsons(storage, tile_id, year)
+        if trees is None:
+            status = 'no_json'
+            return None
+        set_tile_metric('trees_loaded', len(trees))
+        trees = match_shade_data(trees, storage, tile_id, year, batch_size, max_fetch_workers)
+        trees = match_json_with_geojson_boundary(trees, boundary_path)
+        set_tile_metric('tree_batch_bytes', trees.nbytes())
+        matched_tile = match_tile(trees, all_geojson, x_buffer_distance, y_buffer_distance, match_mode, max_match_distance)
+        fingerprint = tile_fingerprint(year, all_geojson, boundary_path, x_buffer_distance, y_buffer_distance,
+                                       match_mode, max_match_distance, matched_tile['tile_bounds'], s3_inputs)
+        save_tile_outputs(output_dir, tile_id, matched_tile, fingerprint)
+        tqdm.write(f"New GeoJSON for tile_id {tile_id} saved")
+        logging.info(f"New GeoJSON for tile_id {tile_id} saved")
+        # After processing the tile, manually invoke GC to clean up
+        gc.collect()
+        status = 'done'
+        return True
+    except MemoryError:
+        # Let the supervisor see the OOM so it can retry with smaller batches
+        logging.error(f"Out of memory processing tile_id: {tile_id}", exc_info=True)
+        status = 'memory'
+        gc.collect()
+        raise
+    except Exception as e:
+        logging.error(f"Error processing tile_id: {tile_id}. Error: {e}", exc_info=True)
+        # Clean up memory after an error to prevent memory leaks
+        gc.collect()
+        return False
+    finally:
+        # one row per tile attempt in the performance table, see tile_report.py
+        finish_tile_metrics(os.path.join(output_dir, 'tile_performance.jsonl'), status)
+
+
+def register_census_claims(census_claims, claims_dir, tile_key):
+    tile_claims = load_tile_claims(claims_dir, tile_key)
+    if tile_claims is None:
+        return
+    conflicts = register_tile_claims(census_claims, tile_key, tile_claims)
+    if conflicts:
+        logging.info(f"Tile {tile_key} claims {conflicts} census trees already matched in another tile")
+
+
+def is_tile_processed(tile_key, output_dir):
+    # Check if a file corresponding to the tile_key exists in output_dir
+    output_file_path = os.path.join(output_dir, f'NewMatchedShadingTrees_{tile_key}.geojson')
+    return os.path.exists(output_file_path)
+
+
+def run_tiles(storage, tile_keys, year, all_geojson, boundary_path, x_buffer_distance, y_buffer_distance, output_dir,
+              skip_processed=False, **kwargs):
+    # the plain tile loop of the local and test entry points; IndexMatch_HL_aws1 adds the
+    # supervision, scheduling and seam reconciliation of the full runs
+    processed_count = 0
+    try:
+        with tqdm(total=len(tile_keys), desc="Processing Tiles") as progress_bar:
+            for tile_key in tile_keys:
+                if not (skip_processed and is_tile_processed(tile_key, output_dir)):
+                    process_tile(storage, tile_key, year, all_geojson, boundary_path, x_buffer_distance,
+                                 y_buffer_distance, output_dir, **kwargs)
+                    processed_count += 1
+                progress_bar.update(1)
+    except Exception as e:
+        logging.error("Error occurred during the main processing", exc_info=True)
+    logging.info("SCRIPT_END: Processing complete.")
+    return processed_count
@@ -0,0 +1,123 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+
+# City-wide reconciliation of census matches at tile seams. Every tile filters the census with
+# its own buffered box, so a census tree near a seam can be claimed by LiDAR trees of two tiles.
+# Each finished tile saves its claims (census tree_id, distance, LiDAR tree), the run keeps an
+# index keyed by census tree_id holding the best claim so far, and resolve_seam_conflicts settles
+# every census tree in one vectorized pass. Only the losing rows are emitted as corrections; tile
+# outputs are not reprocessed. Claims name census trees by tree_id, not by their position in
+# load_all_geojson_files, so claims saved against an older or reordered census stay valid.
+
+CLAIM_FIELDS = ['tile_id', 'tree_id', 'census_id', 'distance', 'longitude', 'latitude']
+
+
+def init_census_claims():
+    return {
+        # census_id -> (distance, tile_id, tree_id) of the best claim so far
+        'best': {},
+        # latest claims per tile, a re-processed tile replaces its earlier claims
+        'tile_claims': {}
+    }
+
+
+def tile_claims_path(claims_dir, tile_id):
+    return os.path.join(claims_dir, f'census_claims_{tile_id}.npz')
+
+
+def save_tile_claims(claims_dir, tile_id, tree_ids, census_ids, distances, longitudes, latitudes):
+    if not os.path.exists(claims_dir):
+        os.makedirs(claims_dir)
+    np.savez(tile_claims_path(claims_dir, tile_id),
+             tile_id=np.full(len(tree_ids), int(tile_id), dtype=np.int64),
+             tree_id=np.asarray(tree_ids, dtype=np.int64),
+             census_id=np.asarray([str(census_id) for census_id in census_ids], dtype=str),
+             distance=np.asarray(distances, dtype=float),
+             longitude=np.asarray(longitudes, dtype=float),
+             latitude=np.asarray(latitudes, dtype=float))
+
+
+def load_tile_claims(claims_dir, tile_id):
+    path = tile_claims_path(claims_dir, tile_id)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if 'census_id' not in data.files:
+            # saved by census row before claims were keyed by tree_id; the tile's code
+            # fingerprint is stale as well, so its rerun writes them again
+            logging.warning(f"Tile {tile_id}: census claims without census ids ignored")
+            return None
+        return {field: data[field] for field in CLAIM_FIELDS}
+
+
+def register_tile_claims(claims, tile_id, tile_claims):
+    # Fold one finished tile into the running index, returns how many of its claims hit
+    # a census tree already claimed by another tile
+    claims['tile_claims'][int(tile_id)] = tile_claims
+    best = claims['best']
+    conflicts = 0
+    for census_id, distance, tree_id in zip(tile_claims['census_id'].tolist(), tile_claims['distance'].tolist(),
+                                            tile_claims['tree_id'].tolist()):
+        previous = best.get(census_id)
+        if previous is not None and previous[1] != int(tile_id):
+            conflicts += 1
+        if previous is None or distance < previous[0]:
+            best[census_id] = (distance, int(tile_id), tree_id)
+    return conflicts
+
+
+def resolve_seam_conflicts(claims):
+    # One pass over all claims: per census tree the closest claim wins, ties go to the
+    # lower tile id so the result does not depend on the order tiles finished in
+    tile_claims = [c for c in claims['tile_claims'].values() if len(c['census_id'])]
+    if not tile_claims:
+        return pd.DataFrame(columns=CLAIM_FIELDS + ['winner_tile_id', 'winner_tree_id'])
+    all_claims = {field: np.concatenate([c[field] for c in tile_claims]) for field in CLAIM_FIELDS}
+    census_codes, census_ids = pd.factorize(all_claims['census_id'])
+    order = np.lexsort((all_claims['tree_id'], all_claims['tile_id'], all_claims['distance'], census_codes))
+    sorted_codes = census_codes[order]
+    is_winner = np.ones(len(order), dtype=bool)
+    is_winner[1:] = sorted_codes[1:] != sorted_codes[:-1]
+
+    winners = order[is_winner]
+    winner_tile = np.empty(len(census_ids), dtype=np.int64)
+    winner_tree = np.empty(len(census_ids), dtype=np.int64)
+    winner_tile[census_codes[winners]] = all_claims['tile_id'][winners]
+    winner_tree[census_codes[winners]] = all_claims['tree_id'][winners]
+    claims['best'] = {census_id: (distance, tile_id, tree_id) for census_id, distance, tile_id, tree_id in zip(
+        all_claims['census_id'][winners].tolist(), all_claims['distance'][winners].tolist(),
+        all_claims['tile_id'][winners].tolist(), all_claims['tree_id'][winners].tolist())}
+
+    losers = order[~is_winner]
+    corrections = pd.DataFrame({field: all_claims[field][losers] for field in CLAIM_FIELDS})
+    corrections['winner_tile_id'] = winner_tile[census_codes[losers]]
+    corrections['winner_tree_id'] = winner_tree[census_codes[losers]]
+    return corrections.sort_values(['tile_id', 'tree_id']).reset_index(drop=True)
+
+
+def corrected_rows(corrections):
+    # The losing LiDAR trees lose their census match, the same way post_process_matched_data
+    # unmatches a LiDAR tree that is not the nearest one within a tile
+    return pd.DataFrame({
+        'Tile_id': corrections['tile_id'].astype(str),
+        'Tree_CountID': corrections['tree_id'],
+        'Predicted Latitude': corrections['latitude'],
+        'Predicted Longitude': corrections['longitude'],
+        'isNearest': False,
+        'hasTreeCensusID': False,
+        'Census_id': None,
+        'Census Latitude': None,
+        'Census Longitude': None,
+        'Seam_winner_Tile_id': corrections['winner_tile_id'].astype(str),
+        'Seam_winner_Tree_CountID': corrections['winner_tree_id'],
+    })
+
+
+def write_seam_corrections(claims, output_path):
+    corrections = resolve_seam_conflicts(claims)
+    rows = corrected_rows(corrections)
+    rows.to_csv(output_path, index=False)
+    logging.info(f"Seam reconciliation: {len(rows)} corrected rows written to {output_path}")
+    return rows
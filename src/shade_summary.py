@@ -0,0 +1,153 @@
+import os
+import re
+import json
+import logging
+import argparse
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from shade_windows import SHADE_WINDOWS, evaluate_shade_windows
+
+# Per-tree shade summaries of local tile folders, consolidated into one table for all tiles.
+# Each tile's JSON and CSV folders are listed once with os.scandir and paired by tree id, instead
+# of probing os.path.exists for every id between the smallest and largest one. Tiles run in a
+# process pool and the shade statistics come from shade_windows, the same windows as the
+# matching pipeline.
+#
+#   python src/shade_summary.py Data/2017 --year 2017 --layout treecluster --output SummarizedShadeStatistics_2017.parquet
+
+CSV_NAME = re.compile(r'^Shading_Metric_(\d+)_Tree_ID_(\d+)\.csv$')
+
+
+def _treecluster_fields(data):
+    location = data["PredictedTreeLocation"]
+    return {
+        "Tree_CountID": data["Tree_CountId"],
+        "Predicted Latitude": location["Latitude"],
+        "Predicted Longitude": location["Longitude"],
+        "Recorded Year": data["RecordedYear"],
+        "TopofCanopyHeight": data["TreeFoliageHeight"],
+        "CanopyVolume": data["ConvexHull_TreeDict"]["volume"],
+        "CanopyArea": data["ConvexHull_TreeDict"]["area"],
+    }
+
+
+def _shading_data_fields(data):
+    return {"TreeID": data["TreeID"], "TreeLocation": data["TreeLocation"], "ShadeYear": data["ShadeYear"]}
+
+
+# folder and file names of the two local layouts, and the per-tree fields kept from the JSON
+LAYOUTS = {
+    # LiDAR exports: {tile}/JSON_TreeData_{tile}/{tile}_{year}_ID_{id}_TreeCluster.json
+    'treecluster': {
+        'json_dir': 'JSON_TreeData_{tile_id}',
+        'json_name': re.compile(r'^(\d+)_\d+_ID_(\d+)_TreeCluster\.json$'),
+        'fields': _treecluster_fields,
+        'rename': {},
+    },
+    # early sample data: {tile}/ShadingData_{tile}/Shading_Data_{tile}_Tree_ID_{id}.json
+    'shading_data': {
+        'json_dir': 'ShadingData_{tile_id}',
+        'json_name': re.compile(r'^Shading_Data_(\d+)_Tree_ID_(\d+)\.json$'),
+        'fields': _shading_data_fields,
+        # this layout called the 11:00-15:00 window a weighted average
+        'rename': {
+            'HighTempHours_Avg_ShadedArea': 'WeightedAvg_ShadedArea',
+            'HighTempHours_Avg_ShadedArea_Ground': 'WeightedAvg_ShadedArea_Ground',
+            'HighTempHours_Avg_Perc_Canopy_StreetShade': 'WeightedAvg_PercCanopy_StreetShade',
+            'HighTempHours_Avg_Perc_Canopy_InShade': 'WeightedAvg_PercCanopy_InShade',
+        },
+    },
+}
+
+
+def scan_ids(directory, pattern):
+    # {tree_id: path} from one scandir; a missing folder is an empty one
+    paths = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                match = pattern.match(entry.name)
+                if match:
+                    paths[int(match.group(2))] = entry.path
+    except FileNotFoundError:
+        pass
+    return paths
+
+
+def pair_tile_files(tile_dir, tile_id, layout):
+    json_paths = scan_ids(os.path.join(tile_dir, layout['json_dir'].format(tile_id=tile_id)), layout['json_name'])
+    csv_paths = scan_ids(os.path.join(tile_dir, f"Shading_Metrics_{tile_id}"), CSV_NAME)
+    paired = sorted(json_paths.keys() & csv_paths.keys())
+    return ([(tree_id, json_paths[tree_id], csv_paths[tree_id]) for tree_id in paired],
+            len(json_paths.keys() - csv_paths.keys()), len(csv_paths.keys() - json_paths.keys()))
+
+
+def summarize_tile(tile_dir, tile_id, year, layout_name):
+    layout = LAYOUTS[layout_name]
+    pairs, json_only, csv_only = pair_tile_files(tile_dir, tile_id, layout)
+    rows = []
+    for tree_id, json_path, csv_path in pairs:
+        with open(json_path, 'r') as f:
+            row = layout['fields'](json.load(f))
+        with open(csv_path, 'rb') as f:
+            shade = evaluate_shade_windows(f.read(), year, SHADE_WINDOWS)
+        row.update({layout['rename'].get(key, key): value for key, value in shade.items()})
+        rows.append(row)
+    return {'tile_id': tile_id, 'rows': rows, 'json_only': json_only, 'csv_only': csv_only}
+
+
+def summarize_tiles(root_dir, year, layout_name='treecluster', processes=None):
+    # one scandir of root_dir for the tile folders, then one task per tile
+    with os.scandir(root_dir) as entries:
+        tile_dirs = {entry.name: entry.path for entry in entries if entry.is_dir() and entry.name.isdigit()}
+    frames = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(summarize_tile, tile_dir, tile_id, str(year), layout_name)
+                   for tile_id, tile_dir in tile_dirs.items()]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Summarizing tiles"):
+            result = future.result()
+            if result['json_only'] or result['csv_only']:
+                logging.warning(f"Tile {result['tile_id']}: {result['json_only']} trees without a CSV, "
+                                f"{result['csv_only']} CSVs without a JSON")
+            if result['rows']:
+                frame = pd.DataFrame(result['rows'])
+                frame.insert(0, 'Tile_id', result['tile_id'])
+                frames.append(frame)
+    if not frames:
+        return pd.DataFrame()
+    # tiles in id order, trees already in id order within each tile
+    frames.sort(key=lambda frame: (len(frame['Tile_id'].iat[0]), frame['Tile_id'].iat[0]))
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_summary(summary, output_path):
+    # parquet when an engine is installed, otherwise the same table as one CSV
+    if output_path.endswith('.parquet'):
+        try:
+            summary.to_parquet(output_path, index=False)
+            return output_path
+        except ImportError:
+            output_path = output_path[:-len('.parquet')] + '.csv'
+            logging.warning(f"No parquet engine installed, writing {output_path} instead")
+    summary.to_csv(output_path, index=False)
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize tree shading for every tile folder into one table.')
+    parser.add_argument('root_dir', help='folder with one subfolder per tile')
+    parser.add_argument('--year', default='2017')
+    parser.add_argument('--layout', default='treecluster', choices=sorted(LAYOUTS))
+    parser.add_argument('--output', default=None, help='.parquet or .csv, defaults to SummarizedShadeStatistics_{year}.parquet')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    summary = summarize_tiles(args.root_dir, args.year, args.layout, args.processes)
+    output_path = write_summary(summary, args.output or f"SummarizedShadeStatistics_{args.year}.parquet")
+    print(f"{len(summary)} trees from {summary['Tile_id'].nunique() if len(summary) else 0} tiles saved to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import io
+import warnings
+import numpy as np
+import pandas as pd
+
+# Declarative analysis windows over a tree's Shading_Metrics CSV. A window is a dict:
+#   date     - 'YYYY-MM-DD', may use {year}; None keeps every day in the CSV
+#   hours    - (first, last) hour of day, both inclusive; None keeps every hour
+#   rows     - 'all', or 'max_sun_amplitude' for the rows at the highest sun in the window
+#   reducer  - 'mean', 'median', 'min', 'max', 'sum', or 'weighted_mean' together with 'weight'
+#   outputs  - {output key: CSV column}
+# evaluate_shade_windows parses a CSV once and evaluates every window on it, so adding a
+# window adds a reduction per tree but no extra download or parse.
+
+SHADE_WINDOWS = [
+    {
+        # relative noon: the time step with the highest sun on the solstice
+        'date': '{year}-06-21', 'hours': None, 'rows': 'max_sun_amplitude', 'reducer': 'mean',
+        'outputs': {
+            'TreeShadow_PointCount': 'TreeShadow_PointCount',
+            'RelNoon_ShadedArea': 'Shadow_Area',
+            'RelNoon_ShadedArea_Ground': 'ShadowArea_Ground',
+            'RelNoon_Perc_Canopy_StreetShade': 'Perc_Canopy_StreetShade',
+            'RelNoon_Perc_Canopy_InShade': 'Perc_Canopy_InShade'
+        }
+    },
+    {
+        'date': '{year}-06-21', 'hours': None, 'rows': 'all', 'reducer': 'mean',
+        'outputs': {
+            'DailyAvg_ShadedArea': 'Shadow_Area',
+            'DailyAvg_ShadedArea_Ground': 'ShadowArea_Ground',
+            'DailyAvg_Perc_Canopy_StreetShade': 'Perc_Canopy_StreetShade',
+            'DailyAvg_Perc_Canopy_InShade': 'Perc_Canopy_InShade'
+        }
+    },
+    {
+        'date': '{year}-06-21', 'hours': (11, 15), 'rows': 'all', 'reducer': 'mean',
+        'outputs': {
+            'HighTempHours_Avg_ShadedArea': 'Shadow_Area',
+            'HighTempHours_Avg_ShadedArea_Ground': 'ShadowArea_Ground',
+            'HighTempHours_Avg_Perc_Canopy_StreetShade': 'Perc_Canopy_StreetShade',
+            'HighTempHours_Avg_Perc_Canopy_InShade': 'Perc_Canopy_InShade'
+        }
+    },
+]
+
+REDUCERS = ['mean', 'median', 'min', 'max', 'sum', 'weighted_mean']
+
+
+def window_output_keys(windows):
+    keys = []
+    for window in windows:
+        keys.extend(window['outputs'])
+    return keys
+
+
+def validate_windows(windows):
+    seen = set()
+    for window in windows:
+        if window['reducer'] not in REDUCERS:
+            raise ValueError(f"Unknown shade window reducer {window['reducer']}")
+        if window['reducer'] == 'weighted_mean' and not window.get('weight'):
+            raise ValueError("A weighted_mean shade window needs a 'weight' column")
+        if window.get('rows', 'all') not in ('all', 'max_sun_amplitude'):
+            raise ValueError(f"Unknown shade window rows {window['rows']}")
+        duplicates = seen.intersection(window['outputs'])
+        if duplicates:
+            raise ValueError(f"Shade window outputs defined twice: {sorted(duplicates)}")
+        seen.update(window['outputs'])
+
+
+def required_columns(windows):
+    columns = {'DateTime_ISO'}
+    for window in windows:
+        columns.update(window['outputs'].values())
+        if window.get('rows', 'all') == 'max_sun_amplitude':
+            columns.add('Sun_Amplitude')
+        if window.get('weight'):
+            columns.add(window['weight'])
+    return columns
+
+
+def empty_shade_summary(windows):
+    return {key: None for key in window_output_keys(windows)}
+
+
+def _reduce(values, weights, reducer):
+    # column-wise reductions over a small float matrix that skip missing values like pandas,
+    # plain numpy because the pandas call overhead dominates at ~150 rows per CSV
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=0)
+    filled = np.where(valid, values, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if reducer == 'mean':
+            return filled.sum(axis=0) / count
+        if reducer == 'sum':
+            return filled.sum(axis=0)
+        if reducer == 'weighted_mean':
+            return (filled * weights[:, None]).sum(axis=0) / (valid * weights[:, None]).sum(axis=0)
+        if reducer == 'min':
+            return np.where(count > 0, np.where(valid, values, np.inf).min(axis=0, initial=np.inf), np.nan)
+        if reducer == 'max':
+            return np.where(count > 0, np.where(valid, values, -np.inf).max(axis=0, initial=-np.inf), np.nan)
+    # median
+    if len(values) == 0:
+        return np.full(values.shape[1], np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(values, axis=0)
+
+
+def evaluate_shade_windows(csv_content, year, windows=SHADE_WINDOWS):
+    if csv_content is None:
+        return empty_shade_summary(windows)
+    columns = required_columns(windows)
+    df = pd.read_csv(io.BytesIO(csv_content), usecols=lambda column: column in columns)
+    moments = pd.to_datetime(df['DateTime_ISO'])
+    if moments.dt.tz is not None:
+        moments = moments.dt.tz_localize(None)
+    days = moments.to_numpy().astype('datetime64[D]')
+    hours = moments.dt.hour.to_numpy()
+
+    value_columns = list(dict.fromkeys(column for window in windows for column in window['outputs'].values()))
+    values = df[value_columns].to_numpy(dtype=float)
+    column_index = {column: i for i, column in enumerate(value_columns)}
+
+    # the date and hour masks are shared by every window that uses the same filter
+    masks = {}
+    summary = {}
+    for window in windows:
+        date = window['date'].format(year=year) if window.get('date') else None
+        hour_range = tuple(window['hours']) if window.get('hours') else None
+        mask_key = (date, hour_range)
+        if mask_key not in masks:
+            mask = np.ones(len(df), dtype=bool)
+            if date:
+                mask &= days == np.datetime64(date)
+            if hour_range:
+                mask &= (hours >= hour_range[0]) & (hours <= hour_range[1])
+            masks[mask_key] = mask
+        mask = masks[mask_key]
+        if window.get('rows', 'all') == 'max_sun_amplitude':
+            amplitude = df['Sun_Amplitude'].to_numpy(dtype=float)
+            if mask.any() and not np.isnan(amplitude[mask]).all():
+                mask = mask & (amplitude == np.nanmax(amplitude[mask]))
+            else:
+                mask = np.zeros(len(df), dtype=bool)
+
+        columns = [column_index[column] for column in window['outputs'].values()]
+        weights = df[window['weight']].to_numpy(dtype=float)[mask] if window.get('weight') else None
+        reduced = _reduce(values[mask][:, columns], weights, window['reducer'])
+        summary.update(zip(window['outputs'], reduced))
+    return summary
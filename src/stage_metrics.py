@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import functools
+import contextlib
+import contextvars
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Opt-in per-stage instrumentation, replacing memory_profiler's @profile and time_it.
+# Disabled unless TREEFOLIO_STAGE_METRICS points at a metrics file (or configure_stage_metrics
+# is called), in which case every instrumented stage appends one JSON line with its wall time,
+# CPU time, peak RSS growth and record count for the current tile.
+#
+# Independently of that, a tile record opened with start_tile_metrics collects per-stage
+# seconds and tile counters (trees loaded, CSVs found, matches ...) and is written as one
+# row of the per-tile performance table by finish_tile_metrics.
+#
+# The current tile lives in a context variable rather than a module global, so the stages of
+# several tiles can run at once (async_pipeline.py) and each row names its own tile. Executor
+# threads and processes do not inherit it; work handed to them runs inside tile_metrics_scope.
+
+_metrics_path = os.environ.get('TREEFOLIO_STAGE_METRICS') or None
+# {'tile_id', 'record', 'start'} of the tile being processed, record is None when only the
+# stage metrics rows are attributed to it
+_current_tile = contextvars.ContextVar('current_tile', default=None)
+
+
+def configure_stage_metrics(metrics_path):
+    # Pass None to switch instrumentation off again
+    global _metrics_path
+    if metrics_path:
+        metrics_dir = os.path.dirname(metrics_path)
+        if metrics_dir and not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+    _metrics_path = metrics_path or None
+
+
+def stage_metrics_enabled():
+    return _metrics_path is not None
+
+
+def start_tile_metrics(tile_id):
+    _current_tile.set({'tile_id': tile_id, 'record': {'tile_id': tile_id, 'stages': {}}, 'start': time.perf_counter()})
+
+
+@contextlib.contextmanager
+def tile_metrics_scope(tile_id):
+    # stage metrics rows inside the block name tile_id, no tile record is collected
+    token = _current_tile.set({'tile_id': tile_id, 'record': None, 'start': None})
+    try:
+        yield
+    finally:
+        _current_tile.reset(token)
+
+
+def current_tile_id():
+    current = _current_tile.get()
+    return None if current is None else current['tile_id']
+
+
+def _tile_record():
+    current = _current_tile.get()
+    return None if current is None else current['record']
+
+
+def add_tile_metric(key, value=1):
+    record = _tile_record()
+    if record is not None:
+        record[key] = record.get(key, 0) + value
+
+
+def set_tile_metric(key, value):
+    record = _tile_record()
+    if record is not None:
+        record[key] = value
+
+
+def add_stage_time(stage_name, seconds):
+    record = _tile_record()
+    if record is not None:
+        stages = record['stages']
+        stages[stage_name] = stages.get(stage_name, 0.0) + seconds
+
+
+def finish_tile_metrics(tile_metrics_path, status):
+    current = _current_tile.get()
+    if current is None or current['record'] is None:
+        return None
+    record = current['record']
+    record['status'] = status
+    record['total_s'] = round(time.perf_counter() - current['start'], 6)
+    record['peak_rss_mb'] = peak_rss_mb()
+    record['stages'] = {name: round(seconds, 6) for name, seconds in record['stages'].items()}
+    record['timestamp'] = time.time()
+    _current_tile.set(None)
+    if tile_metrics_path:
+        append_jsonl(tile_metrics_path, record)
+    return record
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is reported in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def append_jsonl(path, record):
+    # Opened per record so forked tile workers never share a half-flushed buffer
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+def instrument_stage(func):
+    stage_name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _metrics_path is None:
+            if _tile_record() is None:
+                return func(*args, **kwargs)
+            # Only the tile table is being collected, a wall-clock reading is enough
+            wall_start = time.perf_counter()
+            result = func(*args, **kwargs)
+            add_stage_time(stage_name, time.perf_counter() - wall_start)
+            return result
+        rss_before = peak_rss_mb()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = func(*args, **kwargs)
+        wall_time = time.perf_counter() - wall_start
+        cpu_time = time.process_time() - cpu_start
+        rss_after = peak_rss_mb()
+        add_stage_time(stage_name, wall_time)
+        append_jsonl(_metrics_path, {
+            'tile_id': current_tile_id(),
+            'stage': stage_name,
+            'wall_s': round(wall_time, 6),
+            'cpu_s': round(cpu_time, 6),
+            'peak_rss_mb': rss_after,
+            'peak_rss_delta_mb': None if rss_before is None else rss_after - rss_before,
+            'records': len(result) if hasattr(result, '__len__') else None,
+            'timestamp': time.time()
+        })
+        return result
+    return wrapper
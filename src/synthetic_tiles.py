@@ -0,0 +1,252 @@
+import os
+import io
+import json
+import math
+import argparse
+import numpy as np
+import pandas as pd
+
+# Fabricate realistic tiles in the bucket layout the matching scripts read:
+#   {base_prefix}{tile}/{year}/JSON_TreeData_{tile}/{tile}_{year}_ID_{n}_TreeCluster.json
+#   {base_prefix}{tile}/{year}/Shading_Metrics_{tile}/Shading_Metric_{tile}_Tree_ID_{n}.csv
+# plus a census GeoJSON with street trees scattered around the LiDAR trees and a borough
+# boundary covering the area. Files go to a local directory laid out like a fake S3 bucket
+# (see fake_s3.LocalS3Client) or to a real bucket through a boto3 client.
+#
+#   python src/synthetic_tiles.py /tmp/synthetic --tiles 4 --trees 1000
+
+# Roughly one 2500 ft LAS tile in Brooklyn, in degrees
+TILE_ORIGIN = (-73.96, 40.63)
+TILE_SIZE_DEG = (0.0090, 0.0068)
+
+SPECIES = [
+    ('Platanus x acerifolia', 'London planetree'),
+    ('Gleditsia triacanthos var. inermis', 'honeylocust'),
+    ('Pyrus calleryana', 'Callery pear'),
+    ('Quercus palustris', 'pin oak'),
+    ('Tilia cordata', 'littleleaf linden'),
+    ('Styphnolobium japonicum', 'Sophora'),
+    ('Acer platanoides', 'Norway maple'),
+    ('Zelkova serrata', 'Japanese zelkova'),
+]
+HEALTH = ['Good', 'Fair', 'Poor']
+CURB_LOC = ['OnCurb', 'OffsetFromCurb']
+STREETS = ['BEVERLY ROAD', 'BEDFORD AVENUE', 'EAST 28 STREET', 'CHURCH AVENUE', 'FLATBUSH AVENUE', 'OCEAN AVENUE']
+ZIPCODES = [11203, 11210, 11218, 11225, 11226]
+
+SHADE_COLUMNS = ['DateTime_ISO', 'Sun_Amplitude', 'TreeShadow_PointCount', 'Shadow_Area',
+                 'ShadowArea_Ground', 'Perc_Canopy_StreetShade', 'Perc_Canopy_InShade']
+
+
+class LocalWriter:
+    def __init__(self, root, bucket_name):
+        self.bucket_root = os.path.join(root, bucket_name)
+
+    def write(self, key, body):
+        path = os.path.join(self.bucket_root, *key.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb' if isinstance(body, bytes) else 'w') as f:
+            f.write(body)
+
+
+class S3Writer:
+    def __init__(self, s3_client, bucket_name):
+        self.s3 = s3_client
+        self.bucket_name = bucket_name
+
+    def write(self, key, body):
+        self.s3.put_object(Bucket=self.bucket_name, Key=key, Body=body)
+
+
+def tile_origin(tile_index):
+    # Tiles are laid out on a grid of 10 columns going east, then north
+    col, row = tile_index % 10, tile_index // 10
+    return TILE_ORIGIN[0] + col * TILE_SIZE_DEG[0], TILE_ORIGIN[1] + row * TILE_SIZE_DEG[1]
+
+
+def tree_cluster_json(rng, tile_id, year, tree_id, lon, lat, points_per_tree):
+    height = float(rng.uniform(4, 30))
+    ground = float(rng.uniform(2, 40))
+    radius_deg = rng.uniform(1.5, 8) / 111000
+    # Point cloud and hull vertices make the document about as heavy as the real TreeCluster files
+    points = np.column_stack([
+        lon + rng.normal(0, radius_deg, points_per_tree),
+        lat + rng.normal(0, radius_deg, points_per_tree),
+        ground + rng.uniform(0, height, points_per_tree)
+    ]).round(8).tolist()
+    return {
+        'Tree_CountId': tree_id,
+        'Tile_id': tile_id,
+        'RecordedYear': int(year),
+        'TreeFoliageHeight': height,
+        'GroundZValue': ground,
+        'InPark': bool(rng.random() < 0.1),
+        'ClusterCentroid': [lon, lat, ground + height / 2],
+        'PredictedTreeLocation': {'Latitude': lat, 'Longitude': lon},
+        'ConvexHull_TreeDict': {
+            'volume': float(rng.uniform(20, 3000)),
+            'area': float(rng.uniform(10, 800)),
+            'vertices': points[:max(4, points_per_tree // 10)]
+        },
+        'ClusterPoints': points
+    }
+
+
+def shading_metric_csv(rng, year, days, step_minutes):
+    # Sun from 5:30 to 20:30 local time on each day ending with the summer solstice
+    solstice = pd.Timestamp(f'{year}-06-21')
+    times = []
+    for day in range(days - 1, -1, -1):
+        date = solstice - pd.Timedelta(days=day)
+        times.append(pd.date_range(date + pd.Timedelta(hours=5, minutes=30),
+                                   date + pd.Timedelta(hours=20, minutes=30), freq=f'{step_minutes}min'))
+    times = times[0].append(times[1:]) if len(times) > 1 else times[0]
+    hours = times.hour + times.minute / 60
+    amplitude = np.clip(np.sin((hours - 5.5) / 15 * math.pi), 0, None) * 73.5
+    base_area = rng.uniform(20, 250)
+    shadow_area = base_area * (1.6 - amplitude / 73.5) * rng.uniform(0.9, 1.1, len(times))
+    table = pd.DataFrame({
+        'DateTime_ISO': times.strftime('%Y-%m-%dT%H:%M:%S'),
+        'Sun_Amplitude': amplitude.round(4),
+        'TreeShadow_PointCount': rng.integers(100, 4000, len(times)),
+        'Shadow_Area': shadow_area.round(4),
+        'ShadowArea_Ground': (shadow_area * rng.uniform(0.4, 1.0, len(times))).round(4),
+        'Perc_Canopy_StreetShade': rng.uniform(0, 100, len(times)).round(2),
+        'Perc_Canopy_InShade': rng.uniform(0, 20, len(times)).round(2),
+    }, columns=SHADE_COLUMNS)
+    buffer = io.StringIO()
+    table.to_csv(buffer, index=False)
+    return buffer.getvalue()
+
+
+def census_feature(rng, census_id, lon, lat):
+    spc_latin, spc_common = SPECIES[rng.integers(len(SPECIES))]
+    return {
+        'type': 'Feature',
+        'properties': {
+            'tree_id': census_id,
+            'tree_dbh': int(rng.integers(0, 40)),
+            'curb_loc': CURB_LOC[rng.integers(len(CURB_LOC))],
+            'status': 'Alive',
+            'health': HEALTH[rng.integers(len(HEALTH))],
+            'spc_latin': spc_latin,
+            'spc_common': spc_common,
+            'address': f"{int(rng.integers(1, 9999))} {STREETS[rng.integers(len(STREETS))]}",
+            'zipcode': ZIPCODES[rng.integers(len(ZIPCODES))],
+            'boroname': 'Brooklyn',
+            'nta_name': 'Erasmus',
+            'Latitude': lat,
+            'longitude': lon
+        },
+        'geometry': {'type': 'Point', 'coordinates': [lon, lat]}
+    }
+
+
+def generate_tiles(writer, base_prefix, tile_ids, year='2017', trees_per_tile=1000, census_density=0.7,
+                   census_jitter_m=3.0, missing_csv_ratio=0.02, points_per_tree=200, days=3, step_minutes=30,
+                   seed=0):
+    # census_density is the number of census street trees per LiDAR tree, placed within
+    # census_jitter_m of a LiDAR tree (matched) or anywhere in the tile (unmatched clutter)
+    rng = np.random.default_rng(seed)
+    census_features = []
+    census_id = 100000
+    for tile_index, tile_id in enumerate(tile_ids):
+        origin_lon, origin_lat = tile_origin(tile_index)
+        lons = origin_lon + rng.uniform(0, TILE_SIZE_DEG[0], trees_per_tile)
+        lats = origin_lat + rng.uniform(0, TILE_SIZE_DEG[1], trees_per_tile)
+        json_prefix = f"{base_prefix}{tile_id}/{year}/JSON_TreeData_{tile_id}/"
+        csv_prefix = f"{base_prefix}{tile_id}/{year}/Shading_Metrics_{tile_id}/"
+        for tree_id in range(trees_per_tile):
+            lon, lat = float(lons[tree_id]), float(lats[tree_id])
+            tree = tree_cluster_json(rng, tile_id, year, tree_id, lon, lat, points_per_tree)
+            writer.write(f"{json_prefix}{tile_id}_{year}_ID_{tree_id}_TreeCluster.json", json.dumps(tree))
+            if rng.random() >= missing_csv_ratio:
+                writer.write(f"{csv_prefix}Shading_Metric_{tile_id}_Tree_ID_{tree_id}.csv",
+                             shading_metric_csv(rng, year, days, step_minutes))
+
+        n_census = int(round(trees_per_tile * census_density))
+        near = rng.random(n_census) < 0.85
+        anchors = rng.integers(0, trees_per_tile, n_census)
+        jitter = rng.normal(0, census_jitter_m / 111000, (n_census, 2))
+        census_lons = np.where(near, lons[anchors] + jitter[:, 0], origin_lon + rng.uniform(0, TILE_SIZE_DEG[0], n_census))
+        census_lats = np.where(near, lats[anchors] + jitter[:, 1], origin_lat + rng.uniform(0, TILE_SIZE_DEG[1], n_census))
+        for lon, lat in zip(census_lons, census_lats):
+            census_features.append(census_feature(rng, census_id, float(lon), float(lat)))
+            census_id += 1
+    return {'type': 'FeatureCollection', 'features': census_features}
+
+
+def borough_boundary(n_tiles):
+    # One Brooklyn polygon around every generated tile
+    cols = min(n_tiles, 10)
+    rows = (n_tiles + 9) // 10
+    min_lon, min_lat = TILE_ORIGIN[0] - 0.01, TILE_ORIGIN[1] - 0.01
+    max_lon = TILE_ORIGIN[0] + cols * TILE_SIZE_DEG[0] + 0.01
+    max_lat = TILE_ORIGIN[1] + rows * TILE_SIZE_DEG[1] + 0.01
+    ring = [[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]]
+    return {
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'properties': {'boro_code': '3', 'boro_name': 'Brooklyn'},
+            'geometry': {'type': 'MultiPolygon', 'coordinates': [[ring]]}
+        }]
+    }
+
+
+def generate_dataset(output_root, bucket_name='treefolio-synthetic', base_prefix='ProcessedLasData/Synthetic/',
+                     n_tiles=1, trees_per_tile=1000, year='2017', s3_client=None, **kwargs):
+    # Writes the tiles under output_root/bucket_name (or to s3_client), and the census and
+    # boundary GeoJSONs under output_root/StreetTreeGeoJSONs and output_root/Boundaries
+    tile_ids = [str(900000 + i) for i in range(n_tiles)]
+    writer = S3Writer(s3_client, bucket_name) if s3_client is not None else LocalWriter(output_root, bucket_name)
+    census = generate_tiles(writer, base_prefix, tile_ids, year, trees_per_tile, **kwargs)
+
+    census_dir = os.path.join(output_root, 'StreetTreeGeoJSONs')
+    boundary_dir = os.path.join(output_root, 'Boundaries')
+    os.makedirs(census_dir, exist_ok=True)
+    os.makedirs(boundary_dir, exist_ok=True)
+    with open(os.path.join(census_dir, 'Synthetic_StreetTrees.geojson'), 'w') as f:
+        json.dump(census, f)
+    boundary_path = os.path.join(boundary_dir, 'Borough_Boundaries.geojson')
+    with open(boundary_path, 'w') as f:
+        json.dump(borough_boundary(n_tiles), f)
+    return {
+        'root': output_root,
+        'bucket_name': bucket_name,
+        'base_prefix': base_prefix,
+        'year': year,
+        'tile_ids': tile_ids,
+        'census_dir': census_dir,
+        'boundary_path': boundary_path
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic TreeFolio tiles for local runs and benchmarks.')
+    parser.add_argument('output_root', help='directory used as the fake S3 root')
+    parser.add_argument('--bucket', default='treefolio-synthetic')
+    parser.add_argument('--base-prefix', default='ProcessedLasData/Synthetic/')
+    parser.add_argument('--tiles', type=int, default=1)
+    parser.add_argument('--trees', type=int, default=1000, help='LiDAR trees per tile')
+    parser.add_argument('--year', default='2017')
+    parser.add_argument('--census-density', type=float, default=0.7, help='census trees per LiDAR tree')
+    parser.add_argument('--missing-csv-ratio', type=float, default=0.02)
+    parser.add_argument('--points-per-tree', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--s3', action='store_true', help='upload to the real bucket instead of output_root')
+    args = parser.parse_args()
+
+    s3_client = None
+    if args.s3:
+        import boto3
+        s3_client = boto3.client('s3')
+    dataset = generate_dataset(args.output_root, args.bucket, args.base_prefix, args.tiles, args.trees, args.year,
+                               s3_client=s3_client, census_density=args.census_density,
+                               missing_csv_ratio=args.missing_csv_ratio, points_per_tree=args.points_per_tree,
+                               seed=args.seed)
+    print(json.dumps(dataset, indent=4))
+
+
+if __name__ == "__main__":
+    main()
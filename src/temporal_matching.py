@@ -0,0 +1,174 @@
+import os
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from tqdm import tqdm
+from shade_windows import SHADE_WINDOWS, window_output_keys
+
+# Matches the LiDAR trees of one tile across two acquisitions (e.g. 2017 vs 2021 LAS, both under
+# {tile}/{year}/ in the bucket or a local copy) and writes one change record per tree:
+#   matched - the tree was found in both years within the tolerance, with height/canopy/shade deltas
+#   removed - the tree is only in the earlier year
+#   new     - the tree is only in the later year
+# Trees of each year are turned into columns once and joined with a KD-tree in EPSG:2263 feet,
+# so a tile is a handful of array operations instead of a loop over tree pairs.
+#
+#   python src/temporal_matching.py --years 2017 2021 --output-dir /data/Datasets/CanopyChange
+
+MEASURES = ['TopofCanopyHeight', 'CanopyVolume', 'CanopyArea', 'GroundHeight']
+SHADE_KEYS = window_output_keys(SHADE_WINDOWS)
+
+
+def tree_columns(trees):
+    # One row per LiDAR tree with the measures that can change between acquisitions, straight
+    # from the TreeBatch arrays; None gives the empty frame of a year without data
+    if trees is None:
+        return pd.DataFrame({column: np.array([], dtype=float)
+                             for column in ['Tree_CountID', 'Longitude', 'Latitude'] + MEASURES})
+    return pd.DataFrame({
+        'Tree_CountID': trees.tree_count_id,
+        'Longitude': trees.longitude,
+        'Latitude': trees.latitude,
+        'TopofCanopyHeight': trees.foliage_height,
+        'CanopyVolume': trees.canopy_volume,
+        'CanopyArea': trees.canopy_area,
+        'GroundHeight': trees.ground_z,
+        **{key: trees.shade[key] for key in SHADE_KEYS if key in trees.shade}
+    })
+
+
+def load_year_trees(pipeline, storage, tile_id, year, with_shade=True, batch_size=100, max_fetch_workers=8):
+    trees = pipeline.load_tree_jsons(storage, tile_id, year)
+    if trees is None:
+        return None
+    if with_shade:
+        trees = pipeline.match_shade_data(trees, storage, tile_id, year, batch_size, max_fetch_workers)
+    return tree_columns(trees)
+
+
+def match_across_years(before, after, tolerance_ft, project_lonlat):
+    # Returns (before_index, after_index, distance_ft) of one-to-one pairs: every earlier tree takes
+    # its nearest later tree within the tolerance, and a later tree claimed twice keeps the closest
+    empty = np.array([], dtype=np.int64)
+    if len(before) == 0 or len(after) == 0:
+        return empty, empty, np.array([], dtype=float)
+    after_points = project_lonlat(after[['Longitude', 'Latitude']].to_numpy())
+    before_points = project_lonlat(before[['Longitude', 'Latitude']].to_numpy())
+    distances, indices = cKDTree(after_points).query(before_points, k=1, distance_upper_bound=tolerance_ft)
+    found = np.isfinite(distances)
+    before_index = found.nonzero()[0]
+    after_index = indices[found]
+    distances = distances[found]
+
+    order = np.lexsort((before_index, distances))
+    _, first = np.unique(after_index[order], return_index=True)
+    keep = np.sort(order[first])
+    return before_index[keep], after_index[keep], distances[keep]
+
+
+def change_records(before, after, years, tolerance_ft, project_lonlat):
+    year_a, year_b = years
+    before_index, after_index, distances = match_across_years(before, after, tolerance_ft, project_lonlat)
+
+    matched = pd.concat([
+        before.iloc[before_index].add_suffix(f'_{year_a}').reset_index(drop=True),
+        after.iloc[after_index].add_suffix(f'_{year_b}').reset_index(drop=True)
+    ], axis=1)
+    matched.insert(0, 'Status', 'matched')
+    matched['Distance_ft'] = distances
+
+    removed = before.drop(index=before.index[before_index]).add_suffix(f'_{year_a}').reset_index(drop=True)
+    removed.insert(0, 'Status', 'removed')
+    new = after.drop(index=after.index[after_index]).add_suffix(f'_{year_b}').reset_index(drop=True)
+    new.insert(0, 'Status', 'new')
+
+    records = pd.concat([frame for frame in (matched, removed, new) if len(frame)] or [matched], ignore_index=True)
+    # a year without trees (tile flown once) has no rows to bring its columns, they are all NaN
+    columns = list(dict.fromkeys(list(before.columns) + list(after.columns)))
+    for year in years:
+        for column in columns:
+            if f'{column}_{year}' not in records.columns:
+                records[f'{column}_{year}'] = np.nan
+    # deltas are later minus earlier, NaN for trees present in a single year
+    for column in MEASURES + [column for column in SHADE_KEYS if column in columns]:
+        records[f'{column}_Delta'] = records[f'{column}_{year_b}'] - records[f'{column}_{year_a}']
+    return records
+
+
+def summarize_changes(tile_id, records, years):
+    year_a, year_b = years
+    status = records['Status']
+    matched = records[status == 'matched']
+    return {
+        'Tile_id': tile_id,
+        'matched': int(len(matched)),
+        'removed': int((status == 'removed').sum()),
+        'new': int((status == 'new').sum()),
+        f'trees_{year_a}': int((status != 'new').sum()),
+        f'trees_{year_b}': int((status != 'removed').sum()),
+        'mean_height_delta': matched['TopofCanopyHeight_Delta'].mean() if len(matched) else np.nan,
+        'total_volume_delta': records[f'CanopyVolume_{year_b}'].sum() - records[f'CanopyVolume_{year_a}'].sum()
+    }
+
+
+def process_tile_change(pipeline, storage, tile_id, years, tolerance_ft, output_dir, with_shade=True,
+                        batch_size=100, max_fetch_workers=8):
+    year_a, year_b = years
+    frames = [load_year_trees(pipeline, storage, tile_id, year, with_shade, batch_size, max_fetch_workers)
+              for year in years]
+    if frames[0] is None and frames[1] is None:
+        return None
+    # a tile flown in only one of the years is all removed or all new
+    before, after = [frame if frame is not None else tree_columns(None) for frame in frames]
+    records = change_records(before, after, years, tolerance_ft, pipeline.project_lonlat)
+    records.insert(0, 'Tile_id', tile_id)
+    records.to_csv(os.path.join(output_dir, f'CanopyChange_{tile_id}_{year_a}_{year_b}.csv'), index=False)
+    return summarize_changes(tile_id, records, years)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Match LiDAR trees of two acquisition years and write change records.')
+    parser.add_argument('--years', nargs=2, default=['2017', '2021'], help='earlier and later acquisition year')
+    parser.add_argument('--bucket', default='treefolio-sylvania-data')
+    parser.add_argument('--base-prefix', default='ProcessedLasData/Sept17th-2023/')
+    parser.add_argument('--tiles', nargs='*', default=None, help='tile ids, defaults to every tile in the bucket')
+    parser.add_argument('--tolerance', type=float, default=5.0, help='largest move between years, in --unit')
+    parser.add_argument('--unit', default='ft', choices=['ft', 'm'])
+    parser.add_argument('--no-shade', action='store_true', help='skip the Shading_Metrics CSVs')
+    parser.add_argument('--local-s3', default=None, help='read the bucket from this folder instead of S3')
+    parser.add_argument('--sample-dir', default=None, help='read the tiles from this local folder (e.g. TFb or BK17)')
+    parser.add_argument('--output-dir', default='/data/Datasets/CanopyChange')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    os.environ.setdefault('TREEFOLIO_LOG_DIR', args.output_dir)
+    import pipeline_engine as pipeline
+    pipeline.configure_logging(os.environ['TREEFOLIO_LOG_DIR'])
+    storage = pipeline.open_storage(args.bucket, args.base_prefix, args.local_s3, args.sample_dir)
+
+    years = tuple(args.years)
+    tolerance_ft = pipeline.distance_in_feet(args.tolerance, args.unit)
+    tile_keys = args.tiles or storage.list_tiles()
+
+    summaries = []
+    for tile_id in tqdm(tile_keys, desc="Matching years"):
+        try:
+            summary = process_tile_change(pipeline, storage, tile_id, years, tolerance_ft, args.output_dir,
+                                          not args.no_shade)
+        except Exception as e:
+            logging.error(f"Error matching years for tile_id: {tile_id}. Error: {e}", exc_info=True)
+            continue
+        if summary is None:
+            logging.info(f"No LiDAR data for tile {tile_id} in {years[0]} or {years[1]}")
+            continue
+        summaries.append(summary)
+
+    summary_path = os.path.join(args.output_dir, f'canopy_change_summary_{years[0]}_{years[1]}.csv')
+    pd.DataFrame(summaries).to_csv(summary_path, index=False)
+    print(f"{len(summaries)} tiles matched across {years[0]} and {years[1]}, summary in {summary_path}")
+
+
+if __name__ == "__main__":
+    main()
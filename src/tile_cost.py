@@ -0,0 +1,107 @@
+import os
+import heapq
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from tile_report import load_tile_metrics
+
+# Tile cost estimates for longest-processing-time-first scheduling. A tile that was processed
+# before costs what its last successful run took (tile_performance.jsonl); any other tile is
+# estimated from one list_objects_v2 pass over its JSON_TreeData and Shading_Metrics objects,
+# with per-object and per-MB weights calibrated against the tiles that have past timings.
+# Dispatching the most expensive tiles first keeps a huge tile from starting last and leaving
+# every other worker idle at the end of the run.
+
+# seconds per JSON / CSV object and per MB downloaded, before calibration
+DEFAULT_WEIGHTS = {'json': 0.004, 'csv': 0.006, 'mb': 0.05}
+
+
+def listing_stats(objects, tile_id):
+    # objects are list_objects_v2 entries under the tile's {tile_id}/{year}/ folder
+    stats = {'json': 0, 'csv': 0, 'bytes': 0}
+    for obj in objects:
+        key = obj['Key']
+        if f'/JSON_TreeData_{tile_id}/' in key and key.endswith('.json'):
+            stats['json'] += 1
+        elif f'/Shading_Metrics_{tile_id}/' in key and key.endswith('.csv'):
+            stats['csv'] += 1
+        else:
+            continue
+        stats['bytes'] += obj.get('Size', 0)
+    return stats
+
+
+def list_tile_stats(storage, tile_id, year):
+    return listing_stats(storage.tile_objects(tile_id, year), tile_id)
+
+
+def model_seconds(json_count, csv_count, mb, weights=DEFAULT_WEIGHTS):
+    return weights['json'] * json_count + weights['csv'] * csv_count + weights['mb'] * mb
+
+
+def load_past_timings(tile_metrics_path):
+    # tile_id -> latest successful record of tile_performance.jsonl
+    if not tile_metrics_path or not os.path.exists(tile_metrics_path):
+        return {}
+    df = load_tile_metrics(tile_metrics_path)
+    if df.empty:
+        return {}
+    # process_tile and async_pipeline record a completed tile as 'done'
+    df = df[df['status'] == 'done']
+    return {row['tile_id']: row for row in df.to_dict('records')}
+
+
+def calibration_factor(past):
+    # How far the default weights are off on this machine: median of actual over modelled
+    # seconds, from the object counts each past run recorded (no bytes there, so mb=0)
+    ratios = []
+    for record in past.values():
+        modelled = model_seconds(record.get('trees_loaded', 0), record.get('csvs_found', 0), 0)
+        if modelled > 0 and record.get('total_s'):
+            ratios.append(record['total_s'] / modelled)
+    return float(np.median(ratios)) if ratios else 1.0
+
+
+def estimate_tile_costs(tile_keys, storage, year, tile_metrics_path=None, list_workers=16):
+    # Returns {tile_id: estimated seconds}; only tiles without a past timing are listed
+    past = load_past_timings(tile_metrics_path)
+    factor = calibration_factor(past)
+    costs = {tile_id: float(past[tile_id]['total_s']) for tile_id in tile_keys if tile_id in past}
+    to_list = [tile_id for tile_id in tile_keys if tile_id not in costs]
+    if to_list:
+        with ThreadPoolExecutor(max_workers=list_workers) as executor:
+            listings = executor.map(lambda tile_id: list_tile_stats(storage, tile_id, year), to_list)
+            for tile_id, stats in zip(to_list, listings):
+                costs[tile_id] = factor * model_seconds(stats['json'], stats['csv'], stats['bytes'] / 1e6)
+    logging.info(f"Tile costs: {len(tile_keys) - len(to_list)} from past runs, {len(to_list)} from listings, "
+                 f"calibration x{factor:.2f}")
+    return costs
+
+
+def lpt_order(tile_keys, costs):
+    # longest first; ties keep the original order
+    return sorted(tile_keys, key=lambda tile_id: -costs.get(tile_id, 0.0))
+
+
+def lpt_makespan(costs, workers):
+    # Greedy LPT on `workers` identical machines: each tile goes to the worker that frees up first.
+    # Returns the estimated makespan in seconds, what the run should take when the estimates hold.
+    loads = [0.0] * max(1, workers)
+    for cost in sorted(costs, reverse=True):
+        heapq.heappush(loads, heapq.heappop(loads) + cost)
+    return max(loads)
+
+
+def estimate_remaining(done_cost, remaining_cost, elapsed):
+    # Seconds left at the pace observed so far; scales the estimates by how fast the finished
+    # tiles actually went, which also covers how many workers are running
+    if done_cost <= 0 or elapsed <= 0:
+        return None
+    return remaining_cost * elapsed / done_cost
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return 'unknown'
+    seconds = int(seconds)
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m{seconds % 60:02d}s"
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from functools import lru_cache
+
+# Input fingerprints for incremental reprocessing. Each tile output carries a sidecar
+# NewMatchedShadingTrees_{tile}.fingerprint.json with a hash per input:
+#   s3_inputs    - keys and ETags of the tile's JSON_TreeData and Shading_Metrics objects
+#   census_shard - the census trees inside the tile's buffered bounds, by content; their row
+#                  positions may change freely since the tile's census claims name trees by tree_id
+#   boundary     - the borough boundary file
+#   code         - the pipeline source and the matching configuration
+# plan_stale_tiles compares them with the current inputs and returns only the tiles whose
+# outputs are out of date, with the components that changed.
+
+FINGERPRINT_COMPONENTS = ['code', 'boundary', 'census_shard', 's3_inputs']
+
+
+def _sha256_lines(lines):
+    digest = hashlib.sha256()
+    for line in lines:
+        digest.update(line.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def s3_listing_hash(objects, tile_id):
+    # objects are list_objects_v2 entries under {base_prefix}{tile_id}/{year}/
+    entries = []
+    for obj in objects:
+        key = obj['Key']
+        if f'/JSON_TreeData_{tile_id}/' in key or f'/Shading_Metrics_{tile_id}/' in key:
+            entries.append(f"{key} {obj['ETag']}")
+    entries.sort()
+    return _sha256_lines(entries)
+
+
+def s3_inputs_hash(storage, tile_id, year):
+    # ETags come with the listing, so this is one list pass per tile and no downloads;
+    # storage is a pipeline_engine backend, local copies hash their sizes and mtimes instead
+    return s3_listing_hash(storage.tile_objects(tile_id, year), tile_id)
+
+
+@lru_cache(maxsize=32)
+def _file_sha256(path, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_sha256(path):
+    # Cached on (path, mtime, size) so the boundary file is hashed once per run, not per tile
+    stat = os.stat(path)
+    return _file_sha256(path, stat.st_mtime_ns, stat.st_size)
+
+
+def census_shard_hash(all_geojson, tile_bounds):
+    # tile_bounds is (minx, miny, maxx, maxy); the census points inside it are the only
+    # census trees that can influence the tile's matches. Only their content is hashed, not
+    # their rows in the city-wide census: nothing the tile saves refers to those rows
+    points = all_geojson['points']
+    if len(points) == 0:
+        return _sha256_lines([])
+    minx, miny, maxx, maxy = tile_bounds
+    inside = (points[:, 0] > minx) & (points[:, 0] < maxx) & (points[:, 1] > miny) & (points[:, 1] < maxy)
+    rows = inside.nonzero()[0]
+    properties = all_geojson['properties']
+    return _sha256_lines(
+        json.dumps([points[i].tolist(), properties.row(i)], sort_keys=True, default=str) for i in rows
+    )
+
+
+def code_version(source_paths, config):
+    lines = [file_sha256(path) for path in source_paths]
+    lines.append(json.dumps(config, sort_keys=True, default=str))
+    return _sha256_lines(lines)
+
+
+def fingerprint_path(output_dir, tile_id):
+    return os.path.join(output_dir, f'NewMatchedShadingTrees_{tile_id}.fingerprint.json')
+
+
+def save_fingerprint(output_dir, tile_id, fingerprint, tile_bounds):
+    record = {'tile_id': tile_id, 'tile_bounds': list(tile_bounds), 'components': fingerprint, 'created': time.time()}
+    with open(fingerprint_path(output_dir, tile_id), 'w') as f:
+        json.dump(record, f, indent=4)
+
+
+def load_fingerprint(output_dir, tile_id):
+    path = fingerprint_path(output_dir, tile_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        logging.error(f"Unreadable fingerprint for tile {tile_id}, treating it as stale")
+        return None
+
+
+def plan_stale_tiles(tile_keys, output_dir, is_processed, storage, year, all_geojson, boundary_path, code_hash,
+                     trust_unfingerprinted=True):
+    # Returns {tile_id: [reasons]} for tiles that need (re)processing. Cheap local checks run
+    # first, the storage listing only for tiles that are still fresh after them.
+    # trust_unfingerprinted keeps outputs written before fingerprints existed.
+    boundary_hash = file_sha256(boundary_path)
+    stale = {}
+    for tile_id in tile_keys:
+        if not is_processed(tile_id, output_dir):
+            stale[tile_id] = ['missing_output']
+            continue
+        stored = load_fingerprint(output_dir, tile_id)
+        if stored is None:
+            if not trust_unfingerprinted:
+                stale[tile_id] = ['no_fingerprint']
+            continue
+        components = stored['components']
+        reasons = []
+        if components.get('code') != code_hash:
+            reasons.append('code')
+        if components.get('boundary') != boundary_hash:
+            reasons.append('boundary')
+        if components.get('census_shard') != census_shard_hash(all_geojson, stored['tile_bounds']):
+            reasons.append('census_shard')
+        if not reasons and components.get('s3_inputs') != s3_inputs_hash(storage, tile_id, year):
+            reasons.append('s3_inputs')
+        if reasons:
+            stale[tile_id] = reasons
+    return stale
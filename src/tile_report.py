@@ -0,0 +1,126 @@
+import os
+import json
+import argparse
+import pandas as pd
+
+# Rank tiles by cost from the per-tile performance table (tile_performance.jsonl written by
+# pipeline_engine.process_tile) and break their time down into pipeline phases, so it is
+# clear whether S3, shading aggregation, matching or output writing is the bottleneck.
+#
+#   python src/tile_report.py /data/Datasets/MatchingResult_All/tile_performance.jsonl --top 20
+
+# Which phase each instrumented stage belongs to
+STAGE_PHASES = {
+    'load_tree_jsons': 's3',
+    'fetch_objects': 's3',
+    # names of the same stages in runs before pipeline_engine
+    'load_json_files_from_s3': 's3',
+    'fetch_s3_objects': 's3',
+    'aggregate_shade_batch': 'shading',
+    'match_json_with_geojson_boundary': 'borough',
+    'filter_geojson_data': 'census',
+    'construct_nearest_neighbors': 'matching',
+    'match_json_to_geojson': 'matching',
+    'post_process_matched_data': 'matching',
+    'construct_new_geojson': 'output',
+    'construct_new_geojson_from_shade': 'output',
+    'save_new_geojson': 'output',
+    # stages of async_pipeline.py, where the tiles overlap so the phases add up to more than total_s
+    'list': 's3',
+    'fetch_json': 's3',
+    'fetch_csv': 's3',
+    'shade': 'shading',
+    'borough': 'borough',
+    'match': 'matching',
+    'write': 'output',
+}
+
+COUNT_COLUMNS = ['trees_loaded', 'csvs_found', 'csvs_missing', 'census_candidates', 'matched', 'output_bytes', 'peak_rss_mb']
+
+
+def load_tile_metrics(tile_metrics_path):
+    records = []
+    with open(tile_metrics_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    if not records:
+        return pd.DataFrame()
+    df = pd.DataFrame(records)
+    stages = pd.DataFrame(df.pop('stages').tolist(), index=df.index).fillna(0.0)
+    stages.columns = [f'stage_{name}' for name in stages.columns]
+    df = pd.concat([df, stages], axis=1)
+    # A tile retried by the supervisor appears once per attempt, keep the latest one
+    df = df.sort_values('timestamp').drop_duplicates('tile_id', keep='last')
+    df['tile_id'] = df['tile_id'].astype(str)
+    for column in COUNT_COLUMNS:
+        if column not in df:
+            df[column] = 0
+    df[COUNT_COLUMNS] = df[COUNT_COLUMNS].fillna(0)
+    return df.reset_index(drop=True)
+
+
+def add_phase_columns(df):
+    stage_columns = [c for c in df.columns if c.startswith('stage_')]
+    phases = {}
+    for column in stage_columns:
+        phase = STAGE_PHASES.get(column[len('stage_'):], 'other')
+        phases.setdefault(phase, []).append(column)
+    for phase, columns in phases.items():
+        df[f'{phase}_s'] = df[columns].sum(axis=1)
+    df['bottleneck'] = df[[f'{phase}_s' for phase in phases]].idxmax(axis=1).str[:-2] if phases else None
+    return df, sorted(f'{phase}_s' for phase in phases)
+
+
+def build_report(tile_metrics_path, top=20, sort_by='total_s'):
+    df = load_tile_metrics(tile_metrics_path)
+    if df.empty:
+        return df, pd.DataFrame(), pd.DataFrame()
+    df, phase_columns = add_phase_columns(df)
+    ranked = df.sort_values(sort_by, ascending=False).head(top)
+    ranked = ranked[['tile_id', 'status', 'total_s'] + phase_columns + ['bottleneck'] + COUNT_COLUMNS]
+
+    # Share of the whole run spent in each phase
+    totals = df[phase_columns].sum()
+    overall = pd.DataFrame({'seconds': totals, 'share': totals / totals.sum() if totals.sum() else 0.0})
+    overall.index = [column[:-2] for column in overall.index]
+    overall = overall.sort_values('seconds', ascending=False)
+
+    status_counts = df['status'].value_counts().rename_axis('status').reset_index(name='tiles')
+    return ranked, overall, status_counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank tiles by processing cost and show stage breakdowns.')
+    parser.add_argument('tile_metrics_path', help='tile_performance.jsonl written by the matching pipeline')
+    parser.add_argument('--top', type=int, default=20, help='number of slowest tiles to show')
+    parser.add_argument('--sort-by', default='total_s',
+                        help='column to rank by, e.g. total_s, peak_rss_mb, s3_s, shading_s, output_bytes')
+    parser.add_argument('--csv', default=None, help='optionally write the full per-tile table to this CSV')
+    args = parser.parse_args()
+
+    ranked, overall, status_counts = build_report(args.tile_metrics_path, args.top, args.sort_by)
+    if ranked.empty:
+        print(f"No tile metrics found in {args.tile_metrics_path}")
+        return
+
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.2f}'.format):
+        print(f"Top {len(ranked)} tiles by {args.sort_by}:")
+        print(ranked.to_string(index=False))
+        print("\nTime per phase over all tiles:")
+        print(overall.to_string())
+        print("\nTiles per status:")
+        print(status_counts.to_string(index=False))
+
+    if args.csv:
+        full, _ = add_phase_columns(load_tile_metrics(args.tile_metrics_path))
+        csv_dir = os.path.dirname(args.csv)
+        if csv_dir and not os.path.exists(csv_dir):
+            os.makedirs(csv_dir)
+        full.to_csv(args.csv, index=False)
+        print(f"\nPer-tile table written to {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import logging
+import traceback
+import multiprocessing as mp
+from stage_metrics import peak_rss_mb
+
+try:
+    import resource
+except ImportError:  # not available on Windows, only the wall-clock timeout applies there
+    resource = None
+
+# Run each tile in its own subprocess with a memory budget and a wall-clock timeout.
+# A tile that runs out of memory, gets killed or times out is retried with a smaller
+# batch size and fewer concurrent fetches, and recorded as failed if it still doesn't fit.
+
+RETRYABLE_STATUSES = ('memory', 'killed', 'timeout')
+
+
+def _address_space_bytes():
+    # Current virtual size of this process (first field of /proc/self/statm, in pages)
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[0])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def _apply_memory_limit(memory_limit_mb):
+    if resource is None or not memory_limit_mb:
+        return
+    # The forked child already maps everything the parent loaded (census points, boundaries),
+    # so the budget is granted on top of that baseline rather than as an absolute cap
+    limit = _address_space_bytes() + int(memory_limit_mb * 1024 * 1024)
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _run_in_child(conn, func, args, kwargs, memory_limit_mb):
+    _apply_memory_limit(memory_limit_mb)
+    try:
+        result = func(*args, **kwargs)
+        status = 'error' if result is False else 'ok'
+        conn.send({'status': status, 'message': None, 'peak_rss_mb': peak_rss_mb()})
+    except MemoryError:
+        conn.send({'status': 'memory', 'message': traceback.format_exc(limit=5), 'peak_rss_mb': peak_rss_mb()})
+    except Exception:
+        conn.send({'status': 'error', 'message': traceback.format_exc(limit=5), 'peak_rss_mb': peak_rss_mb()})
+    finally:
+        conn.close()
+
+
+def run_supervised(func, args=(), kwargs=None, memory_limit_mb=None, timeout=None):
+    # fork keeps the shared, read-only inputs (e.g. all_geojson) copy-on-write instead of pickling them
+    ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_run_in_child, args=(child_conn, func, args, kwargs or {}, memory_limit_mb))
+    start_time = time.time()
+    proc.start()
+    child_conn.close()
+
+    outcome = None
+    if parent_conn.poll(timeout):
+        try:
+            outcome = parent_conn.recv()
+        except EOFError:
+            outcome = None
+        proc.join(5)
+    if proc.is_alive():
+        proc.terminate()
+        proc.join(5)
+        if proc.is_alive():
+            proc.kill()
+            proc.join()
+        if outcome is None:
+            outcome = {'status': 'timeout', 'message': f"Exceeded wall-clock limit of {timeout} seconds", 'peak_rss_mb': None}
+    if outcome is None:
+        # No report from the child: it was killed from outside, most likely by the kernel OOM killer
+        outcome = {'status': 'killed', 'message': f"Worker exited with code {proc.exitcode}", 'peak_rss_mb': None}
+    parent_conn.close()
+
+    outcome['exitcode'] = proc.exitcode
+    outcome['elapsed'] = round(time.time() - start_time, 3)
+    return outcome
+
+
+def degraded_settings(batch_size, max_fetch_workers, max_retries):
+    # First attempt uses the configured settings, each retry quarters the batch and halves the fetchers
+    settings = [{'batch_size': batch_size, 'max_fetch_workers': max_fetch_workers}]
+    for _ in range(max_retries):
+        prev = settings[-1]
+        settings.append({
+            'batch_size': max(1, prev['batch_size'] // 4),
+            'max_fetch_workers': max(1, prev['max_fetch_workers'] // 2)
+        })
+    return settings
+
+
+def record_failed_tile(failure_log_path, tile_id, attempts):
+    log_dir = os.path.dirname(failure_log_path)
+    if log_dir and not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    with open(failure_log_path, 'a') as f:
+        f.write(json.dumps({'tile_id': tile_id, 'attempts': attempts}) + '\n')
+
+
+def process_tile_supervised(process_func, tile_id, args, kwargs, batch_size, max_fetch_workers,
+                            memory_limit_mb, timeout, max_retries, failure_log_path):
+    attempts = []
+    for settings in degraded_settings(batch_size, max_fetch_workers, max_retries):
+        outcome = run_supervised(process_func, args, {**kwargs, **settings}, memory_limit_mb, timeout)
+        outcome.update(settings)
+        attempts.append(outcome)
+        if outcome['status'] == 'ok':
+            if len(attempts) > 1:
+                logging.info(f"Tile {tile_id} succeeded after {len(attempts)} attempts with {settings}")
+            return True
+        logging.warning(f"Tile {tile_id} attempt {len(attempts)} failed ({outcome['status']}) with {settings}: {outcome['message']}")
+        if outcome['status'] not in RETRYABLE_STATUSES:
+            break
+    logging.error(f"Tile {tile_id} failed after {len(attempts)} attempts, recorded in {failure_log_path}")
+    record_failed_tile(failure_log_path, tile_id, attempts)
+    return False
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+# Tile-level record batch passed between the load, shade, borough, match and write stages of
+# pipeline_engine. Instead of one nested dict per tree (the full TreeCluster JSON with its
+# ClusterPoints, copied again for the shade summary and wrapped again by the matcher) a tile is
+# a struct of arrays: one numpy array per numeric field, categoricals for repeated strings, and
+# the match state as index arrays into the tile's census features.
+
+def extract_tree_fields(data):
+    # The fields of a TreeCluster JSON the pipeline uses, in TREE_FIELDS order
+    location = data['PredictedTreeLocation']
+    hull = data['ConvexHull_TreeDict']
+    return (data['Tree_CountId'], data['RecordedYear'], data['TreeFoliageHeight'], hull['volume'], hull['area'],
+            data['InPark'], data['GroundZValue'], location['Longitude'], location['Latitude'])
+
+
+TREE_FIELDS = ['tree_count_id', 'recorded_year', 'foliage_height', 'canopy_volume', 'canopy_area', 'in_park',
+               'ground_z', 'longitude', 'latitude']
+FLOAT_FIELDS = {'foliage_height', 'canopy_volume', 'canopy_area', 'ground_z', 'longitude', 'latitude'}
+
+
+def compact_column(values):
+    # numbers and booleans become plain arrays, anything else (strings, None) a categorical
+    # so a repeated value is stored once per tile
+    array = np.asarray(values)
+    if array.dtype.kind in 'biuf':
+        return array
+    return pd.Categorical(values)
+
+
+class TreeBatch:
+    __slots__ = TREE_FIELDS + ['tile_id', 'boro_code', 'boro_name', 'shade', 'census_index', 'distance', 'matched',
+                               'candidate_indices', 'candidate_distances']
+
+    def __init__(self, tile_id, rows):
+        self.tile_id = tile_id
+        columns = list(zip(*rows)) if rows else [()] * len(TREE_FIELDS)
+        for field, values in zip(TREE_FIELDS, columns):
+            if field in FLOAT_FIELDS:
+                setattr(self, field, np.array(values, dtype=float))
+            else:
+                setattr(self, field, compact_column(values))
+        n = len(self.longitude)
+        self.boro_code = pd.Categorical([None] * n)
+        self.boro_name = pd.Categorical([None] * n)
+        # shade window output key -> float array, NaN where the tree has no shading CSV
+        self.shade = {}
+        # census_index is the position in the tile's filtered census features, -1 for none
+        self.census_index = np.full(n, -1, dtype=np.int64)
+        self.distance = np.full(n, np.nan)
+        self.matched = np.zeros(n, dtype=bool)
+        self.candidate_indices = None
+        self.candidate_distances = None
+
+    def __len__(self):
+        return len(self.longitude)
+
+    def lonlat(self):
+        return np.column_stack([self.longitude, self.latitude])
+
+    def set_shade(self, key, start, values):
+        if key not in self.shade:
+            self.shade[key] = np.full(len(self), np.nan)
+        self.shade[key][start:start + len(values)] = np.array(values, dtype=float)
+
+    def nbytes(self):
+        total = 0
+        for field in self.__slots__:
+            value = getattr(self, field)
+            if isinstance(value, dict):
+                total += sum(array.nbytes for array in value.values())
+            elif isinstance(value, (np.ndarray, pd.Categorical)):
+                total += value.nbytes
+        return total
+
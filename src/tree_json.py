@@ -0,0 +1,221 @@
+import os
+import re
+import sys
+import json
+import time
+import threading
+import argparse
+from json.decoder import scanstring
+from tree_batch import extract_tree_fields
+
+# Parsing of TreeCluster JSONs. The pipeline needs nine fields of a document whose bulk is the
+# ClusterPoints (and hull vertices) arrays, so parse_tree_fields avoids building those:
+#   simdjson - lazy document, only the needed fields are materialized
+#   orjson   - full parse, but several times faster than the stdlib
+#   scan     - stdlib only: walks the objects key by key, decodes the wanted values and skips
+#              numeric arrays with a regex instead of turning them into Python lists
+#   auto     - orjson for small documents, scan for large ones (when simdjson is missing)
+# The fastest available backend is used unless TREEFOLIO_JSON_BACKEND names one; whenever a fast
+# path fails the document is parsed again with json.loads, so malformed files raise the usual
+# json.JSONDecodeError.
+#
+#   python src/tree_json.py --points 200 2000 20000      # benchmark the available backends
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# key -> None to decode the value, or a nested spec for an object of which only some keys are needed
+TREE_FIELD_SPEC = {
+    'Tree_CountId': None,
+    'RecordedYear': None,
+    'TreeFoliageHeight': None,
+    'ConvexHull_TreeDict': {'volume': None, 'area': None},
+    'InPark': None,
+    'GroundZValue': None,
+    'PredictedTreeLocation': None
+}
+
+# documents from this size on are scanned rather than fully parsed by orjson
+AUTO_SCAN_BYTES = 32 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# a run of numbers, commas and brackets, e.g. the [[x, y, z], ...] of ClusterPoints
+_NUMERIC_ARRAY = re.compile(r'\[[-+0-9.eE,\s\[\]]*')
+
+
+def _skip_value(text, pos):
+    # End position of the value at pos. Arrays of numbers are skipped without decoding them,
+    # anything else goes through the decoder.
+    if text[pos] == '[':
+        span = _NUMERIC_ARRAY.match(text, pos).group()
+        span = span[:span.rfind(']') + 1]
+        # balanced means the array closed inside the run; otherwise it holds strings or objects
+        if span and span.count('[') == span.count(']'):
+            return pos + len(span)
+    return _decoder.raw_decode(text, pos)[1]
+
+
+def _scan_object(text, pos, spec, stop_early=False):
+    # Returns ({key: value} for the keys in spec, end position of the object)
+    pos = _WHITESPACE.match(text, pos).end()
+    if text[pos] != '{':
+        raise ValueError(f"Expected an object at {pos}")
+    values = {}
+    pos = _WHITESPACE.match(text, pos + 1).end()
+    if text[pos] == '}':
+        return values, pos + 1
+    while True:
+        if text[pos] != '"':
+            raise ValueError(f"Expected a key at {pos}")
+        key, pos = scanstring(text, pos + 1)
+        pos = _WHITESPACE.match(text, pos).end()
+        if text[pos] != ':':
+            raise ValueError(f"Expected ':' at {pos}")
+        pos = _WHITESPACE.match(text, pos + 1).end()
+        if key not in spec:
+            pos = _skip_value(text, pos)
+        elif spec[key] is None:
+            values[key], pos = _decoder.raw_decode(text, pos)
+        else:
+            values[key], pos = _scan_object(text, pos, spec[key])
+        if stop_early and len(values) == len(spec):
+            return values, pos
+        pos = _WHITESPACE.match(text, pos).end()
+        if text[pos] == '}':
+            return values, pos + 1
+        if text[pos] != ',':
+            raise ValueError(f"Expected ',' or '}}' at {pos}")
+        pos = _WHITESPACE.match(text, pos + 1).end()
+
+
+def _parse_scan(raw):
+    text = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+    values, _ = _scan_object(text, 0, TREE_FIELD_SPEC, stop_early=True)
+    return extract_tree_fields(values)
+
+
+def _parse_simdjson(raw):
+    # the parser reuses its buffers, and a document is only valid until the next parse, so
+    # every thread (the fetch workers of async_pipeline) parses with a parser of its own
+    parser = getattr(_simdjson_parsers, 'parser', None)
+    if parser is None:
+        parser = _simdjson_parsers.parser = simdjson.Parser()
+    document = parser.parse(raw)
+    location = document['PredictedTreeLocation']
+    hull = document['ConvexHull_TreeDict']
+    return (document['Tree_CountId'], document['RecordedYear'], document['TreeFoliageHeight'], hull['volume'],
+            hull['area'], document['InPark'], document['GroundZValue'], location['Longitude'], location['Latitude'])
+
+
+def _parse_orjson(raw):
+    return extract_tree_fields(orjson.loads(raw))
+
+
+def _parse_stdlib(raw):
+    return extract_tree_fields(json.loads(raw))
+
+
+def _parse_auto(raw):
+    # orjson wins on small documents, skipping the arrays wins once ClusterPoints dominates
+    if len(raw) < AUTO_SCAN_BYTES:
+        return _parse_orjson(raw)
+    return _parse_scan(raw)
+
+
+BACKENDS = {'stdlib': _parse_stdlib, 'scan': _parse_scan}
+if orjson is not None:
+    BACKENDS['orjson'] = _parse_orjson
+    BACKENDS['auto'] = _parse_auto
+if simdjson is not None:
+    _simdjson_parsers = threading.local()
+    BACKENDS['simdjson'] = _parse_simdjson
+
+
+def default_backend():
+    requested = os.environ.get('TREEFOLIO_JSON_BACKEND')
+    if requested:
+        if requested not in BACKENDS:
+            raise ValueError(f"JSON backend {requested} is not available, choose from {sorted(BACKENDS)}")
+        return requested
+    for name in ('simdjson', 'auto', 'scan'):
+        if name in BACKENDS:
+            return name
+
+
+_backend = default_backend()
+
+
+def parse_tree_fields(raw, backend=None):
+    # raw is the bytes of one TreeCluster JSON, returns the tuple of tree_batch.TREE_FIELDS
+    parse = BACKENDS[backend or _backend]
+    try:
+        return parse(raw)
+    except (ValueError, IndexError, TypeError):
+        # unusual layout or invalid JSON, the stdlib either handles it or raises JSONDecodeError
+        if parse is _parse_stdlib:
+            raise
+        return _parse_stdlib(raw)
+
+
+def benchmark(documents, backends, repeat=3):
+    results = {}
+    total_bytes = sum(len(raw) for raw in documents)
+    expected = [_parse_stdlib(raw) for raw in documents]
+    for name in backends:
+        parse = BACKENDS[name]
+        if [parse(raw) for raw in documents] != expected:
+            raise AssertionError(f"Backend {name} extracts different fields than json.loads")
+        best = float('inf')
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            for raw in documents:
+                parse(raw)
+            best = min(best, time.perf_counter() - start_time)
+        results[name] = {'ms_per_doc': 1000 * best / len(documents), 'mb_per_s': total_bytes / best / 1e6}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the TreeCluster JSON parsing backends.')
+    parser.add_argument('--files', nargs='*', default=None, help='real TreeCluster JSONs to parse')
+    parser.add_argument('--points', type=int, nargs='+', default=[200, 2000, 20000],
+                        help='ClusterPoints per synthetic document')
+    parser.add_argument('--docs', type=int, default=100, help='synthetic documents per size')
+    args = parser.parse_args()
+
+    suites = {}
+    if args.files:
+        documents = []
+        for path in args.files:
+            with open(path, 'rb') as f:
+                documents.append(f.read())
+        suites['files'] = documents
+    else:
+        import numpy as np
+        from synthetic_tiles import tree_cluster_json
+        rng = np.random.default_rng(0)
+        for points in args.points:
+            suites[f'{points} points'] = [
+                json.dumps(tree_cluster_json(rng, '900000', '2017', i, -73.95, 40.63, points)).encode('utf-8')
+                for i in range(args.docs)
+            ]
+
+    print(f"default backend: {_backend}")
+    backends = sorted(BACKENDS, key=lambda name: ['stdlib', 'scan', 'orjson', 'auto', 'simdjson'].index(name))
+    print(f"{'documents':<16}{'kb/doc':>10}" + ''.join(f"{name + ' ms':>14}" for name in backends))
+    for label, documents in suites.items():
+        results = benchmark(documents, backends)
+        kb = sum(len(raw) for raw in documents) / len(documents) / 1024
+        print(f"{label:<16}{kb:>10.1f}" + ''.join(f"{results[name]['ms_per_doc']:>14.3f}" for name in backends))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
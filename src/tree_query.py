@@ -0,0 +1,345 @@
+import os
+import json
+import time
+import math
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from pyproj import Transformer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Query service over the matched-tree outputs (NewMatchedShadingTrees_{tile}.geojson). `build`
+# reads every tile once into a column store: one .npy file per output property, strings
+# dictionary-encoded as int32 codes, rows ordered by a uniform grid of GRID_FEET cells in
+# EPSG:2263 so every grid cell is one contiguous slice of rows. `serve` and TreeStore memory-map
+# the columns, so opening the store is quick and a query only touches the rows of its cells:
+#   bbox / radius  - trees in a lon/lat box or within a distance of a point (ft or m)
+#   census_id, tree_countid, tile_id, any other output column - equality, several values allowed
+#   min_<column> / max_<column> - numeric ranges
+#   offset / limit - pagination, the total is returned with every page
+#
+#   python src/tree_query.py build /data/Datasets/MatchingResult_All /data/Datasets/TreeStore
+#   python src/tree_query.py serve /data/Datasets/TreeStore --port 8765
+#   curl 'localhost:8765/trees?Spc_common=London%20planetree&Zipcode=11203&Health=Poor&limit=50'
+#   curl 'localhost:8765/trees?near=-73.95,40.65,100&unit=m'
+
+OUTPUT_PREFIX = 'NewMatchedShadingTrees_'
+GRID_FEET = 500.0
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 10000
+INT_NULL = np.iinfo(np.int64).min
+FEET_PER_METRE = 3937 / 1200
+to_feet = Transformer.from_crs('EPSG:4326', 'EPSG:2263', always_xy=True)
+
+
+def _load_json(path):
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read()) if orjson is not None else json.load(f)
+
+
+def load_tile_properties(path):
+    # {column: list of values} for one tile output; the point is the tree's (matched) location
+    features = _load_json(path)['features']
+    columns = {}
+    for i, feature in enumerate(features):
+        for key, value in feature['properties'].items():
+            if key not in columns:
+                columns[key] = [None] * i
+            columns[key].append(value)
+        for values in columns.values():
+            if len(values) <= i:
+                values.append(None)
+    lonlat = np.array([feature['geometry']['coordinates'][:2] for feature in features], dtype=float).reshape(-1, 2)
+    return {'columns': columns, 'lonlat': lonlat, 'rows': len(features)}
+
+
+def column_kind(values):
+    types = {type(value) for value in values if value is not None}
+    if types <= {bool}:
+        return 'bool'
+    if types <= {int}:
+        return 'int'
+    if types <= {int, float}:
+        return 'float'
+    return 'category'
+
+
+def encode_column(values, kind):
+    # numpy array plus the categories of a dictionary-encoded column
+    if kind == 'bool':
+        return np.array([-1 if value is None else int(value) for value in values], dtype=np.int8), None
+    if kind == 'int':
+        return np.array([INT_NULL if value is None else value for value in values], dtype=np.int64), None
+    if kind == 'float':
+        return np.array([np.nan if value is None else value for value in values], dtype=float), None
+    codes, categories = pd.factorize(pd.Series([None if value is None else str(value) for value in values], dtype=object))
+    return codes.astype(np.int32), [str(category) for category in categories]
+
+
+def build_store(match_data_dir, store_dir, processes=None):
+    with os.scandir(match_data_dir) as entries:
+        paths = sorted(entry.path for entry in entries
+                       if entry.name.startswith(OUTPUT_PREFIX) and entry.name.endswith('.geojson'))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        tiles = [tile for tile in executor.map(load_tile_properties, paths, chunksize=8) if tile['rows']]
+    n = sum(tile['rows'] for tile in tiles)
+    names = list(dict.fromkeys(name for tile in tiles for name in tile['columns']))
+    lonlat = np.concatenate([tile['lonlat'] for tile in tiles]) if tiles else np.empty((0, 2))
+    x, y = to_feet.transform(lonlat[:, 0], lonlat[:, 1])
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+
+    # grid cells in feet, rows sorted by cell so a cell is the slice cell_start[c]:cell_start[c + 1]
+    origin = (float(x.min()), float(y.min())) if n else (0.0, 0.0)
+    grid_cols = int((x.max() - origin[0]) // GRID_FEET) + 1 if n else 1
+    grid_rows = int((y.max() - origin[1]) // GRID_FEET) + 1 if n else 1
+    cells = ((y - origin[1]) // GRID_FEET).astype(np.int64) * grid_cols + ((x - origin[0]) // GRID_FEET).astype(np.int64)
+    order = np.argsort(cells, kind='stable')
+    cell_start = np.searchsorted(cells[order], np.arange(grid_rows * grid_cols + 1))
+
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = {'rows': n, 'grid': {'origin': origin, 'cell_feet': GRID_FEET, 'cols': grid_cols, 'rows': grid_rows},
+                'sources': len(paths), 'built': time.time(), 'columns': {}}
+    arrays = {'_lon': lonlat[:, 0], '_lat': lonlat[:, 1], '_x_ft': x, '_y_ft': y, '_cell_start': cell_start}
+    for name in names:
+        values = [value for tile in tiles for value in tile['columns'].get(name, [None] * tile['rows'])]
+        kind = column_kind(values)
+        arrays[name], categories = encode_column(values, kind)
+        manifest['columns'][name] = {'kind': kind, 'categories': categories}
+    for file_name in os.listdir(store_dir):
+        if file_name.endswith('.npy'):
+            os.remove(os.path.join(store_dir, file_name))
+    for i, (name, array) in enumerate(arrays.items()):
+        # file names by position, column names have spaces and slashes
+        array = array if name == '_cell_start' else array[order]
+        np.save(os.path.join(store_dir, f'{i:03d}.npy'), np.ascontiguousarray(array))
+        manifest.setdefault('files', {})[name] = f'{i:03d}.npy'
+    with open(os.path.join(store_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+class TreeStore:
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.columns = self.manifest['columns']
+        self.arrays = {name: np.load(os.path.join(store_dir, file_name), mmap_mode='r')
+                       for name, file_name in self.manifest['files'].items()}
+        self.rows = self.manifest['rows']
+        # value -> code of every dictionary-encoded column
+        self.codes = {name: {category: code for code, category in enumerate(info['categories'])}
+                      for name, info in self.columns.items() if info['kind'] == 'category'}
+
+    def _cell_rows(self, x0, y0, x1, y1):
+        # rows of the grid cells overlapping a box in feet, one slice per grid row
+        grid = self.manifest['grid']
+        cols, origin, size = grid['cols'], grid['origin'], grid['cell_feet']
+        cx0, cx1 = max(0, int((x0 - origin[0]) // size)), min(cols - 1, int((x1 - origin[0]) // size))
+        cy0, cy1 = max(0, int((y0 - origin[1]) // size)), min(grid['rows'] - 1, int((y1 - origin[1]) // size))
+        if cx0 > cx1 or cy0 > cy1:
+            return np.array([], dtype=np.int64)
+        cell_start = self.arrays['_cell_start']
+        ranges = [np.arange(cell_start[cy * cols + cx0], cell_start[cy * cols + cx1 + 1]) for cy in range(cy0, cy1 + 1)]
+        return np.concatenate(ranges)
+
+    def _value_mask(self, name, values, rows):
+        if name not in self.columns:
+            raise KeyError(f"Unknown column {name}")
+        column = self.arrays[name] if rows is None else self.arrays[name][rows]
+        kind = self.columns[name]['kind']
+        if kind == 'category':
+            codes = [self.codes[name][str(value)] for value in values if str(value) in self.codes[name]]
+            return np.isin(column, codes)
+        if kind == 'bool':
+            return np.isin(column, [int(str(value).lower() in ('1', 'true')) for value in values])
+        return np.isin(column, [float(value) for value in values])
+
+    def _range_mask(self, name, low, high, rows):
+        if self.columns.get(name, {}).get('kind') not in ('int', 'float'):
+            raise KeyError(f"{name} is not a numeric column")
+        column = self.arrays[name] if rows is None else self.arrays[name][rows]
+        mask = column != INT_NULL if self.columns[name]['kind'] == 'int' else ~np.isnan(column)
+        if low is not None:
+            mask &= column >= low
+        if high is not None:
+            mask &= column <= high
+        return mask
+
+    def query(self, bbox=None, near=None, unit='ft', census_id=None, tree_countid=None, tile_id=None, where=None,
+              ranges=None, columns=None, offset=0, limit=DEFAULT_LIMIT):
+        # bbox: (min_lon, min_lat, max_lon, max_lat); near: (lon, lat, distance in unit);
+        # where: {column: value or list of values}; ranges: {column: (low or None, high or None)}
+        rows = None
+        distances = None
+        if bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            xs, ys = to_feet.transform([min_lon, min_lon, max_lon, max_lon], [min_lat, max_lat, min_lat, max_lat])
+            rows = self._cell_rows(min(xs), min(ys), max(xs), max(ys))
+            lon, lat = self.arrays['_lon'][rows], self.arrays['_lat'][rows]
+            rows = rows[(lon >= min_lon) & (lon <= max_lon) & (lat >= min_lat) & (lat <= max_lat)]
+        if near is not None:
+            lon, lat, distance = near
+            radius = distance * FEET_PER_METRE if unit in ('m', 'metres', 'meters') else distance
+            x, y = to_feet.transform(lon, lat)
+            candidates = self._cell_rows(x - radius, y - radius, x + radius, y + radius)
+            if rows is not None:
+                candidates = np.intersect1d(candidates, rows)
+            d = np.hypot(self.arrays['_x_ft'][candidates] - x, self.arrays['_y_ft'][candidates] - y)
+            inside = d <= radius
+            rows, distances = candidates[inside], d[inside]
+
+        filters = dict(where or {})
+        for name, value in (('Census_id', census_id), ('Tree_CountID', tree_countid), ('Tile_id', tile_id)):
+            if value is not None:
+                filters[name] = value
+        for name, values in filters.items():
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            mask = self._value_mask(name, values, rows)
+            rows = mask.nonzero()[0] if rows is None else rows[mask]
+            distances = None if distances is None else distances[mask]
+        for name, (low, high) in (ranges or {}).items():
+            mask = self._range_mask(name, low, high, rows)
+            rows = mask.nonzero()[0] if rows is None else rows[mask]
+            distances = None if distances is None else distances[mask]
+        if rows is None:
+            rows = np.arange(self.rows)
+        if distances is not None:
+            # nearest first around a point
+            order = np.argsort(distances, kind='stable')
+            rows, distances = rows[order], distances[order]
+
+        limit = max(0, min(int(limit), MAX_LIMIT))
+        offset = max(0, int(offset))
+        page = rows[offset:offset + limit]
+        trees = self.records(page, columns)
+        if distances is not None:
+            unit_distances = distances[offset:offset + limit] / (FEET_PER_METRE if unit in ('m', 'metres', 'meters') else 1)
+            for tree, distance in zip(trees, unit_distances.tolist()):
+                tree['query_distance'] = distance
+        return {'total': int(len(rows)), 'offset': offset, 'limit': limit, 'trees': trees}
+
+    def records(self, rows, columns=None):
+        names = columns or list(self.columns)
+        decoded = {}
+        for name in names:
+            kind = self.columns[name]['kind']
+            values = np.asarray(self.arrays[name][rows])
+            if kind == 'category':
+                categories = self.columns[name]['categories']
+                decoded[name] = [categories[code] if code >= 0 else None for code in values.tolist()]
+            elif kind == 'bool':
+                decoded[name] = [None if value < 0 else bool(value) for value in values.tolist()]
+            elif kind == 'int':
+                decoded[name] = [None if value == INT_NULL else value for value in values.tolist()]
+            else:
+                decoded[name] = [None if math.isnan(value) else value for value in values.tolist()]
+        return [dict(zip(names, values)) for values in zip(*decoded.values())] if names else [{} for _ in rows]
+
+
+def parse_query(params, store):
+    # query-string parameters (each a list, as parse_qs returns them) -> TreeStore.query arguments
+    def split(value):
+        return [part for part in value.split(',') if part != '']
+
+    kwargs = {'where': {}, 'ranges': {}}
+    for key, values in params.items():
+        value = values[-1]
+        if key == 'bbox':
+            kwargs['bbox'] = tuple(float(part) for part in split(value))
+        elif key == 'near':
+            kwargs['near'] = tuple(float(part) for part in split(value))
+        elif key in ('unit', 'offset', 'limit'):
+            kwargs[key] = value
+        elif key == 'columns':
+            kwargs['columns'] = split(value)
+        elif key in ('census_id', 'tree_countid', 'tile_id'):
+            kwargs[key] = split(value)
+        elif key.startswith(('min_', 'max_')) and key[4:] in store.columns:
+            low, high = kwargs['ranges'].get(key[4:], (None, None))
+            kwargs['ranges'][key[4:]] = (float(value), high) if key.startswith('min_') else (low, float(value))
+        elif key in store.columns:
+            kwargs['where'][key] = split(value)
+        else:
+            raise KeyError(f"Unknown parameter {key}")
+    return kwargs
+
+
+def make_handler(store):
+    class TreeQueryHandler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/columns':
+                self._send(200, {name: info['kind'] for name, info in store.columns.items()})
+                return
+            if url.path != '/trees':
+                self._send(404, {'error': f"Unknown path {url.path}, expected /trees or /columns"})
+                return
+            start_time = time.perf_counter()
+            try:
+                result = store.query(**parse_query(parse_qs(url.query), store))
+            except (KeyError, ValueError, TypeError) as e:
+                self._send(400, {'error': str(e)})
+                return
+            result['elapsed_ms'] = round((time.perf_counter() - start_time) * 1000, 3)
+            self._send(200, result)
+
+        def log_message(self, format, *args):
+            logging.info(f"{self.address_string()} {format % args}")
+
+    return TreeQueryHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Column store and query service over the matched-tree outputs.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='read every NewMatchedShadingTrees GeoJSON into a store')
+    build.add_argument('match_data_dir')
+    build.add_argument('store_dir')
+    build.add_argument('--processes', type=int, default=None)
+    serve = commands.add_parser('serve', help='answer /trees queries over HTTP')
+    serve.add_argument('store_dir')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    query = commands.add_parser('query', help='run one query, parameters as in the query string')
+    query.add_argument('store_dir')
+    query.add_argument('params', nargs='*', metavar='KEY=VALUE')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'build':
+        manifest = build_store(args.match_data_dir, args.store_dir, args.processes)
+        print(f"{manifest['rows']} trees from {manifest['sources']} tiles, {len(manifest['columns'])} columns in {args.store_dir}")
+        return
+    start_time = time.perf_counter()
+    store = TreeStore(args.store_dir)
+    logging.info(f"Opened {store.rows} trees in {(time.perf_counter() - start_time) * 1000:.1f} ms")
+    if args.command == 'query':
+        params = {key: [value] for key, value in (param.split('=', 1) for param in args.params)}
+        print(json.dumps(store.query(**parse_query(params, store)), indent=4))
+        return
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(store))
+    print(f"Serving {store.rows} trees on http://{args.host}:{args.port}/trees")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
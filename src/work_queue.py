@@ -0,0 +1,256 @@
+import os
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from tile_cost import estimate_remaining, format_duration
+
+# Shared tile queue for running one city-wide job on several machines. The queue is a SQLite
+# file on storage every node mounts (EFS/NFS) or a local path for several workers on one box.
+# A node leases one tile at a time; the lease expires unless the node's heartbeat renews it, so
+# the tiles of a node that died are leased again by the others. The run is over when no tile is
+# pending or leased, whichever node gets there first. Tiles carry their estimated cost as
+# priority and are leased most expensive first (LPT), see tile_cost.py.
+#
+# A queue file holds one run at a time. Once its finalizer is done the queue is marked
+# finalized, and the first worker of the next run on the same file clears it and seeds that
+# run's stale tiles, failed ones included. An interrupted run is resumed instead; reset_queue
+# (--reset-queue) starts over from a fresh plan.
+#
+# The rollback journal is kept (no WAL), WAL needs shared memory that network filesystems do
+# not provide. Every change is one short IMMEDIATE transaction.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    tile_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,            -- pending, leased, done, failed, fresh
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    priority REAL NOT NULL DEFAULT 0,   -- estimated seconds
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+LEASE_SECONDS = 10 * 60
+POLL_SECONDS = 30
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def connect_queue(queue_path):
+    queue_dir = os.path.dirname(queue_path)
+    if queue_dir and not os.path.exists(queue_dir):
+        os.makedirs(queue_dir)
+    # isolation_level=None: transactions are opened explicitly with BEGIN IMMEDIATE
+    conn = sqlite3.connect(queue_path, timeout=60, isolation_level=None)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _claim_meta(conn, key, value):
+    # True for exactly one caller per key
+    cursor = conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)", (key, value))
+    return cursor.rowcount == 1
+
+
+def get_meta(conn, key):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _clear_queue(conn):
+    conn.execute("DELETE FROM tiles")
+    conn.execute("DELETE FROM meta")
+
+
+def reset_queue(conn):
+    # Drops every tile and the seeder/finalizer claims, only while no worker uses the queue
+    conn.execute("BEGIN IMMEDIATE")
+    _clear_queue(conn)
+    conn.execute("COMMIT")
+
+
+def claim_seeding(conn, worker_id):
+    # True for the one worker that seeds this run; a finalized queue is cleared first
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if get_meta(conn, 'finalized') is not None:
+            logging.info(f"Queue was finalized by an earlier run, {worker_id} starts a new one")
+            _clear_queue(conn)
+        claimed = _claim_meta(conn, 'seeder', worker_id)
+        conn.execute("COMMIT")
+        return claimed
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def seed_queue(conn, stale_tiles, fresh_tiles, costs=None):
+    # Stale tiles wait for a worker; fresh ones are only listed so the finalizer sees every tile
+    now = time.time()
+    costs = costs or {}
+    conn.execute("BEGIN IMMEDIATE")
+    conn.executemany("INSERT OR IGNORE INTO tiles (tile_id, state, priority, updated) VALUES (?, 'pending', ?, ?)",
+                     [(tile_id, costs.get(tile_id, 0.0), now) for tile_id in stale_tiles])
+    conn.executemany("INSERT OR IGNORE INTO tiles (tile_id, state, updated) VALUES (?, 'fresh', ?)",
+                     [(tile_id, now) for tile_id in fresh_tiles])
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seeded', ?)", (str(now),))
+    conn.execute("COMMIT")
+
+
+def wait_until_seeded(conn, poll_seconds=5):
+    while get_meta(conn, 'seeded') is None:
+        time.sleep(poll_seconds)
+
+
+def lease_tile(conn, worker_id, lease_seconds=LEASE_SECONDS, max_attempts=3):
+    # Most expensive pending tile, or a leased one whose owner stopped heart-beating
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT tile_id FROM tiles WHERE attempts < ? AND "
+            "(state = 'pending' OR (state = 'leased' AND lease_expires < ?)) ORDER BY priority DESC, rowid LIMIT 1",
+            (max_attempts, now)).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        conn.execute(
+            "UPDATE tiles SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ? "
+            "WHERE tile_id = ?", (worker_id, now + lease_seconds, now, row[0]))
+        conn.execute("COMMIT")
+        return row[0]
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def renew_lease(conn, tile_id, worker_id, lease_seconds=LEASE_SECONDS):
+    # False once the lease was lost, e.g. after a long pause that let it expire and be re-leased
+    now = time.time()
+    cursor = conn.execute(
+        "UPDATE tiles SET lease_expires = ?, updated = ? WHERE tile_id = ? AND worker = ? AND state = 'leased'",
+        (now + lease_seconds, now, tile_id, worker_id))
+    return cursor.rowcount == 1
+
+
+def complete_tile(conn, tile_id, worker_id, ok):
+    cursor = conn.execute(
+        "UPDATE tiles SET state = ?, lease_expires = NULL, updated = ? WHERE tile_id = ? AND worker = ?",
+        ('done' if ok else 'failed', time.time(), tile_id, worker_id))
+    return cursor.rowcount == 1
+
+
+def fail_exhausted_tiles(conn, max_attempts=3):
+    # Tiles whose lease ran out max_attempts times (their node died each time) count as failed
+    conn.execute("UPDATE tiles SET state = 'failed', lease_expires = NULL, updated = ? "
+                 "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                 (time.time(), time.time(), max_attempts))
+
+
+def queue_counts(conn):
+    return dict(conn.execute("SELECT state, COUNT(*) FROM tiles GROUP BY state").fetchall())
+
+
+def queue_drained(conn):
+    counts = queue_counts(conn)
+    return counts.get('pending', 0) == 0 and counts.get('leased', 0) == 0
+
+
+def queue_eta(conn):
+    # Seconds until the queue drains at the pace of all workers since seeding
+    done_cost, remaining_cost = conn.execute(
+        "SELECT COALESCE(SUM(CASE WHEN state IN ('done', 'failed') THEN priority END), 0), "
+        "COALESCE(SUM(CASE WHEN state IN ('pending', 'leased') THEN priority END), 0) FROM tiles").fetchone()
+    seeded = get_meta(conn, 'seeded')
+    elapsed = time.time() - float(seeded) if seeded else 0.0
+    return estimate_remaining(done_cost, remaining_cost, elapsed)
+
+
+def all_tile_ids(conn):
+    return [row[0] for row in conn.execute("SELECT tile_id FROM tiles ORDER BY rowid")]
+
+
+def claim_finalizing(conn, worker_id):
+    return _claim_meta(conn, 'finalizer', worker_id)
+
+
+def finish_finalizing(conn):
+    # the run is complete, the next worker to start on this queue seeds a new run
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('finalized', ?)", (str(time.time()),))
+
+
+class LeaseHeartbeat:
+    # Renews a lease from a background thread, with its own connection, while the tile runs
+    def __init__(self, queue_path, tile_id, worker_id, lease_seconds=LEASE_SECONDS):
+        self.queue_path = queue_path
+        self.tile_id = tile_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        conn = connect_queue(self.queue_path)
+        try:
+            while not self._stop.wait(self.lease_seconds / 3):
+                try:
+                    if not renew_lease(conn, self.tile_id, self.worker_id, self.lease_seconds):
+                        logging.warning(f"Lease on tile {self.tile_id} was lost by {self.worker_id}")
+                        self.lost = True
+                        return
+                except sqlite3.OperationalError as e:
+                    # a busy or briefly unreachable queue file, the next beat tries again
+                    logging.warning(f"Heartbeat for tile {self.tile_id} failed: {e}")
+        finally:
+            conn.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_queue_worker(queue_path, worker_id, process_tile_key, lease_seconds=LEASE_SECONDS, max_attempts=3,
+                     poll_seconds=POLL_SECONDS):
+    # Leases and processes tiles until the queue drains; process_tile_key(tile_id) returns True on success.
+    # Returns the number of tiles this worker processed.
+    conn = connect_queue(queue_path)
+    processed = 0
+    try:
+        while True:
+            tile_id = lease_tile(conn, worker_id, lease_seconds, max_attempts)
+            if tile_id is None:
+                fail_exhausted_tiles(conn, max_attempts)
+                if queue_drained(conn):
+                    break
+                # other nodes still hold leases; wait in case one dies and its tile comes back
+                time.sleep(poll_seconds)
+                continue
+            logging.info(f"Worker {worker_id} leased tile {tile_id}")
+            with LeaseHeartbeat(queue_path, tile_id, worker_id, lease_seconds) as heartbeat:
+                try:
+                    ok = bool(process_tile_key(tile_id))
+                except Exception as e:
+                    logging.error(f"Error processing tile_id: {tile_id}. Error: {e}", exc_info=True)
+                    ok = False
+            if heartbeat.lost or not complete_tile(conn, tile_id, worker_id, ok):
+                logging.warning(f"Tile {tile_id} was re-leased while {worker_id} processed it, result not recorded")
+            processed += 1
+            logging.info(f"Queue {queue_counts(conn)}, estimated time to completion {format_duration(queue_eta(conn))}")
+        logging.info(f"Queue drained: {queue_counts(conn)}")
+    finally:
+        conn.close()
+    return processed
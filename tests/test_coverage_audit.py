@@ -0,0 +1,14 @@
+from fake_s3 import LocalS3Client
+from coverage_audit import s3_tile_folders
+
+
+def test_non_json_keys_before_the_tree_jsons(tmp_path):
+    s3 = LocalS3Client(str(tmp_path))
+    prefix = 'ProcessedLasData/Synthetic/'
+    s3.put_object('bucket', f'{prefix}1/2017/JSON_TreeData_1/1_2017_ID_1_TreeCluster.json', '{}')
+    # listed before the tree JSON
+    s3.put_object('bucket', f'{prefix}2/2017/JSON_TreeData_2/000_manifest.txt', 'manifest')
+    s3.put_object('bucket', f'{prefix}2/2017/JSON_TreeData_2/2_2017_ID_1_TreeCluster.json', '{}')
+    s3.put_object('bucket', f'{prefix}3/2017/JSON_TreeData_3/000_manifest.txt', 'manifest')
+    s3.put_object('bucket', f'{prefix}4/2017/Shading_Metrics_4/Shading_Metric_4_Tree_ID_1.csv', '')
+    assert s3_tile_folders(s3, 'bucket', prefix, '2017') == {'1': True, '2': True, '3': False, '4': False}
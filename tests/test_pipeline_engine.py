@@ -0,0 +1,43 @@
+import os
+import ast
+import numpy as np
+from census_store import CensusProperties
+from tree_batch import TreeBatch
+from pipeline_engine import match_tile, PIPELINE_MODULES, PIPELINE_SOURCES
+
+X_BUFFER_DISTANCE = 0.00009009
+Y_BUFFER_DISTANCE = 0.00010484
+
+
+def census(points):
+    properties = [{'tree_id': 100 + i, 'Latitude': lat, 'longitude': lon, 'spc_latin': 'Zelkova serrata',
+                   'spc_common': 'Japanese zelkova', 'tree_dbh': 14, 'curb_loc': 'OnCurb', 'status': 'Alive',
+                   'health': 'Good', 'address': f'{i} EAST 28 STREET', 'zipcode': 11226, 'boroname': 'Brooklyn'}
+                  for i, (lon, lat) in enumerate(points)]
+    return {'points': np.array(points, dtype=float), 'properties': CensusProperties.from_properties(properties)}
+
+
+def lidar_trees(points):
+    # tree_count_id, recorded_year, foliage_height, canopy_volume, canopy_area, in_park, ground_z, lon, lat
+    return TreeBatch('900000', [(i + 1, 2017, 30.0, 900.0, 300.0, False, 10.0, lon, lat)
+                                for i, (lon, lat) in enumerate(points)])
+
+
+def test_optimal_match_with_a_single_census_tree():
+    trees = lidar_trees([(-73.95, 40.63), (-73.9501, 40.6301), (-73.9502, 40.6302)])
+    result = match_tile(trees, census([(-73.95001, 40.63001)]), X_BUFFER_DISTANCE, Y_BUFFER_DISTANCE, 'optimal')
+    matched = result['trees'].matched
+    assert matched.sum() == 1
+    assert result['trees'].tree_count_id[matched][0] == 1
+    assert list(result['new_geojson']['Census_id'][matched]) == [100]
+
+
+def test_code_fingerprint_covers_the_local_imports():
+    # every local module the engine imports changes its results, except the fingerprint, timing and
+    # local S3 helpers
+    engine_path = PIPELINE_SOURCES[PIPELINE_MODULES.index('pipeline_engine')]
+    with open(engine_path) as f:
+        imported = {node.module for node in ast.walk(ast.parse(f.read())) if isinstance(node, ast.ImportFrom)}
+    src_dir = os.path.dirname(engine_path)
+    local = {module for module in imported if os.path.exists(os.path.join(src_dir, f'{module}.py'))}
+    assert local - set(PIPELINE_MODULES) == {'tile_fingerprint', 'stage_metrics', 'fake_s3'}
@@ -0,0 +1,40 @@
+import numpy as np
+from census_store import CensusProperties
+from tree_batch import TreeBatch
+from pipeline_engine import match_tile, save_census_claims, register_census_claims
+from seam_reconciliation import init_census_claims, resolve_seam_conflicts
+
+X_BUFFER_DISTANCE = 0.00009009
+Y_BUFFER_DISTANCE = 0.00010484
+SEAM_TREE = (-73.95001, 40.63)
+
+
+def census(trees):
+    # trees: (tree_id, lon, lat) in census order
+    properties = [{'tree_id': tree_id, 'Latitude': lat, 'longitude': lon, 'tree_dbh': 14}
+                  for tree_id, lon, lat in trees]
+    return {'points': np.array([(lon, lat) for _, lon, lat in trees], dtype=float),
+            'properties': CensusProperties.from_properties(properties)}
+
+
+def claim_tile(output_dir, tile_id, lon, lat, all_geojson):
+    # tree_count_id, recorded_year, foliage_height, canopy_volume, canopy_area, in_park, ground_z, lon, lat
+    trees = TreeBatch(tile_id, [(1, 2017, 30.0, 900.0, 300.0, False, 10.0, lon, lat)])
+    result = match_tile(trees, all_geojson, X_BUFFER_DISTANCE, Y_BUFFER_DISTANCE)
+    save_census_claims(output_dir, tile_id, result['trees'], result['census'])
+
+
+def test_claims_survive_a_reordered_and_grown_census(tmp_path):
+    # tile 1 ran against the old census, tile 2 after new trees were added in front of it
+    claim_tile(str(tmp_path), '900001', -73.94998, 40.63, census([(100, *SEAM_TREE), (101, -73.96, 40.64)]))
+    claim_tile(str(tmp_path), '900002', -73.950015, 40.63,
+               census([(102, -73.97, 40.65), (103, -73.98, 40.66), (101, -73.96, 40.64), (100, *SEAM_TREE)]))
+
+    claims = init_census_claims()
+    for tile_id in ['900001', '900002']:
+        register_census_claims(claims, str(tmp_path / 'census_claims'), tile_id)
+    corrections = resolve_seam_conflicts(claims)
+    assert len(corrections) == 1
+    correction = corrections.iloc[0]
+    assert (correction['tile_id'], correction['census_id']) == (900001, '100')
+    assert (correction['winner_tile_id'], correction['winner_tree_id']) == (900002, 1)
@@ -0,0 +1,26 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from stage_metrics import configure_stage_metrics, instrument_stage, tile_metrics_scope
+from async_pipeline import run_for_tile
+
+
+@instrument_stage
+def count_trees(trees):
+    return trees
+
+
+def test_stage_rows_name_the_tile_of_their_executor_call(tmp_path):
+    metrics_path = str(tmp_path / 'stage_metrics.jsonl')
+    configure_stage_metrics(metrics_path)
+    try:
+        # the async runner hands every tile's CPU work to a shared pool
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda tile_id: run_for_tile(tile_id, count_trees, [tile_id]), ['a', 'b', 'c', 'd']))
+        with tile_metrics_scope('e'):
+            count_trees(['e'])
+        count_trees([])
+    finally:
+        configure_stage_metrics(None)
+    with open(metrics_path) as f:
+        rows = [json.loads(line) for line in f]
+    assert sorted((row['tile_id'] or '') for row in rows) == ['', 'a', 'b', 'c', 'd', 'e']
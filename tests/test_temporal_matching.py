@@ -0,0 +1,27 @@
+import numpy as np
+from pipeline_engine import project_lonlat
+from temporal_matching import tree_columns, change_records, summarize_changes
+from tree_batch import TreeBatch
+
+
+def year_trees(points):
+    return tree_columns(TreeBatch('900000', [(i + 1, 2017, 30.0, 900.0, 300.0, False, 10.0, lon, lat)
+                                             for i, (lon, lat) in enumerate(points)]))
+
+
+def test_tile_flown_in_one_year_is_all_removed():
+    before = year_trees([(-73.95, 40.63), (-73.951, 40.631)])
+    records = change_records(before, tree_columns(None), ('2017', '2021'), 10, project_lonlat)
+    assert list(records['Status']) == ['removed', 'removed']
+    assert records['TopofCanopyHeight_Delta'].isna().all()
+    summary = summarize_changes('900000', records, ('2017', '2021'))
+    assert (summary['removed'], summary['new'], summary['trees_2021']) == (2, 0, 0)
+    assert np.isnan(summary['mean_height_delta'])
+
+
+def test_tile_flown_in_one_year_is_all_new():
+    after = year_trees([(-73.95, 40.63)])
+    records = change_records(tree_columns(None), after, ('2017', '2021'), 10, project_lonlat)
+    summary = summarize_changes('900000', records, ('2017', '2021'))
+    assert (summary['new'], summary['trees_2017']) == (1, 0)
+    assert summary['total_volume_delta'] == 900.0
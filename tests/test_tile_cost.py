@@ -0,0 +1,17 @@
+from stage_metrics import start_tile_metrics, set_tile_metric, finish_tile_metrics
+from tile_cost import load_past_timings, calibration_factor
+
+
+def test_past_timings_read_back_finished_tiles(tmp_path):
+    metrics_path = str(tmp_path / 'tile_performance.jsonl')
+    start_tile_metrics('900000')
+    set_tile_metric('trees_loaded', 400)
+    set_tile_metric('csvs_found', 390)
+    finish_tile_metrics(metrics_path, 'done')
+    start_tile_metrics('900001')
+    finish_tile_metrics(metrics_path, 'error')
+
+    past = load_past_timings(metrics_path)
+    assert list(past) == ['900000']
+    assert past['900000']['trees_loaded'] == 400
+    assert calibration_factor(past) != 1.0
@@ -0,0 +1,21 @@
+import numpy as np
+from census_store import CensusProperties
+from tile_fingerprint import census_shard_hash
+
+TILE_BOUNDS = (-73.951, 40.629, -73.949, 40.631)
+
+
+def census(trees):
+    # trees: (tree_id, lon, lat, tree_dbh) in census order
+    properties = [{'tree_id': tree_id, 'tree_dbh': dbh} for tree_id, _, _, dbh in trees]
+    return {'points': np.array([(lon, lat) for _, lon, lat, _ in trees], dtype=float),
+            'properties': CensusProperties.from_properties(properties)}
+
+
+def test_census_shard_hash_follows_content_not_rows():
+    inside = [(100, -73.95, 40.63, 14), (101, -73.9501, 40.6301, 8)]
+    outside = [(102, -73.97, 40.65, 20)]
+    before = census_shard_hash(census(inside + outside), TILE_BOUNDS)
+    # claims are keyed by tree_id, so a reordered or grown census leaves the tile fresh
+    assert census_shard_hash(census(outside + [(103, -73.98, 40.66, 5)] + inside), TILE_BOUNDS) == before
+    assert census_shard_hash(census([(100, -73.95, 40.63, 15)] + inside[1:] + outside), TILE_BOUNDS) != before
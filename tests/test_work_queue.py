@@ -0,0 +1,48 @@
+from work_queue import (connect_queue, claim_seeding, seed_queue, wait_until_seeded, run_queue_worker,
+                        claim_finalizing, finish_finalizing, reset_queue, queue_counts)
+
+
+def worker_run(queue_path, worker_id, stale_tiles, fresh_tiles, process_tile_key):
+    # the --worker flow of IndexMatch_HL_aws1.main; returns (tiles processed, finalized by this worker)
+    conn = connect_queue(queue_path)
+    try:
+        if claim_seeding(conn, worker_id):
+            seed_queue(conn, stale_tiles, fresh_tiles)
+        else:
+            wait_until_seeded(conn, poll_seconds=0.01)
+        processed = run_queue_worker(queue_path, worker_id, process_tile_key, poll_seconds=0.01)
+        finalized = claim_finalizing(conn, worker_id)
+        if finalized:
+            finish_finalizing(conn)
+        return processed, finalized
+    finally:
+        conn.close()
+
+
+def test_a_second_run_on_a_finalized_queue_seeds_its_own_tiles(tmp_path):
+    queue_path = str(tmp_path / 'tile_queue.sqlite')
+    assert worker_run(queue_path, 'node-1', ['a', 'b'], [], lambda tile_id: True) == (2, True)
+    # the next run finds tile c stale, and tile b again after its inputs changed
+    processed = []
+    assert worker_run(queue_path, 'node-1', ['c', 'b'], ['a'], lambda tile_id: processed.append(tile_id) or True) == (2, True)
+    assert sorted(processed) == ['b', 'c']
+
+
+def test_failed_tiles_are_retried_by_the_next_run(tmp_path):
+    queue_path = str(tmp_path / 'tile_queue.sqlite')
+    assert worker_run(queue_path, 'node-1', ['a', 'b'], [], lambda tile_id: tile_id == 'a') == (2, True)
+    assert worker_run(queue_path, 'node-2', ['b'], ['a'], lambda tile_id: True) == (1, True)
+    conn = connect_queue(queue_path)
+    assert queue_counts(conn) == {'done': 1, 'fresh': 1}
+    conn.close()
+
+
+def test_reset_queue_drops_an_interrupted_run(tmp_path):
+    queue_path = str(tmp_path / 'tile_queue.sqlite')
+    conn = connect_queue(queue_path)
+    assert claim_seeding(conn, 'node-1')
+    seed_queue(conn, ['a', 'b'], [])
+    # node-1 died before working; a restart resumes its tiles, a reset plans again
+    reset_queue(conn)
+    conn.close()
+    assert worker_run(queue_path, 'node-2', ['c'], ['a', 'b'], lambda tile_id: tile_id == 'c') == (1, True)